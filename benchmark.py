@@ -0,0 +1,687 @@
+
+# Бенчмарки парсера на локальных заглушках fragment.com и t.me
+import argparse
+import base64
+import contextlib
+import gc
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import main
+
+MODELS = ["Cake", "Muffin", "Pie", "Donut", "Cupcake", "Waffle", "Bagel", "Croissant"]
+BACKDROPS = ["Black", "Onyx", "Ivory", "Emerald", "Ruby", "Sapphire", "Amber"]
+SYMBOLS = ["Star", "Heart", "Moon", "Sun", "Clover", "Diamond", "Crown", "Bolt", "Leaf"]
+
+# Синтетические данные подарка (детерминированные по id)
+def make_fragment_json(collection_name, gift_id):
+    rnd = random.Random(gift_id)
+    return {
+        "name": f"{collection_name} #{gift_id}",
+        "description": f"Gift {collection_name} number {gift_id}",
+        "image": f"https://nft.fragment.com/gift/{collection_name.lower()}-{gift_id}.webp",
+        "lottie": f"https://nft.fragment.com/gift/{collection_name.lower()}-{gift_id}.lottie.json",
+        "attributes": [
+            {"trait_type": "Model", "value": rnd.choice(MODELS)},
+            {"trait_type": "Backdrop", "value": rnd.choice(BACKDROPS)},
+            {"trait_type": "Symbol", "value": rnd.choice(SYMBOLS)},
+        ],
+        "original_details": {
+            "sender_name": f"Sender{gift_id}",
+            "sender_telegram_id": 1000 + gift_id,
+            "recipient_name": f"Recipient{gift_id}",
+            "recipient_telegram_id": 2000 + gift_id,
+            "date": 1735689600 + gift_id,
+        },
+    }
+
+def make_telegram_html(collection_name, gift_id, version=0):
+    """Страница t.me; version > 0 — подарок сменил владельца."""
+    fragment = make_fragment_json(collection_name, gift_id)
+    rnd = random.Random(gift_id * 7919)
+    owner = f"{gift_id}.{version}" if version else f"{gift_id}"
+    rows = [
+        f'<tr><th>Owner</th><td><a href="https://t.me/owner{owner}">'
+        f'<img src="https://cdn.t.me/avatar/{owner}.jpg" alt=""> <span>Owner {owner}</span></a></td></tr>'
+    ]
+    for attr in fragment["attributes"]:
+        percent = round(rnd.uniform(0.1, 5.0), 1)
+        rows.append(f'<tr><th>{attr["trait_type"]}</th><td>{attr["value"]} <mark>{percent}%</mark></td></tr>')
+    rows.append(f'<tr><th>Quantity</th><td>{gift_id}/100 000 issued</td></tr>')
+    return (
+        '<!DOCTYPE html><html><head><meta charset="utf-8"><title>Telegram</title></head><body>'
+        '<div class="tgme_page"><div class="tgme_gift_preview"></div>'
+        '<div class="tgme_gift_table_wrap"><table class="tgme_gift_table"><tbody>'
+        + "".join(rows) +
+        '</tbody></table></div></div></body></html>'
+    ).encode("utf-8")
+
+# Нестандартные страницы t.me для сверки парсеров
+EDGE_CASE_PAGES = [
+    b'<html><body><p>no table</p></body></html>',
+    b'<html><body><div class="tgme_gift_table_wrap"><p>empty</p></div></body></html>',
+    (
+        '<html><head><meta charset="utf-8"></head><body>'
+        '<div class="x tgme_gift_table_wrap y"><table class="tgme_gift_table"><tbody>'
+        '<tr><th> Owner </th><td><span>\u0412\u043b\u0430\u0434\u0435\u043b\u0435\u0446 &amp; Co</span></td></tr>'
+        '<tr><th>Model</th><td>  Cake\n  <b>Pro</b> <mark> n/a % </mark></td></tr>'
+        '<tr><th>Backdrop</th><td>Onyx<mark>0.5%</mark> tail</td></tr>'
+        '<tr><th>Symbol</th><td><!-- hidden --> Star <mark>1,2%</mark></td></tr>'
+        '<tr><th>Empty</th><td></td></tr>'
+        '<tr><td>no header</td></tr>'
+        '</tbody></table></div></body></html>'
+    ).encode('utf-8'),
+    (
+        '<html><body><div class="tgme_gift_table_wrap"><table class="tgme_gift_table"><tbody>'
+        '<tr><th>Owner</th><td><a href="#"><img src="  https://cdn.t.me/a.jpg "><span> Name </span></a></td></tr>'
+        '<tr><th>Owner</th><td><img alt="no src"></td></tr>'
+        '</tbody></table></div></body></html>'
+    ).encode('utf-8'),
+]
+
+def load_corpus(corpus_dir, size):
+    """Загружает сохранённые страницы t.me или генерирует синтетический корпус."""
+    if corpus_dir and os.path.isdir(corpus_dir):
+        pages = []
+        for name in sorted(os.listdir(corpus_dir)):
+            if name.endswith('.html'):
+                with open(os.path.join(corpus_dir, name), 'rb') as f:
+                    pages.append((name, f.read()))
+        if pages:
+            return pages
+    pages = [(f"synthetic-{gift_id}", make_telegram_html("HomemadeCake", gift_id)) for gift_id in range(1, size + 1)]
+    pages += [(f"edge-{index}", page) for index, page in enumerate(EDGE_CASE_PAGES)]
+    return pages
+
+def save_corpus(corpus_dir, collection_name, start_id, end_id):
+    """Сохраняет реальные страницы t.me (*.html) и JSON fragment.com (*.json) в каталог корпуса."""
+    os.makedirs(corpus_dir, exist_ok=True)
+    client = main.get_http_client()
+    for gift_id in range(start_id, end_id + 1):
+        for url, extension in ((main.get_telegram_url(collection_name, gift_id), 'html'),
+                               (main.get_fragment_url(collection_name, gift_id), 'json')):
+            response = client.get(url)
+            if response.status_code == 200:
+                with open(os.path.join(corpus_dir, f"{collection_name}-{gift_id}.{extension}"), 'wb') as f:
+                    f.write(response.content)
+                print(f"Сохранена страница {url}")
+            else:
+                print(f"Пропуск {url}: HTTP {response.status_code}")
+
+def load_recorded(corpus_dir):
+    """Записанные ответы для заглушек: {"gift": [JSON fragment.com], "nft": [HTML t.me]}."""
+    recorded = {"gift": [], "nft": []}
+    if corpus_dir and os.path.isdir(corpus_dir):
+        for name in sorted(os.listdir(corpus_dir)):
+            kind = {".json": "gift", ".html": "nft"}.get(os.path.splitext(name)[1])
+            if kind:
+                with open(os.path.join(corpus_dir, name), 'rb') as f:
+                    recorded[kind].append(f.read())
+    return recorded
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Заголовки и тело пишутся отдельно: без TCP_NODELAY задержанный ACK добавляет ~200 мс
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        if server.error_rate and random.random() < server.error_rate:
+            self._send(503, b"", "text/plain")
+            return
+        match = re.match(r"^/(gift|nft)/([A-Za-z]+)-(\d+)$", self.path)
+        if not match:
+            self._send(404, b"", "text/plain")
+            return
+        kind, collection_name, gift_id = match.group(1), match.group(2), int(match.group(3))
+        if server.max_gift_id is not None and gift_id > server.max_gift_id:
+            self._send(404, b"", "text/plain")
+            return
+        content_type = "application/json" if kind == "gift" else "text/html; charset=utf-8"
+        recorded = server.recorded.get(kind)
+        if recorded:
+            # Записанных страниц меньше, чем подарков: повторяем их по кругу
+            body = recorded[(gift_id - 1) % len(recorded)]
+        elif kind == "gift":
+            body = json.dumps(make_fragment_json(collection_name, gift_id)).encode("utf-8")
+        else:
+            body = make_telegram_html(collection_name, gift_id, server.next_version(self.path))
+        etag = None
+        if server.etags:
+            etag = '"' + hashlib.md5(body).hexdigest() + '"'
+            if self.headers.get("If-None-Match") == etag:
+                self._send(304, b"", content_type, etag)
+                return
+        self._send(200, body, content_type, etag)
+
+    def _send(self, status, body, content_type, etag=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        if etag:
+            self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, latency=0.0, error_rate=0.0, etags=True, recorded=None, churn=0.0, max_gift_id=None):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.etags = etags
+        self.recorded = recorded or {}
+        self.churn = churn
+        # Подарков с id больше max_gift_id "ещё нет": заглушка отвечает 404
+        self.max_gift_id = max_gift_id
+        self.versions = {}
+        self._lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def next_version(self, path):
+        """Версия страницы: при повторных запросах меняется с вероятностью churn."""
+        with self._lock:
+            requests_seen, version = self.versions.get(path, (0, 0))
+            if requests_seen and self.churn and random.random() < self.churn:
+                version += 1
+            self.versions[path] = (requests_seen + 1, version)
+            return version
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+@contextlib.contextmanager
+def stub_sources(latency=0.0, error_rate=0.0, etags=True, recorded=None, churn=0.0, max_gift_id=None):
+    """Поднимает заглушки fragment.com и t.me и направляет на них main.py."""
+    fragment_server = StubServer(latency, error_rate, etags, recorded, max_gift_id=max_gift_id)
+    telegram_server = StubServer(latency, error_rate, etags, recorded, churn, max_gift_id)
+    saved = main.FRAGMENT_BASE_URL, main.TELEGRAM_BASE_URL
+    main.FRAGMENT_BASE_URL, main.TELEGRAM_BASE_URL = fragment_server.url, telegram_server.url
+    try:
+        yield fragment_server, telegram_server
+    finally:
+        main.FRAGMENT_BASE_URL, main.TELEGRAM_BASE_URL = saved
+        fragment_server.shutdown()
+        telegram_server.shutdown()
+
+def serve_sources(conn, latency, error_rate, etags, corpus, churn, max_gift_id):
+    """Точка входа процесса с заглушками: отправляет их адреса и работает до сигнала в conn."""
+    recorded = load_recorded(corpus)
+    servers = [StubServer(latency, error_rate, etags, recorded, max_gift_id=max_gift_id),
+               StubServer(latency, error_rate, etags, recorded, churn, max_gift_id)]
+    conn.send([server.url for server in servers])
+    conn.recv()
+    for server in servers:
+        server.shutdown()
+
+@contextlib.contextmanager
+def stub_sources_process(latency=0.0, error_rate=0.0, etags=True, corpus=None, churn=0.0, max_gift_id=None):
+    """Как stub_sources, но заглушки работают в отдельном процессе и не делят GIL с main.py."""
+    context = multiprocessing.get_context("spawn")
+    parent_conn, child_conn = context.Pipe()
+    process = context.Process(target=serve_sources, args=(child_conn, latency, error_rate, etags, corpus, churn, max_gift_id),
+                              daemon=True)
+    process.start()
+    saved = main.FRAGMENT_BASE_URL, main.TELEGRAM_BASE_URL
+    main.FRAGMENT_BASE_URL, main.TELEGRAM_BASE_URL = parent_conn.recv()
+    try:
+        yield
+    finally:
+        main.FRAGMENT_BASE_URL, main.TELEGRAM_BASE_URL = saved
+        parent_conn.send("stop")
+        process.join(timeout=5)
+
+# Заглушка S3-совместимого хранилища: принимает PutObject от boto3 по path-style адресам
+class S3StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_PUT(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if server.latency:
+            time.sleep(server.latency)
+        if server.error_rate and random.random() < server.error_rate:
+            self._send(503, b'<?xml version="1.0" encoding="UTF-8"?>'
+                            b'<Error><Code>SlowDown</Code><Message>Reduce your request rate</Message></Error>')
+            return
+        digest = hashlib.md5(body)
+        content_md5 = self.headers.get("Content-MD5")
+        if content_md5 and content_md5 != base64.b64encode(digest.digest()).decode("ascii"):
+            self._send(400, b'<?xml version="1.0" encoding="UTF-8"?>'
+                            b'<Error><Code>BadDigest</Code><Message>Content-MD5 mismatch</Message></Error>')
+            return
+        server.record(self.path, body, self.headers)
+        self._send(200, b"", '"' + digest.hexdigest() + '"')
+
+    def _send(self, status, body, etag=None):
+        self.send_response(status)
+        if etag:
+            self.send_header("ETag", etag)
+        if body:
+            self.send_header("Content-Type", "application/xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class S3StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, latency=0.0, error_rate=0.0):
+        super().__init__(("127.0.0.1", 0), S3StubHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.objects = {}
+        self._lock = threading.Lock()
+        self._reset_stats()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def _reset_stats(self):
+        self.puts = 0
+        self.bytes = 0
+        self.first_put = None
+        self.last_put = None
+
+    def record(self, path, body, headers):
+        now = time.perf_counter()
+        with self._lock:
+            self.objects[path] = {
+                "size": len(body),
+                "content_encoding": headers.get("Content-Encoding"),
+                "cache_control": headers.get("Cache-Control"),
+            }
+            self.puts += 1
+            self.bytes += len(body)
+            self.first_put = self.first_put or now
+            self.last_put = now
+
+    def take_stats(self):
+        """Возвращает статистику загрузок с прошлого вызова и сбрасывает её."""
+        with self._lock:
+            window = (self.last_put - self.first_put) if self.puts > 1 else 0.0
+            stats = {
+                "objects": self.puts,
+                "bytes": self.bytes,
+                "mb_per_second": self.bytes / 1024 / 1024 / window if window else 0.0,
+            }
+            self._reset_stats()
+        return stats
+
+def make_jobs(collection_name, count):
+    return [(collection_name, f"{collection_name}_{gift_id}", gift_id, collection_name)
+            for gift_id in range(1, count + 1)]
+
+def run_sweep(engine, jobs, config):
+    """Выполняет один обход и возвращает (секунды, число успешно обработанных подарков)."""
+    all_data = {collection_key: {} for collection_key, _, _, _ in jobs}
+    changed_keys = {collection_key: set() for collection_key in all_data}
+    index_dirty = set()
+    fingerprints = main.FingerprintIndex()
+
+    def on_result(collection_key, key, gift_data):
+        main.apply_gift_result(all_data, collection_key, key, gift_data, changed_keys, index_dirty, fingerprints)
+
+    main.init_http_client(config)
+    main.init_request_governor(config)
+    main.validator_cache = main.ValidatorCache()
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        if engine == "async":
+            main.run_async_sweep(jobs, config, on_result)
+        else:
+            main.run_threaded_sweep(jobs, config["thread_workers"], on_result)
+    elapsed = time.perf_counter() - started
+    return elapsed, sum(len(keys) for keys in changed_keys.values())
+
+# Сравнение движков: пул потоков против asyncio
+def bench_engines(args):
+    config = {
+        "thread_workers": args.thread_workers,
+        "async": {"max_in_flight": args.max_in_flight, "per_host_limit": args.per_host_limit},
+        # Заглушки не ограничивают частоту запросов
+        "governor": {"rate": 1e6, "burst": 1e6},
+    }
+    jobs = make_jobs("HomemadeCake", args.gifts)
+    engines = ["threads", "async"] if main.aiohttp is not None else ["threads"]
+    with stub_sources(latency=args.latency):
+        for engine in engines:
+            elapsed, ok = run_sweep(engine, jobs, config)
+            print(f"{engine:8s} подарков: {ok}/{len(jobs)}  время: {elapsed:.2f} с  "
+                  f"скорость: {ok / elapsed:.1f} подарков/с")
+    if main.aiohttp is None:
+        print("aiohttp не установлен, асинхронный движок пропущен.")
+
+# Сверка и сравнение скорости parse_gift_table и эталонного parse_gift_table_bs4
+def bench_parser(args):
+    if args.fetch:
+        collection_name, id_range = args.fetch.split(':')
+        start_id, end_id = (int(x) for x in id_range.split('-'))
+        save_corpus(args.corpus, collection_name, start_id, end_id)
+    pages = load_corpus(args.corpus, args.size)
+
+    mismatches = 0
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = [(name, main.parse_gift_table(page), main.parse_gift_table_bs4(page)) for name, page in pages]
+    for name, fast, reference in results:
+        if fast != reference:
+            mismatches += 1
+            print(f"Расхождение на {name}:\n  lxml: {fast}\n  bs4:  {reference}")
+    print(f"Сверка: страниц {len(pages)}, расхождений {mismatches}")
+
+    for label, parser in (("bs4", main.parse_gift_table_bs4), ("lxml", main.parse_gift_table)):
+        with contextlib.redirect_stdout(io.StringIO()):
+            started = time.perf_counter()
+            for _ in range(args.repeat):
+                for _, page in pages:
+                    parser(page)
+            elapsed = time.perf_counter() - started
+        total = len(pages) * args.repeat
+        print(f"{label:5s} {total / elapsed:10.1f} страниц/с  ({elapsed / total * 1e6:.1f} мкс/страница)")
+    if mismatches:
+        sys.exit(1)
+
+# Синтетическая коллекция без HTTP и разбора HTML
+def make_collection(collection_name, count):
+    gifts = {}
+    for gift_id in range(1, count + 1):
+        rnd = random.Random(gift_id * 7919)
+        fragment_data = make_fragment_json(collection_name, gift_id)
+        telegram_data = {
+            "Owner": f"Owner {gift_id}",
+            "Owner_avatar": f"https://cdn.t.me/avatar/{gift_id}.jpg",
+        }
+        for attr in fragment_data["attributes"]:
+            telegram_data[attr["trait_type"]] = {
+                "trait_type": attr["trait_type"], "value": attr["value"], "percent": round(rnd.uniform(0.1, 5.0), 1),
+            }
+        key = f"{collection_name}_{gift_id}"
+        gifts[key] = main.build_gift_data(gift_id, collection_name, fragment_data, telegram_data)
+    return gifts
+
+class NullUploader:
+    """Считает объекты и байты вместо загрузки в бакет."""
+
+    def __init__(self):
+        self.objects = 0
+        self.bytes = 0
+
+    def submit(self, object_key, body, **put_kwargs):
+        self.objects += 1
+        self.bytes += len(body.encode("utf-8") if isinstance(body, str) else body)
+
+# Скорость генерации главной страницы и страниц подарков
+def bench_render(args):
+    for size in args.sizes:
+        gifts = make_collection("HomemadeCake", size)
+        uploader = NullUploader()
+        with contextlib.redirect_stdout(io.StringIO()):
+            started = time.perf_counter()
+            manifest = main.generate_manifest(gifts, "HomemadeCake", uploader)
+            index_elapsed = time.perf_counter() - started
+            manifest_bytes = uploader.bytes
+            started = time.perf_counter()
+            main.generate_gift_pages(gifts, "HomemadeCake", uploader)
+            pages_elapsed = time.perf_counter() - started
+        page_objects = uploader.objects - len(manifest["pages"]) - 1
+        print(f"{size:>7} подарков: манифест {index_elapsed * 1000:8.1f} мс ({manifest_bytes / 1024 / 1024:.1f} МБ, "
+              f"{len(manifest['pages'])} стр.), страницы {pages_elapsed:6.2f} с ({size / pages_elapsed:,.0f} стр/с, "
+              f"{(uploader.bytes - manifest_bytes) / page_objects / 1024:.1f} КБ/стр)")
+
+# Память all_data: вложенные словари против GiftRecord
+def measure_state(payloads, convert):
+    """Байты, выделенные на состояние из JSON-строк хранилища, и время загрузки."""
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    state = {key: convert(key, json.loads(payload)) for key, payload in payloads}
+    elapsed = time.perf_counter() - started
+    gc.collect()
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del state
+    return allocated, elapsed
+
+def bench_memory(args):
+    for size in args.sizes:
+        # Подарки загружаются из строк, как из state.db: строки не разделяются между записями
+        payloads = [(key, json.dumps(data, ensure_ascii=False))
+                    for key, data in make_collection("HomemadeCake", size).items()]
+        dict_bytes, dict_elapsed = measure_state(payloads, lambda key, data: data)
+        record_bytes, record_elapsed = measure_state(payloads, main.compact_gift)
+        print(f"{size:>7} подарков: словари {dict_bytes / size:7.0f} Б/подарок ({dict_elapsed:5.2f} с), "
+              f"GiftRecord {record_bytes / size:7.0f} Б/подарок ({record_elapsed:5.2f} с), "
+              f"экономия {(1 - record_bytes / dict_bytes) * 100:.0f}%")
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+class RecordingMetrics(main.Metrics):
+    """Метрики main.py, дополнительно хранящие точные задержки подарков и отчёты циклов."""
+
+    s3 = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.gift_latencies = []
+        self.cycle_reports = []
+
+    def observe(self, name, seconds, **labels):
+        super().observe(name, seconds, **labels)
+        if labels.get("stage") == "gift":
+            self.gift_latencies.append(seconds)
+
+    def end_cycle(self, interval_seconds, summary_file=None):
+        summary = super().end_cycle(interval_seconds, summary_file)
+        latencies, self.gift_latencies = self.gift_latencies, []
+        summary["gift_p50_seconds"] = percentile(latencies, 0.5)
+        summary["gift_p99_seconds"] = percentile(latencies, 0.99)
+        summary["s3"] = self.s3.take_stats() if self.s3 else {}
+        self.cycle_reports.append(summary)
+        return summary
+
+def run_cycles(size, options):
+    """Полные циклы main.main() по синтетической коллекции; выполняется в отдельном процессе.
+
+    Заглушки источников работают в собственном процессе, заглушка S3 — в этом же,
+    поэтому пиковый RSS включает main.py и S3, но не источники.
+    """
+    s3 = S3StubServer(options["s3_latency"], options["s3_error_rate"])
+    workdir = tempfile.mkdtemp(prefix="giftexplorer-bench-")
+    os.chdir(workdir)
+    config = {
+        "collections": [{"name": "HomemadeCake", "start_id": 1, "end_id": size}],
+        "yandex": {"id": "bench", "key": "bench", "bucket_name": "bench", "endpoint_url": s3.url},
+        # С планировщиком цикл ждёт min_interval, иначе к следующему циклу ни один подарок не созреет
+        "interval_seconds": options["scheduler_interval"] if options["scheduler"] else 0,
+        "thread_workers": options["thread_workers"],
+        "engine": options["engine"],
+        "async": {"max_in_flight": options["max_in_flight"], "per_host_limit": options["per_host_limit"]},
+        # Заглушки не ограничивают частоту запросов, ошибки повторяются без долгих пауз
+        "governor": {"rate": 1e6, "burst": 1e6, "backoff_base": 0.01, "backoff_max": 0.1, "cooldown": 1},
+        # growth = 1: каждый цикл опрашивает все созревшие подарки, а не всё меньшую их долю
+        "scheduler": {"enabled": options["scheduler"], "min_interval": options["scheduler_interval"],
+                      "growth": 1.0, "requests_per_second": options["scheduler_rps"]},
+        "metadata": {"enabled": options["metadata_cache"]},
+        # Заглушки не отдают изображений, а внешние хосты бенчмарку недоступны
+        "assets": {"enabled": False},
+        "upload": {"workers": options["upload_workers"], "backoff_seconds": 0.01},
+        "metrics": {"port": 0},
+    }
+    with open("config.json", "w", encoding="utf-8") as f:
+        json.dump(config, f)
+    RecordingMetrics.s3 = s3
+    main.Metrics = RecordingMetrics
+    with stub_sources_process(options["latency"], options["error_rate"], corpus=options["corpus"],
+                              churn=options["churn"], max_gift_id=size):
+        with contextlib.redirect_stdout(io.StringIO()):
+            main.main("config.json", max_cycles=options["cycles"])
+    s3.shutdown()
+    return {
+        "size": size,
+        "cycles": main.get_metrics().cycle_reports,
+        # ru_maxrss в Linux — килобайты
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+def compare_with_baseline(results, baseline_file, tolerance):
+    """Сравнивает первый (холодный) цикл с сохранённым прогоном. Возвращает True при регрессии."""
+    with open(baseline_file, "r", encoding="utf-8") as f:
+        baseline = {str(result["size"]): result for result in json.load(f)}
+    regressed = False
+    for result in results:
+        base = baseline.get(str(result["size"]))
+        if not base:
+            continue
+        current, previous = result["cycles"][0], base["cycles"][0]
+        checks = [
+            ("подарков/с", current["gifts"]["per_second"], previous["gifts"]["per_second"], False),
+            ("p99", current["gift_p99_seconds"], previous["gift_p99_seconds"], True),
+            ("пиковый RSS", result["peak_rss_mb"], base["peak_rss_mb"], True),
+        ]
+        for name, value, reference, lower_is_better in checks:
+            if not reference:
+                continue
+            change = (value - reference) / reference
+            if (change > tolerance) if lower_is_better else (change < -tolerance):
+                regressed = True
+                print(f"РЕГРЕССИЯ {result['size']} подарков, {name}: {reference:.3f} → {value:.3f} ({change * 100:+.1f}%)")
+    return regressed
+
+# Полные циклы main() на заглушках fragment.com, t.me и S3
+def bench_cycles(args):
+    options = {
+        "cycles": args.cycles,
+        "engine": args.engine,
+        "latency": args.latency,
+        "error_rate": args.error_rate,
+        "churn": args.churn,
+        "s3_latency": args.s3_latency,
+        "s3_error_rate": args.s3_error_rate,
+        "thread_workers": args.thread_workers,
+        "max_in_flight": args.max_in_flight,
+        "per_host_limit": args.per_host_limit,
+        "upload_workers": args.upload_workers,
+        "scheduler": args.scheduler,
+        "scheduler_interval": args.scheduler_interval,
+        "scheduler_rps": args.scheduler_rps,
+        "metadata_cache": not args.no_metadata_cache,
+        "corpus": args.corpus,
+    }
+    results = []
+    # Каждый размер в отдельном процессе, чтобы пиковый RSS не накапливался между прогонами
+    context = multiprocessing.get_context("spawn")
+    for size in args.sizes:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            result = executor.submit(run_cycles, size, options).result()
+        results.append(result)
+        for report in result["cycles"]:
+            s3_stats = report["s3"]
+            print(f"{size:>7} подарков, цикл {report['cycle']}: {report['duration_seconds']:7.2f} с, "
+                  f"{report['gifts']['per_second']:8.1f} подарков/с, "
+                  f"p50 {report['gift_p50_seconds'] * 1000:7.1f} мс, p99 {report['gift_p99_seconds'] * 1000:7.1f} мс, "
+                  f"изменилось {report['gifts']['changed']}, ошибок {report['gifts']['error']}, "
+                  f"загружено {s3_stats['objects']} объектов ({s3_stats['bytes'] / 1024 / 1024:.1f} МБ, "
+                  f"{s3_stats['mb_per_second']:.1f} МБ/с)")
+        print(f"{size:>7} подарков: пиковый RSS {result['peak_rss_mb']:.1f} МБ")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    idle = [(result["size"], report["cycle"]) for result in results for report in result["cycles"]
+            if not report["gifts"]["total"]]
+    if idle:
+        print("ОШИБКА: циклы без обработанных подарков (размер, цикл): "
+              + ", ".join(f"{size}/{cycle}" for size, cycle in idle))
+        sys.exit(1)
+    if args.baseline and compare_with_baseline(results, args.baseline, args.tolerance):
+        sys.exit(1)
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Бенчмарки GiftExplorer на локальных заглушках")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    engines = subparsers.add_parser("engines", help="threads против async")
+    engines.add_argument("--gifts", type=int, default=500)
+    engines.add_argument("--latency", type=float, default=0.05, help="задержка ответа заглушки, с")
+    engines.add_argument("--thread-workers", type=int, default=5)
+    engines.add_argument("--max-in-flight", type=int, default=200)
+    engines.add_argument("--per-host-limit", type=int, default=100)
+    engines.set_defaults(func=bench_engines)
+
+    parser_bench = subparsers.add_parser("parser", help="сверка и скорость разбора страниц t.me")
+    parser_bench.add_argument("--corpus", default="corpus", help="каталог с сохранёнными страницами *.html")
+    parser_bench.add_argument("--fetch", help="сохранить страницы в корпус, например HomemadeCake:1-50")
+    parser_bench.add_argument("--size", type=int, default=200, help="размер синтетического корпуса")
+    parser_bench.add_argument("--repeat", type=int, default=5)
+    parser_bench.set_defaults(func=bench_parser)
+
+    render = subparsers.add_parser("render", help="скорость рендеринга страниц")
+    render.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    render.set_defaults(func=bench_render)
+
+    memory = subparsers.add_parser("memory", help="байты на подарок в all_data")
+    memory.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    memory.set_defaults(func=bench_memory)
+
+    cycles = subparsers.add_parser("cycles", help="полные циклы main() на заглушках источников и S3")
+    cycles.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 5000])
+    cycles.add_argument("--cycles", type=int, default=3)
+    cycles.add_argument("--engine", choices=["threads", "async"], default="async" if main.aiohttp else "threads")
+    cycles.add_argument("--latency", type=float, default=0.02, help="задержка ответа заглушек источников, с")
+    cycles.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 503 от источников")
+    cycles.add_argument("--churn", type=float, default=0.05, help="доля подарков, меняющих владельца за цикл")
+    cycles.add_argument("--s3-latency", type=float, default=0.005, help="задержка ответа заглушки S3, с")
+    cycles.add_argument("--s3-error-rate", type=float, default=0.0, help="доля ответов 503 от заглушки S3")
+    cycles.add_argument("--thread-workers", type=int, default=20)
+    cycles.add_argument("--max-in-flight", type=int, default=200)
+    cycles.add_argument("--per-host-limit", type=int, default=100)
+    cycles.add_argument("--upload-workers", type=int, default=16)
+    cycles.add_argument("--scheduler", action="store_true", help="включить адаптивный планировщик опроса")
+    cycles.add_argument("--scheduler-interval", type=float, default=1.0,
+                        help="min_interval планировщика и пауза между циклами, с")
+    cycles.add_argument("--scheduler-rps", type=float, default=1000.0,
+                        help="бюджет запросов в секунду планировщика")
+    cycles.add_argument("--no-metadata-cache", action="store_true",
+                        help="запрашивать fragment.com в каждом цикле, как без кэша метаданных")
+    cycles.add_argument("--corpus", help="каталог с записанными ответами *.json и *.html")
+    cycles.add_argument("--output", help="сохранить результаты в JSON")
+    cycles.add_argument("--baseline", help="JSON прошлого прогона для поиска регрессий")
+    cycles.add_argument("--tolerance", type=float, default=0.15, help="допустимое ухудшение относительно baseline")
+    cycles.set_defaults(func=bench_cycles)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,61 +1,1435 @@
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 from bs4 import BeautifulSoup
+from lxml import etree
 import json
 import time
 import os
+import base64
+import gzip
+import tempfile
+import zlib
+import heapq
+import random
+import string
+import sys
+import signal
+import socket
+import sqlite3
+import threading
+import asyncio
+from array import array
+import multiprocessing
+import weakref
+from collections.abc import Mapping
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+from email.utils import parsedate_to_datetime
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import boto3
 from botocore.client import Config
-from hashlib import md5
+from hashlib import md5, sha256
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# Адреса источников данных (переопределяются в benchmark.py для локальных заглушек)
+FRAGMENT_BASE_URL = "https://nft.fragment.com"
+TELEGRAM_BASE_URL = "https://t.me"
+DEFAULT_OWNER_AVATAR = "https://i.getgems.io/pa4IG9_bFDXTUAXXqwq1M2OBNrplmfVaecyHGHoY3Po/rs:fill:512:512:1/g:ce/czM6Ly9nZXRnZW1zLXMzL3VzZXItbWVkaWEvZ2Vtcy80Ni53ZWJw"
+
+# Атомарная запись JSON: при остановке процесса посреди записи остаётся прежняя версия файла
+def write_json_atomic(path, data, **dump_kwargs):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, **dump_kwargs)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
 
 # Инициализация клиента Yandex Object Storage
-def init_yandex_client(yandex_config):
+def init_yandex_client(yandex_config, max_pool_connections=10):
     yandex_client = boto3.client(
         's3',
         aws_access_key_id=yandex_config['id'],
         aws_secret_access_key=yandex_config['key'],
-        endpoint_url='https://storage.yandexcloud.net',  # Endpoint для Yandex Object Storage
-        config=Config(signature_version='s3v4'),
+        # Endpoint для Yandex Object Storage (переопределяется для локальной заглушки S3)
+        endpoint_url=yandex_config.get('endpoint_url', 'https://storage.yandexcloud.net'),
+        config=Config(signature_version='s3v4', max_pool_connections=max_pool_connections),
     )
     return yandex_client
 
-# Функция для загрузки файла в Yandex Object Storage
-def upload_to_yandex(yandex_client, bucket_name, file_path, object_key):
+# Параллельная загрузка в Yandex Object Storage из памяти
+# Метаданные публикуемых объектов: тип содержимого по расширению ключа и
+# Cache-Control по классу артефакта (переопределяется в config.json "upload": {"cache_control": {...}})
+CONTENT_TYPES = {
+    '.html': 'text/html; charset=utf-8',
+    '.json': 'application/json; charset=utf-8',
+    '.css': 'text/css; charset=utf-8',
+    '.js': 'application/javascript; charset=utf-8',
+    '.ndjson': 'application/x-ndjson; charset=utf-8',
+    '.parquet': 'application/vnd.apache.parquet',
+    '.arrow': 'application/vnd.apache.arrow.file',
+    '.webp': 'image/webp',
+    '.png': 'image/png',
+    '.jpg': 'image/jpeg',
+    '.gif': 'image/gif',
+}
+# Форматы со своим сжатием внутри: повторно не сжимаются
+PRECOMPRESSED_EXTENSIONS = {'.parquet', '.arrow', '.webp', '.png', '.jpg', '.gif'}
+
+DEFAULT_CACHE_CONTROL = {
+    'static': 'public, max-age=31536000, immutable',         # версия в имени файла
+    'manifest_page': 'public, max-age=31536000, immutable',  # хеш содержимого в имени файла
+    'manifest_meta': 'no-cache',
+    'index': 'public, max-age=60',
+    'gift_page': 'public, max-age=300',
+    'gift_json': 'public, max-age=300',
+    'rarity': 'public, max-age=60',
+    'search': 'public, max-age=60',
+    'export': 'public, max-age=31536000, immutable',         # версия в имени файла
+    'export_meta': 'no-cache',
+    'asset': 'public, max-age=31536000, immutable',          # ключ — хеш содержимого
+    'changelog': 'public, max-age=31536000, immutable',      # закрытые сегменты не меняются
+    'changelog_head': 'no-cache',
+}
+
+def get_artifact_class(object_key):
+    """Определяет класс артефакта по ключу объекта в бакете."""
+    if object_key.startswith('static/'):
+        return 'static'
+    if object_key.startswith('manifest/'):
+        return 'manifest_meta' if object_key.endswith('/meta.json') else 'manifest_page'
+    if object_key.startswith('json/'):
+        return 'gift_json'
+    if object_key.startswith('gifts/'):
+        return 'gift_page'
+    if object_key.startswith('rarity/'):
+        return 'rarity'
+    if object_key.startswith('search/'):
+        return 'search'
+    if object_key.startswith('export/'):
+        return 'export_meta' if object_key.endswith('/latest.json') else 'export'
+    if object_key.startswith('assets/'):
+        return 'asset'
+    if object_key.startswith('changelog/'):
+        return 'changelog_head' if object_key.endswith(('/cursor.json', '/current.ndjson')) else 'changelog'
+    if '/' not in object_key and object_key.endswith('.html'):
+        return 'index'
+    return None
+
+def compress_body(body, encoding, level):
+    """Детерминированно сжимает body: одинаковый вход даёт одинаковый MD5."""
+    if encoding == 'br':
+        return brotli.compress(body, quality=level)
+    return gzip.compress(body, compresslevel=level, mtime=0)
+
+class YandexUploader:
+    """Загружает байты в бакет пулом потоков через один boto3-клиент.
+
+    Текстовые артефакты (HTML, JSON, NDJSON, CSS, JS) сжимаются один раз перед
+    загрузкой и получают ContentType, ContentEncoding и Cache-Control.
+    Объекты, MD5 которых вместе с метаданными совпадает с сохранённым ETag,
+    не загружаются повторно. Неудачные загрузки повторяются с экспоненциальной
+    задержкой, а после исчерпания попыток откладываются до следующего flush().
+    Загрузки одного ключа выполняются по очереди, и у каждой есть номер поколения:
+    устаревшее тело (например, повтор неудачной загрузки прошлого цикла) не
+    загружается и не перезаписывает ETag, если для ключа уже поставлено более новое.
+    """
+
+    def __init__(self, yandex_client, bucket_name, workers=16, max_retries=5,
+                 backoff_seconds=0.5, etag_cache_file=None, compression='gzip',
+                 compression_level=9, min_compress_size=256, cache_control=None):
+        self.client = yandex_client
+        self.bucket_name = bucket_name
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.etag_cache_file = etag_cache_file
+        if compression == 'br' and brotli is None:
+            print("Модуль brotli не установлен, используется gzip")
+            compression = 'gzip'
+        self.compression = compression if compression in ('gzip', 'br') else None
+        self.compression_level = compression_level
+        self.min_compress_size = min_compress_size
+        self.cache_control = dict(DEFAULT_CACHE_CONTROL)
+        self.cache_control.update(cache_control or {})
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self._lock = threading.Lock()
+        self.pending = []
+        self.failed = {}
+        self.etags = {}
+        # Последнее поколение ещё не завершённых загрузок ключа и блокировки ключей (по хешу)
+        self.latest = {}
+        self.generation = 0
+        self._key_locks = [threading.Lock() for _ in range(256)]
+        if etag_cache_file and os.path.exists(etag_cache_file):
+            with open(etag_cache_file, "r", encoding="utf-8") as f:
+                self.etags = json.load(f)
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self.uploaded = 0
+        self.skipped = 0
+        self.retried = 0
+        self.uploaded_bytes = 0
+        self.raw_bytes = 0
+
+    def _encode(self, object_key, body, put_kwargs):
+        """Сжимает текстовый артефакт и дополняет параметры put_object метаданными."""
+        put_kwargs = dict(put_kwargs)
+        extension = os.path.splitext(object_key)[1]
+        content_type = CONTENT_TYPES.get(extension)
+        if content_type is None:
+            return body, put_kwargs
+        put_kwargs.setdefault('ContentType', content_type)
+        cache_control = self.cache_control.get(get_artifact_class(object_key))
+        if cache_control:
+            put_kwargs.setdefault('CacheControl', cache_control)
+        if (self.compression and 'ContentEncoding' not in put_kwargs
+                and extension not in PRECOMPRESSED_EXTENSIONS and len(body) >= self.min_compress_size):
+            encoded = compress_body(body, self.compression, self.compression_level)
+            if len(encoded) < len(body):
+                put_kwargs['ContentEncoding'] = self.compression
+                body = encoded
+        return body, put_kwargs
+
+    def submit(self, object_key, body, **put_kwargs):
+        """Ставит объект в очередь загрузки. body — bytes или str."""
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        source = (body, put_kwargs)
+        body, put_kwargs = self._encode(object_key, body, put_kwargs)
+        digest = md5(body)
+        # Смена метаданных (например, политики кэширования) тоже требует перезаливки
+        etag = digest.hexdigest()
+        if put_kwargs:
+            etag += ';' + md5(repr(sorted(put_kwargs.items())).encode('utf-8')).hexdigest()[:8]
+        with self._lock:
+            if (self.etags.get(object_key) == etag and object_key not in self.failed
+                    and object_key not in self.latest):
+                self.skipped += 1
+                return
+            # Новое тело заменяет отложенное неудачное
+            self.failed.pop(object_key, None)
+            self.generation += 1
+            generation = self.latest[object_key] = self.generation
+        content_md5 = base64.b64encode(digest.digest()).decode('ascii')
+        future = self.executor.submit(self._put, object_key, body, etag, content_md5, put_kwargs, source, generation)
+        self.pending.append(future)
+
+    def _put(self, object_key, body, etag, content_md5, put_kwargs, source, generation):
+        metrics = get_metrics()
+        artifact = get_artifact_class(object_key) or 'other'
+        with self._key_locks[hash(object_key) % len(self._key_locks)]:
+            for attempt in range(self.max_retries + 1):
+                with self._lock:
+                    if self.latest.get(object_key) != generation:
+                        # Для ключа уже поставлено более новое тело
+                        return False
+                try:
+                    with metrics.timer('upload', artifact=artifact):
+                        self.client.put_object(Bucket=self.bucket_name, Key=object_key, Body=body,
+                                               ContentMD5=content_md5, **put_kwargs)
+                    metrics.inc('upload_bytes_total', len(body), artifact=artifact)
+                    with self._lock:
+                        if self.latest.get(object_key) == generation:
+                            del self.latest[object_key]
+                            self.etags[object_key] = etag
+                        self.uploaded += 1
+                        self.uploaded_bytes += len(body)
+                        self.raw_bytes += len(source[0])
+                    return True
+                except Exception as e:
+                    if attempt == self.max_retries:
+                        metrics.inc('errors_total', category='upload')
+                        print(f"Ошибка загрузки файла {object_key} после {attempt + 1} попыток: {e}")
+                        with self._lock:
+                            if self.latest.get(object_key) == generation:
+                                del self.latest[object_key]
+                                self.failed[object_key] = source
+                        return False
+                    with self._lock:
+                        self.retried += 1
+                    time.sleep(self.backoff_seconds * (2 ** attempt) + random.uniform(0, self.backoff_seconds))
+
+    def delete(self, object_key):
+        """Ставит в очередь удаление объекта; незавершённая загрузка этого ключа отменяется."""
+        with self._lock:
+            self.etags.pop(object_key, None)
+            self.failed.pop(object_key, None)
+            self.latest.pop(object_key, None)
+        self.pending.append(self.executor.submit(self._delete, object_key))
+
+    def _delete(self, object_key):
+        with self._key_locks[hash(object_key) % len(self._key_locks)]:
+            try:
+                self.client.delete_object(Bucket=self.bucket_name, Key=object_key)
+                return True
+            except Exception as e:
+                get_metrics().inc('errors_total', category='upload')
+                print(f"Ошибка удаления файла {object_key}: {e}")
+                return False
+
+    def retry_failed(self):
+        """Повторно ставит в очередь объекты, не загруженные в прошлых циклах."""
+        with self._lock:
+            failed = list(self.failed.items())
+        for object_key, (body, put_kwargs) in failed:
+            self.submit(object_key, body, **put_kwargs)
+
+    def flush(self):
+        """Дожидается всех загрузок, сохраняет кэш ETag и печатает итоги."""
+        pending, self.pending = self.pending, []
+        for future in pending:
+            future.result()
+        if self.etag_cache_file:
+            with self._lock:
+                write_json_atomic(self.etag_cache_file, self.etags)
+        print(f"Загрузка в {self.bucket_name}: загружено {self.uploaded} "
+              f"({self.uploaded_bytes / 1024:.1f} КБ), пропущено без изменений {self.skipped}, "
+              f"повторов {self.retried}, ожидают повтора {len(self.failed)}")
+        if self.raw_bytes:
+            saved = self.raw_bytes - self.uploaded_bytes
+            print(f"Сжатие ({self.compression or 'выключено'}): {self.raw_bytes / 1024:.1f} КБ → "
+                  f"{self.uploaded_bytes / 1024:.1f} КБ, сэкономлено {saved / 1024:.1f} КБ "
+                  f"({saved * 100 / self.raw_bytes:.0f}%)")
+        self._reset_stats()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+# Инициализация загрузчика по config.json ("upload": {...})
+def init_uploader(yandex_config, config):
+    upload_config = config.get('upload', {})
+    workers = upload_config.get('workers', 16)
+    yandex_client = init_yandex_client(yandex_config, max_pool_connections=workers)
+    return YandexUploader(
+        yandex_client,
+        yandex_config['bucket_name'],
+        workers=workers,
+        max_retries=upload_config.get('max_retries', 5),
+        backoff_seconds=upload_config.get('backoff_seconds', 0.5),
+        etag_cache_file=upload_config.get('etag_cache_file', 'upload_etags.json'),
+        compression=upload_config.get('compression', 'gzip'),
+        compression_level=upload_config.get('compression_level', 9),
+        min_compress_size=upload_config.get('min_compress_size', 256),
+        cache_control=upload_config.get('cache_control'),
+    )
+
+# Отпечатки подарков для обнаружения изменений: поля разбиты на группы, чтобы
+# смена владельца или пересчёт процентов не выглядели как изменение самого подарка
+OWNER_FIELDS = ('Owner', 'Owner_avatar')
+FINGERPRINT_FIELDS = ('meta', 'owner', 'percent')
+# Алгоритм записывается в сохранённый отпечаток: при его смене отпечатки пересчитываются по данным
+FINGERPRINT_ALGORITHM = 'xxh3' if xxhash is not None else 'crc32'
+
+def fast_hash(text):
+    """Быстрый некриптографический хеш строки."""
+    data = text.encode('utf-8')
+    if xxhash is not None:
+        return xxhash.xxh3_64_intdigest(data)
+    return zlib.crc32(data)
+
+def gift_fingerprint(data):
+    """Отпечаток подарка по группам FINGERPRINT_FIELDS.
+
+    meta — неизменяемые данные (название, изображения, значения атрибутов, история),
+    owner — владелец и аватар, percent — проценты редкости атрибутов.
+    """
+    # Значения склеиваются через управляющие символы в порядке записи (его задаёт
+    # build_gift_data): без сортировки ключей и json.dumps это примерно вдвое быстрее
+    attributes = data.get('attributes', [])
+    meta = [f"{field}\x1e{value}" for field, value in data.items()
+            if field != 'attributes' and field not in OWNER_FIELDS]
+    meta.extend(f"{attr.get('trait_type')}\x1e{attr.get('value')}" for attr in attributes)
+    return (
+        fast_hash('\x1f'.join(meta)),
+        fast_hash('\x1f'.join([str(data.get(field)) for field in OWNER_FIELDS])),
+        fast_hash('\x1f'.join([str(attr.get('percent')) for attr in attributes])),
+    )
+
+def encode_fingerprint(fingerprint):
+    """Строка для хранилища: "алгоритм:meta,owner,percent" в hex."""
+    return FINGERPRINT_ALGORITHM + ':' + ','.join(format(value, 'x') for value in fingerprint)
+
+def split_legacy_hashes(gifts):
+    """Отделяет служебные ключи "{key}_hash" прежнего формата: (подарки, {key: hash})."""
+    data = {}
+    hashes = {}
+    for key, value in gifts.items():
+        if key.endswith('_hash'):
+            hashes[key[:-len('_hash')]] = value
+        elif key != 'hash':
+            data[key] = value
+    return data, hashes
+
+class FingerprintIndex:
+    """Отпечатки подарков отдельно от all_data: {collection: {gift_id: (meta, owner, percent)}}.
+
+    В хранилище отпечаток записывается строкой encode_fingerprint; прежние MD5 и отпечатки другого алгоритма считаются отсутствующими — тогда
+    старый отпечаток вычисляется по сохранённым данным подарка.
+    changed_fields — группы полей, изменившиеся у подарков в текущем цикле.
+    """
+
+    def __init__(self):
+        self.collections = {}
+        self.changed_fields = {}
+
+    def load(self, collection_key, gift_id, encoded):
+        algorithm, _, values = (encoded or '').partition(':')
+        if algorithm != FINGERPRINT_ALGORITHM:
+            return
+        try:
+            fingerprint = tuple(int(value, 16) for value in values.split(','))
+        except ValueError:
+            return
+        if len(fingerprint) == len(FINGERPRINT_FIELDS):
+            self.collections.setdefault(collection_key, {})[gift_id] = fingerprint
+
+    def encode(self, collection_key, gift_id, data=None):
+        fingerprint = self.collections.get(collection_key, {}).get(gift_id)
+        if fingerprint is None:
+            if data is None:
+                return ''
+            fingerprint = gift_fingerprint(data)
+        return encode_fingerprint(fingerprint)
+
+    def diff(self, collection_key, key, data, old_data=None):
+        """Обновляет отпечаток подарка и возвращает множество изменившихся групп полей."""
+        gift_id = get_gift_number(key)
+        fingerprints = self.collections.setdefault(collection_key, {})
+        old = fingerprints.get(gift_id)
+        if old is None and old_data and "error" not in old_data:
+            old = gift_fingerprint(old_data)
+        new = gift_fingerprint(data)
+        fingerprints[gift_id] = new
+        if old is None:
+            return set(FINGERPRINT_FIELDS)
+        return {field for field, before, after in zip(FINGERPRINT_FIELDS, old, new) if before != after}
+
+    def record_changes(self, collection_key, key, fields):
+        self.changed_fields.setdefault(collection_key, {})[key] = frozenset(fields)
+
+    def keys_with(self, collection_key, field, keys):
+        """Ключи из keys, у которых в текущем цикле изменилась группа field."""
+        changed = self.changed_fields.get(collection_key, {})
+        return {key for key in keys if field in changed.get(key, ())}
+
+    def begin_cycle(self):
+        self.changed_fields.clear()
+
+# Функция для вычисления средней редкости подарка
+def get_average_rarity(data, rarity=None):
+    # percent 0.0 означает, что t.me не отдал процент: без него такой подарок
+    # выглядел бы самым редким, поэтому берём локальную частоту или пропускаем атрибут
+    total_percent = 0
+    count = 0
+    for attr in data.get('attributes', []):
+        percent = attr.get('percent', 0.0)
+        if not percent:
+            if rarity is None:
+                continue
+            percent = rarity.frequency(attr.get('trait_type', ''), attr.get('value', ''))
+        total_percent += percent
+        count += 1
+    return total_percent / count if count > 0 else 0
+
+# Функция для получения полей, видимых в карточке на главной странице
+def get_card_fields(data):
+    if not data:
+        return None
+    return (
+        data.get('name', 'Подарок'),
+        data.get('image', ''),
+        data.get('gift_page', '#'),
+        get_average_rarity(data),
+    )
+
+# Функция для перебора подарков коллекции (only_keys — только эти ключи)
+def iter_gift_items(gift_data, only_keys=None):
+    keys = gift_data.keys() if only_keys is None else [k for k in only_keys if k in gift_data]
+    for key in keys:
+        yield key, gift_data[key]
+
+# Метрики: счётчики и гистограммы задержек по этапам и хостам
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+METRICS_PREFIX = 'giftexplorer_'
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def _format_labels(label_key, extra=()):
+    pairs = list(label_key) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+def http_error_category(status):
+    """Категория ошибки по HTTP-статусу или None для успешного ответа.
+
+    404 не считается ошибкой: так fragment.com сообщает об отсутствующем id
+    (учитывается в gifts_total с result="not_found").
+    """
+    if status is None or status < 400 or status == 404:
+        return None
+    if status == 429:
+        return 'http_429'
+    return 'http_5xx' if status >= 500 else 'http_4xx'
+
+class Metrics:
+    """Счётчики, гистограммы и показатели цикла для Prometheus и JSON-сводки.
+
+    Значения накапливаются за всё время работы, как принято в Prometheus;
+    сводка цикла считается как разница со снимком, сделанным в begin_cycle().
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self.counters = {}    # (имя, метки) -> значение
+        self.histograms = {}  # (имя, метки) -> [счётчики корзин, сумма, количество]
+        self.gauges = {}
+        self.cycles = 0
+        self._cycle_started = None
+        self._snapshot = ({}, {})
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            histogram[0][bisect_left(self.buckets, seconds)] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def set_gauge(self, name, value, **labels):
+        with self._lock:
+            self.gauges[(name, _label_key(labels))] = value
+
+    @contextmanager
+    def timer(self, stage, **labels):
+        """Замеряет длительность блока в гистограмме stage_seconds."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('stage_seconds', time.perf_counter() - started, stage=stage, **labels)
+
+    def record_fetch(self, host, seconds, status=None, error=None):
+        """Учитывает одну попытку HTTP-запроса: задержку, статус и категорию ошибки."""
+        self.observe('stage_seconds', seconds, stage='fetch', host=host)
+        self.inc('http_requests_total', host=host, status=str(status) if status else error)
+        category = error or http_error_category(status)
+        if category:
+            self.inc('errors_total', category=category, host=host)
+
+    def percentile(self, counts, total, q):
+        """Оценка перцентиля по верхним границам корзин гистограммы."""
+        if not total:
+            return 0.0
+        rank = q * total
+        seen = 0
+        for bound, count in zip(self.buckets, counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.buckets[-1]
+
+    def begin_cycle(self):
+        with self._lock:
+            self._cycle_started = time.time()
+            self._snapshot = (
+                dict(self.counters),
+                {key: (list(h[0]), h[1], h[2]) for key, h in self.histograms.items()},
+            )
+
+    def _cycle_delta(self):
+        counters, histograms = self._snapshot
+        with self._lock:
+            counter_delta = {key: value - counters.get(key, 0) for key, value in self.counters.items()}
+            histogram_delta = {}
+            for key, (buckets, total_seconds, count) in self.histograms.items():
+                old_buckets, old_seconds, old_count = histograms.get(key, ([0] * len(buckets), 0.0, 0))
+                if count != old_count:
+                    histogram_delta[key] = ([b - o for b, o in zip(buckets, old_buckets)],
+                                            total_seconds - old_seconds, count - old_count)
+        return counter_delta, histogram_delta
+
+    def end_cycle(self, interval_seconds, summary_file=None):
+        """Обновляет показатели цикла, пишет JSON-сводку и возвращает её."""
+        duration = time.time() - (self._cycle_started or time.time())
+        counter_delta, histogram_delta = self._cycle_delta()
+        self.cycles += 1
+
+        def grouped(name):
+            return {','.join(f'{k}={v}' for k, v in labels) or 'total': value
+                    for (metric, labels), value in sorted(counter_delta.items())
+                    if metric == name and value}
+
+        results = grouped('gifts_total')
+        gifts = sum(results.values())
+        changed = results.get('result=changed', 0)
+        processed = changed + results.get('result=unchanged', 0)
+        gifts_per_second = gifts / duration if duration else 0.0
+        changed_ratio = changed / processed if processed else 0.0
+        self.set_gauge('cycle_duration_seconds', duration)
+        self.set_gauge('interval_seconds', interval_seconds)
+        self.set_gauge('gifts_per_second', gifts_per_second)
+        self.set_gauge('changed_ratio', changed_ratio)
+
+        stages = {}
+        for (metric, labels), (buckets, total_seconds, count) in sorted(histogram_delta.items()):
+            stages[','.join(f'{k}={v}' for k, v in labels)] = {
+                'count': count,
+                'total_seconds': round(total_seconds, 4),
+                'mean_seconds': round(total_seconds / count, 4),
+                'p50_seconds': self.percentile(buckets, count, 0.5),
+                'p99_seconds': self.percentile(buckets, count, 0.99),
+            }
+        summary = {
+            'cycle': self.cycles,
+            'finished_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'duration_seconds': round(duration, 3),
+            'interval_seconds': interval_seconds,
+            'interval_utilization': round(duration / interval_seconds, 3) if interval_seconds else None,
+            'gifts': {
+                'total': gifts,
+                'changed': changed,
+                'unchanged': results.get('result=unchanged', 0),
+                'error': results.get('result=error', 0),
+                'per_second': round(gifts_per_second, 2),
+                'changed_ratio': round(changed_ratio, 4),
+            },
+            'errors': grouped('errors_total'),
+            'http_requests': grouped('http_requests_total'),
+            'upload_bytes': grouped('upload_bytes_total'),
+            'stages': stages,
+        }
+        if summary_file:
+            write_json_atomic(summary_file, summary, ensure_ascii=False, indent=2)
+        print(f"Цикл {self.cycles}: {duration:.1f} с при интервале {interval_seconds} с, "
+              f"подарков {gifts} ({gifts_per_second:.1f}/с), изменилось {changed_ratio * 100:.1f}%, "
+              f"ошибок {sum(summary['errors'].values())}")
+        if interval_seconds and duration > interval_seconds:
+            print(f"Цикл длился дольше интервала опроса на {duration - interval_seconds:.1f} с")
+        return summary
+
+    def render_prometheus(self):
+        """Текст в формате Prometheus exposition 0.0.4."""
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (list(h[0]), h[1], h[2])) for key, h in self.histograms.items())
+            gauges = sorted(self.gauges.items())
+        lines = []
+        declared = set()
+
+        def declare(name, kind):
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# TYPE {METRICS_PREFIX}{name} {kind}")
+
+        for (name, labels), value in counters:
+            declare(name, 'counter')
+            lines.append(f"{METRICS_PREFIX}{name}{_format_labels(labels)} {value}")
+        for (name, labels), value in gauges:
+            declare(name, 'gauge')
+            lines.append(f"{METRICS_PREFIX}{name}{_format_labels(labels)} {value}")
+        for (name, labels), (buckets, total_seconds, count) in histograms:
+            declare(name, 'histogram')
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, buckets):
+                cumulative += bucket
+                lines.append(f"{METRICS_PREFIX}{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{METRICS_PREFIX}{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{METRICS_PREFIX}{name}_sum{_format_labels(labels)} {total_seconds}")
+            lines.append(f"{METRICS_PREFIX}{name}_count{_format_labels(labels)} {count}")
+        return '\n'.join(lines) + '\n'
+
+def start_metrics_server(metrics_registry, host='127.0.0.1', port=9108):
+    """Отдаёт /metrics в формате Prometheus из фонового потока."""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?', 1)[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics_registry.render_prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Метрики Prometheus доступны на http://{host}:{server.server_port}/metrics")
+    return server
+
+metrics = Metrics()
+metrics_summary_file = None
+
+# Инициализация метрик по config.json ("metrics": {...})
+def init_metrics(config):
+    global metrics, metrics_summary_file
+    metrics_config = config.get('metrics', {})
+    metrics = Metrics()
+    metrics_summary_file = metrics_config.get('summary_file', 'metrics_summary.json')
+    if metrics_config.get('enabled', True) and metrics_config.get('port'):
+        try:
+            start_metrics_server(metrics, metrics_config.get('host', '127.0.0.1'), metrics_config['port'])
+        except OSError as e:
+            print(f"Не удалось запустить сервер метрик: {e}")
+    return metrics
+
+def get_metrics():
+    return metrics
+
+# Общий HTTP-клиент с пулами соединений
+# urllib3 распаковывает br только при наличии brotli
+ACCEPT_ENCODING = 'gzip, deflate, br' if brotli else 'gzip, deflate'
+
+HTTP_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
+                  'AppleWebKit/537.36 (KHTML, like Gecko) '
+                  'Chrome/115.0.0.0 Safari/537.36',
+    'Accept-Encoding': ACCEPT_ENCODING,
+}
+
+class PoolStats:
+    """Потокобезопасные счётчики использования соединений по хостам."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = {}
+        self.new_connections = {}
+
+    def record_checkout(self, host):
+        with self._lock:
+            self.checkouts[host] = self.checkouts.get(host, 0) + 1
+
+    def record_new_connection(self, host):
+        with self._lock:
+            self.new_connections[host] = self.new_connections.get(host, 0) + 1
+
+    def snapshot(self):
+        """Возвращает статистику по хостам: запросы, попадания в пул, новые соединения."""
+        with self._lock:
+            result = {}
+            for host, checkouts in self.checkouts.items():
+                new = self.new_connections.get(host, 0)
+                result[host] = {
+                    'requests': checkouts,
+                    'pool_hits': max(checkouts - new, 0),
+                    'new_connections': new,
+                }
+            return result
+
+    def reset(self):
+        with self._lock:
+            self.checkouts.clear()
+            self.new_connections.clear()
+
+def _counting_pool_class(base_class, stats):
+    class CountingConnectionPool(base_class):
+        def _get_conn(self, timeout=None):
+            stats.record_checkout(self.host)
+            return super()._get_conn(timeout)
+
+        def _new_conn(self):
+            stats.record_new_connection(self.host)
+            return super()._new_conn()
+    return CountingConnectionPool
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter, считающий выдачи соединений из пула и новые подключения."""
+
+    def __init__(self, stats, **kwargs):
+        self.stats = stats
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _counting_pool_class(HTTPConnectionPool, self.stats),
+            'https': _counting_pool_class(HTTPSConnectionPool, self.stats),
+        }
+
+# Ограничение частоты запросов по хостам: token bucket, Retry-After, backoff и circuit breaker
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Хост временно отключён после серии ошибок."""
+
+def parse_retry_after(value):
+    """Возвращает задержку из заголовка Retry-After в секундах или None."""
+    if not value:
+        return None
     try:
-        yandex_client.upload_file(file_path, bucket_name, object_key)
-        print(f"Файл загружен: {object_key}")
-    except Exception as e:
-        print(f"Ошибка загрузки файла {object_key}: {e}")
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class HostGovernor:
+    """Состояние одного хоста: корзина токенов, пауза и счётчик подряд идущих ошибок."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.time()
+        self.paused_until = 0.0
+        self.consecutive_failures = 0
+        self.cooldown = 0.0
+        self.stats = {'requests': 0, 'throttled_seconds': 0.0, 'retries': 0, 'rate_limited': 0, 'circuit_opened': 0}
+
+class RequestGovernor:
+    """Общий для всех путей загрузки регулятор запросов к хостам.
+
+    reserve() возвращает, сколько ждать перед запросом (синхронный клиент
+    спит, асинхронный делает await asyncio.sleep), on_failure() — задержку
+    перед повтором или None, если повторять не нужно.
+    """
+
+    def __init__(self, rate=10.0, burst=20, hosts=None, max_retries=3, backoff_base=0.5,
+                 backoff_max=30.0, max_retry_after=120.0, failure_threshold=5, cooldown=30.0,
+                 max_cooldown=600.0):
+        self.rate = rate
+        self.burst = burst
+        self.host_limits = hosts or {}
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_retry_after = max_retry_after
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self._lock = threading.Lock()
+        self.hosts = {}
+
+    def _host(self, host):
+        state = self.hosts.get(host)
+        if state is None:
+            limits = self.host_limits.get(host, {})
+            state = self.hosts[host] = HostGovernor(limits.get('rate', self.rate), limits.get('burst', self.burst))
+        return state
+
+    def reserve(self, host):
+        """Резервирует токен для запроса к хосту и возвращает задержку перед ним."""
+        with self._lock:
+            state = self._host(host)
+            now = time.time()
+            if state.consecutive_failures >= self.failure_threshold and now < state.paused_until:
+                get_metrics().inc('errors_total', category='circuit_open', host=host)
+                raise CircuitOpenError(f"Хост {host} приостановлен ещё на {state.paused_until - now:.0f} с")
+            state.tokens = min(state.burst, state.tokens + (now - state.updated) * state.rate)
+            state.updated = now
+            state.tokens -= 1
+            delay = max(0.0, -state.tokens / state.rate, state.paused_until - now)
+            state.stats['requests'] += 1
+            state.stats['throttled_seconds'] += delay
+            return delay
+
+    def on_success(self, host):
+        with self._lock:
+            state = self._host(host)
+            state.consecutive_failures = 0
+            state.cooldown = 0.0
+
+    def on_failure(self, host, attempt, status=None, retry_after=None):
+        """Учитывает ошибку запроса и возвращает задержку перед повтором или None."""
+        with self._lock:
+            state = self._host(host)
+            now = time.time()
+            state.consecutive_failures += 1
+            if status == 429:
+                state.stats['rate_limited'] += 1
+            if retry_after is not None:
+                # Retry-After приостанавливает весь хост, а не только этот запрос
+                state.paused_until = max(state.paused_until, now + min(retry_after, self.max_retry_after))
+            if state.consecutive_failures >= self.failure_threshold:
+                state.cooldown = min(self.max_cooldown, state.cooldown * 2 if state.cooldown else self.base_cooldown)
+                state.paused_until = max(state.paused_until, now + state.cooldown)
+                state.stats['circuit_opened'] += 1
+                print(f"Хост {host} приостановлен на {state.cooldown:.0f} с после {state.consecutive_failures} ошибок подряд")
+                return None
+            if attempt >= self.max_retries:
+                return None
+            if retry_after is not None and retry_after > self.max_retry_after:
+                return None
+            state.stats['retries'] += 1
+            # Экспоненциальная задержка с полным джиттером
+            backoff = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+            return max(backoff, state.paused_until - now)
+
+    def report(self):
+        """Печатает статистику по хостам и сбрасывает счётчики."""
+        with self._lock:
+            for host, state in sorted(self.hosts.items()):
+                st = state.stats
+                print(f"Регулятор {host}: запросов {st['requests']}, ожидание {st['throttled_seconds']:.1f} с, "
+                      f"повторов {st['retries']}, 429 — {st['rate_limited']}, "
+                      f"отключений хоста {st['circuit_opened']}")
+                state.stats = {k: 0 if isinstance(v, int) else 0.0 for k, v in st.items()}
+
+request_governor = None
+
+# Инициализация регулятора запросов по config.json ("governor": {...})
+def init_request_governor(config):
+    global request_governor
+    governor_config = config.get('governor', {})
+    request_governor = RequestGovernor(
+        rate=governor_config.get('rate', 10.0),
+        burst=governor_config.get('burst', 20),
+        hosts=governor_config.get('hosts', {}),
+        max_retries=governor_config.get('max_retries', 3),
+        backoff_base=governor_config.get('backoff_base', 0.5),
+        backoff_max=governor_config.get('backoff_max', 30.0),
+        max_retry_after=governor_config.get('max_retry_after', 120.0),
+        failure_threshold=governor_config.get('failure_threshold', 5),
+        cooldown=governor_config.get('cooldown', 30.0),
+    )
+    return request_governor
+
+def get_request_governor():
+    global request_governor
+    if request_governor is None:
+        request_governor = RequestGovernor()
+    return request_governor
+
+class HttpClient:
+    """Общая keep-alive сессия для запросов к fragment.com и t.me."""
+
+    def __init__(self, pool_size=10, connect_timeout=5, read_timeout=10, num_hosts=4):
+        self.timeout = (connect_timeout, read_timeout)
+        self.stats = PoolStats()
+        self.session = requests.Session()
+        self.session.headers.update(HTTP_HEADERS)
+        self.session.headers['Connection'] = 'keep-alive'
+        adapter = PooledHTTPAdapter(
+            self.stats,
+            pool_connections=num_hosts,
+            pool_maxsize=pool_size,
+            pool_block=False,
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, url, **kwargs):
+        """GET через регулятор запросов: с ожиданием токена и повторами временных ошибок."""
+        kwargs.setdefault('timeout', self.timeout)
+        governor = get_request_governor()
+        metrics = get_metrics()
+        host = urlsplit(url).hostname
+        attempt = 0
+        while True:
+            time.sleep(governor.reserve(host))
+            started = time.perf_counter()
+            try:
+                response = self.session.get(url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                metrics.record_fetch(host, time.perf_counter() - started,
+                                     error='timeout' if isinstance(e, requests.exceptions.Timeout) else 'connection')
+                delay = governor.on_failure(host, attempt)
+                if delay is None:
+                    raise
+            else:
+                metrics.record_fetch(host, time.perf_counter() - started, response.status_code)
+                if response.status_code not in RETRYABLE_STATUSES:
+                    governor.on_success(host)
+                    return response
+                delay = governor.on_failure(host, attempt, response.status_code,
+                                            parse_retry_after(response.headers.get('Retry-After')))
+                if delay is None:
+                    return response
+                response.close()
+            time.sleep(delay)
+            attempt += 1
+
+    def report(self):
+        """Печатает статистику переиспользования соединений и сбрасывает счётчики."""
+        for host, s in sorted(self.stats.snapshot().items()):
+            reuse = s['pool_hits'] / s['requests'] * 100 if s['requests'] else 0
+            print(f"HTTP {host}: запросов {s['requests']}, из пула {s['pool_hits']}, "
+                  f"новых соединений {s['new_connections']} (переиспользование {reuse:.1f}%)")
+        self.stats.reset()
+
+http_client = None
+
+# Инициализация общего HTTP-клиента
+def init_http_client(config):
+    global http_client
+    http_config = config.get('http', {})
+    http_client = HttpClient(
+        pool_size=http_config.get('pool_size', config.get('thread_workers', 20)),
+        connect_timeout=http_config.get('connect_timeout', 5),
+        read_timeout=http_config.get('read_timeout', 10),
+    )
+    return http_client
+
+def get_http_client():
+    global http_client
+    if http_client is None:
+        http_client = HttpClient()
+    return http_client
+
+# Кэш валидаторов для условных GET-запросов (ETag / Last-Modified)
+NOT_MODIFIED = object()
+
+class ValidatorCache:
+    """Хранит ETag, Last-Modified и хеш тела ответа по URL.
+
+    Валидаторы сохраняются на диск. Разобранные ответы не хранятся: данные
+    неизменного источника восстанавливаются из сохранённой записи подарка
+    (bind), а без неё источник перезапрашивается целиком.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self.entries = {}
+        self.gifts = {}
+        self.not_modified = 0
+        self.body_hash_hits = 0
+        self.misses = 0
+        if path and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+
+    def request_headers(self, url):
+        entry = self.entries.get(url)
+        headers = {}
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def on_response(self, url, status_code, headers, body):
+        """Запоминает валидаторы ответа. Возвращает True, если содержимое не изменилось."""
+        with self._lock:
+            entry = self.entries.get(url)
+            if status_code == 304 and entry:
+                self.not_modified += 1
+                return True
+            body_hash = md5(body).hexdigest()
+            unchanged = bool(entry) and entry.get('body_hash') == body_hash
+            self.entries[url] = {
+                'etag': headers.get('ETag'),
+                'last_modified': headers.get('Last-Modified'),
+                'body_hash': body_hash,
+            }
+            if unchanged:
+                self.body_hash_hits += 1
+            else:
+                self.misses += 1
+            return unchanged
+
+    def bind(self, all_data):
+        """Источник сохранённых записей подарков (all_data или пачка шарда)."""
+        self.gifts = all_data
+
+    def stored_gift(self, collection_key, gift_id):
+        return self.gifts.get(collection_key, {}).get(f"{collection_key}_{gift_id}")
+
+    def invalidate(self, url):
+        with self._lock:
+            self.entries.pop(url, None)
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            write_json_atomic(self.path, self.entries)
+
+    def report(self):
+        """Печатает долю попаданий за цикл и сбрасывает счётчики."""
+        with self._lock:
+            hits = self.not_modified + self.body_hash_hits
+            total = hits + self.misses
+            ratio = hits / total * 100 if total else 0
+            print(f"Кэш валидаторов: 304 — {self.not_modified}, совпадение тела — {self.body_hash_hits}, "
+                  f"промахов — {self.misses} (попаданий {ratio:.1f}%, промахов {100 - ratio if total else 0:.1f}%)")
+            self.not_modified = self.body_hash_hits = self.misses = 0
+
+validator_cache = None
+
+# Инициализация кэша валидаторов
+def init_validator_cache(config):
+    global validator_cache
+    validator_cache = ValidatorCache(config.get('validator_cache_file', 'validator_cache.json'))
+    return validator_cache
+
+def get_validator_cache():
+    global validator_cache
+    if validator_cache is None:
+        validator_cache = ValidatorCache()
+    return validator_cache
+
+# Кэш метаданных fragment.com: название, изображения, атрибуты и история подарка после
+# выпуска не меняются, поэтому обычный цикл опрашивает только t.me
+def fragment_data_from_gift(data, traits):
+    """Данные fragment.com, восстановленные из сохранённой записи подарка.
+
+    traits — типы атрибутов, которые отдаёт fragment.com: строки, добавленные
+    только из таблицы t.me (например, Quantity), в метаданные не попадают.
+    """
+    return {
+        'name': data.get('name', ''),
+        'description': data.get('description', ''),
+        'image': data.get('image', ''),
+        'lottie': data.get('lottie', ''),
+        'attributes': [{'trait_type': attr.get('trait_type', ''), 'value': attr.get('value', '')}
+                       for attr in data.get('attributes', []) if attr.get('trait_type', '') in traits],
+        'original_details': {field: data.get(field, '') for field in
+                             ('sender_name', 'sender_telegram_id', 'recipient_name', 'recipient_telegram_id', 'date')},
+    }
+
+class MetadataCache:
+    """Когда у каждого подарка последний раз загружались метаданные fragment.com.
+
+    Сами метаданные берутся из сохранённой записи подарка в all_data (bind), на диске
+    хранятся только отметки времени. Подарок без отметки, но с сохранённой записью,
+    получает отметку со случайным сдвигом в пределах refresh_seconds: после запуска
+    повторные загрузки fragment.com распределяются по периоду, а не идут все сразу.
+    Типы атрибутов fragment.com каждой коллекции запоминаются при загрузке (traits):
+    пока они неизвестны, метаданные из записи не восстанавливаются.
+    invalidate() — загрузить метаданные заново при следующем опросе.
+    """
+
+    def __init__(self, path=None, refresh_seconds=7 * 86400):
+        self.path = path
+        self.refresh_seconds = refresh_seconds
+        self._lock = threading.Lock()
+        self.fetched = {}
+        self.traits = {}
+        self.gifts = {}
+        self.hits = 0
+        self.misses = 0
+        if path and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                stored = json.load(f)
+            # Прежний формат — только {коллекция: {id: время}}
+            if set(stored) != {'fetched', 'traits'}:
+                stored = {'fetched': stored, 'traits': {}}
+            self.fetched = {collection_key: {int(gift_id): fetched_at for gift_id, fetched_at in entries.items()}
+                            for collection_key, entries in stored['fetched'].items()}
+            self.traits = {collection_key: set(traits) for collection_key, traits in stored['traits'].items()}
+
+    def bind(self, all_data):
+        """Источник сохранённых записей подарков (all_data или пачка шарда)."""
+        self.gifts = all_data
+
+    def lookup(self, collection_key, gift_id):
+        """Метаданные для подарка или None, если fragment.com нужно запросить."""
+        data = self.gifts.get(collection_key, {}).get(f"{collection_key}_{gift_id}")
+        now = time.time()
+        with self._lock:
+            entries = self.fetched.setdefault(collection_key, {})
+            fetched_at = entries.get(gift_id)
+            traits = self.traits.get(collection_key)
+            if data is None or 'name' not in data or not traits:
+                fetched_at = None
+            elif fetched_at is None and gift_id not in entries:
+                fetched_at = entries[gift_id] = now - random.uniform(0, self.refresh_seconds)
+            if fetched_at is None or now - fetched_at >= self.refresh_seconds:
+                self.misses += 1
+                get_metrics().inc('metadata_cache_total', result='miss')
+                return None
+            self.hits += 1
+            traits = frozenset(traits)
+        get_metrics().inc('metadata_cache_total', result='hit')
+        return fragment_data_from_gift(data, traits)
+
+    def fragment_traits(self, collection_key):
+        with self._lock:
+            return frozenset(self.traits.get(collection_key, ()))
+
+    def mark(self, collection_key, gift_id, fragment_data=None):
+        """Метаданные подарка подтверждены fragment.com; fragment_data пополняет типы атрибутов."""
+        with self._lock:
+            self.fetched.setdefault(collection_key, {})[gift_id] = time.time()
+            if fragment_data:
+                self.traits.setdefault(collection_key, set()).update(
+                    attr.get('trait_type', '') for attr in fragment_data.get('attributes', [])
+                    if attr.get('trait_type', '') and attr.get('value', ''))
+
+    def invalidate(self, collection_key, gift_id=None):
+        """Загрузить метаданные заново: одного подарка или всей коллекции."""
+        with self._lock:
+            entries = self.fetched.setdefault(collection_key, {})
+            if gift_id is None:
+                for known_id in list(entries):
+                    entries[known_id] = None
+            else:
+                entries[gift_id] = None
+
+    def check_attributes(self, collection_key, gift_id, metadata, telegram_data):
+        """Если t.me показывает значения атрибутов fragment.com, которых нет в метаданных, они устарели.
+
+        Атрибуты, которых у fragment.com нет (Quantity и т. п.), меняются сами по себе и не проверяются.
+        """
+        if not telegram_data:
+            return
+        traits = self.fragment_traits(collection_key)
+        known = {(attr['trait_type'], attr['value']) for attr in metadata.get('attributes', [])}
+        for key, value in telegram_data.items():
+            if key in ("Owner", "Owner_avatar") or value.get('trait_type', '') not in traits:
+                continue
+            if (value.get('trait_type', ''), value.get('value', '')) not in known:
+                self.invalidate(collection_key, gift_id)
+                return
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            saved = {
+                'fetched': {collection_key: {str(gift_id): fetched_at for gift_id, fetched_at in entries.items()}
+                            for collection_key, entries in self.fetched.items()},
+                'traits': {collection_key: sorted(traits) for collection_key, traits in self.traits.items()},
+            }
+        write_json_atomic(self.path, saved)
+
+    def report(self):
+        with self._lock:
+            total = self.hits + self.misses
+            print(f"Метаданные fragment.com: из кэша {self.hits}, загружено {self.misses} "
+                  f"({self.hits * 100 / total if total else 0:.1f}% без запроса к fragment.com)")
+            self.hits = self.misses = 0
+
+metadata_cache = None
+
+# Инициализация кэша метаданных ("metadata": {"enabled": false} — fragment.com в каждом цикле)
+def init_metadata_cache(config):
+    global metadata_cache
+    metadata_config = config.get('metadata', {})
+    if not metadata_config.get('enabled', True):
+        metadata_cache = None
+        return None
+    metadata_cache = MetadataCache(metadata_config.get('cache_file', 'metadata_fetched.json'),
+                                   refresh_seconds=metadata_config.get('refresh_seconds', 7 * 86400))
+    return metadata_cache
 
-# Функция для получения хеша содержимого подарка
-def get_content_hash(gift_data):
-    hash_md5 = md5()
-    hash_md5.update(json.dumps(gift_data, sort_keys=True).encode('utf-8'))
-    return hash_md5.hexdigest()
+def get_metadata_cache():
+    return metadata_cache
 
-# Функция для проверки изменений
-def has_changed(old_hash, new_hash):
-    return old_hash != new_hash
+# Загрузить метаданные заново: python main.py refresh-metadata [коллекция]
+def refresh_metadata(collection_name=None):
+    """Сбрасывает отметки в файле кэша и в файлах воркеров (worker_path) того же каталога."""
+    config = load_config()
+    path = config.get('metadata', {}).get('cache_file', 'metadata_fetched.json')
+    root, extension = os.path.splitext(os.path.basename(path))
+    directory = os.path.dirname(path) or '.'
+    paths = [os.path.join(directory, name) for name in os.listdir(directory)
+             if name == root + extension or (name.startswith(root + '.') and name.endswith(extension))]
+    collection_keys = [collection_name] if collection_name else [
+        collection.get('name') for collection in config.get('collections', [])]
+    for cache_path in paths:
+        cache = MetadataCache(cache_path)
+        for collection_key in collection_keys:
+            cache.invalidate(collection_key)
+        cache.save()
+    print(f"Метаданные будут загружены заново при следующем опросе: {', '.join(collection_keys)}")
 
 # Функции извлечения и парсинга данных
-def fetch_gift_page(url):
+def fetch_source(url, conditional=True):
+    """Загружает тело ответа. При неизменном содержимом возвращает NOT_MODIFIED."""
+    cache = get_validator_cache()
+    headers = cache.request_headers(url) if conditional else {}
+    response = get_http_client().get(url, headers=headers)
+    if response.status_code != 304:
+        response.raise_for_status()
+    unchanged = cache.on_response(url, response.status_code, response.headers, response.content)
+    if unchanged and conditional:
+        return NOT_MODIFIED
+    return response.content
+
+def fetch_gift_page(url, conditional=False):
     """Получает HTML-содержимое страницы подарка."""
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
-                      'AppleWebKit/537.36 (KHTML, like Gecko) '
-                      'Chrome/115.0.0.0 Safari/537.36'
-    }
     try:
-        response = requests.get(url, headers=headers, timeout=10)
-        response.raise_for_status()
-        return response.content
+        return fetch_source(url, conditional)
     except requests.exceptions.RequestException as e:
         print(f"Ошибка при получении страницы {url}: {e}")
         return None
 
+def resolve_source(url, body, parse, rebuild=None):
+    """Разбирает тело ответа; для неизменного источника данные восстанавливает rebuild().
+
+    Возвращает NOT_MODIFIED, если источник не изменился, но восстановить данные
+    не из чего и его нужно перезапросить без условных заголовков.
+    """
+    if body is NOT_MODIFIED:
+        rebuilt = rebuild() if rebuild else None
+        return NOT_MODIFIED if rebuilt is None else rebuilt
+    if body is None:
+        return None
+    with get_metrics().timer('parse', host=urlsplit(url).hostname):
+        return parse(body)
+
+def stored_fragment_data(collection_name, gift_id):
+    """Данные fragment.com из сохранённой записи; None, если типы атрибутов коллекции неизвестны."""
+    data = get_validator_cache().stored_gift(collection_name, gift_id)
+    cache = get_metadata_cache()
+    traits = cache.fragment_traits(collection_name) if cache else frozenset()
+    if data is None or 'name' not in data or not traits:
+        return None
+    return fragment_data_from_gift(data, traits)
+
+def stored_telegram_data(collection_name, gift_id, fragment_data):
+    """Таблица t.me в формате parse_gift_table, восстановленная из сохранённой записи.
+
+    Из записи берутся только данные t.me: владелец, аватар, строки атрибутов, которых
+    нет у fragment.com, и проценты. Процент атрибута fragment.com переносится, только
+    если значение в fragment_data не изменилось, иначе сохранённая строка со старым
+    значением попала бы в запись вторым атрибутом того же типа.
+    """
+    data = get_validator_cache().stored_gift(collection_name, gift_id)
+    if data is None or 'Owner' not in data:
+        return None
+    cache = get_metadata_cache()
+    fragment_traits = set(cache.fragment_traits(collection_name)) if cache else set()
+    fragment_values = {attr.get('trait_type', ''): attr.get('value', '') for attr in fragment_data.get('attributes', [])}
+    fragment_traits.update(fragment_values)
+    telegram_data = {'Owner': data.get('Owner'), 'Owner_avatar': data.get('Owner_avatar', DEFAULT_OWNER_AVATAR)}
+    for attr in data.get('attributes', []):
+        trait_type = attr.get('trait_type', '')
+        if trait_type in fragment_traits and fragment_values.get(trait_type) != attr.get('value', ''):
+            continue
+        telegram_data[trait_type] = {'trait_type': trait_type, 'value': attr.get('value', ''),
+                                     'percent': attr.get('percent', 0.0)}
+    return telegram_data
+
+def unchanged_gift_result(fragment_url, telegram_url):
+    """Результат для подарка, оба источника которого не изменились."""
+    return {"unchanged": True, "urls": [fragment_url, telegram_url]}
+
+def is_not_found_error(error):
+    """404 от fragment.com: подарка с таким id ещё (или уже) нет."""
+    response = getattr(error, 'response', None)
+    status = getattr(response, 'status_code', None) or getattr(error, 'status', None)
+    return status == 404
+
+def not_found_gift_result(gift_id):
+    return {"error": f"Подарок {gift_id} не найден на fragment.com", "not_found": True}
+
+# Быстрый разбор таблицы подарка: один проход lxml без повторного парсинга ячеек
+_lxml_local = threading.local()
+
+def _lxml_tools():
+    """Парсер и скомпилированные XPath отдельно для каждого потока (lxml их не разделяет)."""
+    tools = getattr(_lxml_local, 'tools', None)
+    if tools is None:
+        tools = _lxml_local.tools = {
+            'parser': etree.HTMLParser(encoding='utf-8'),
+            'wrap': etree.XPath(
+                "(//div[contains(concat(' ', normalize-space(@class), ' '), ' tgme_gift_table_wrap ')])[1]"
+            ),
+            'table': etree.XPath(
+                ".//table[contains(concat(' ', normalize-space(@class), ' '), ' tgme_gift_table ')]"
+            ),
+            'text': etree.XPath('.//text()'),
+        }
+    return tools
+
+def _cell_text(element, separator=''):
+    """Аналог BeautifulSoup.get_text(separator, strip=True)."""
+    return separator.join(t.strip() for t in _lxml_tools()['text'](element) if t.strip())
+
 def parse_gift_table(html_content):
     """Извлекает данные из таблицы подарков."""
+    if isinstance(html_content, str):
+        html_content = html_content.encode('utf-8')
+    tools = _lxml_tools()
+    root = etree.fromstring(html_content, tools['parser']) if html_content else None
+    if root is None:
+        print("Контейнер с таблицей подарков не найден.")
+        return {}
+    wrap = tools['wrap'](root)
+    if not wrap:
+        print("Контейнер с таблицей подарков не найден.")
+        return {}
+    
+    gift_table = tools['table'](wrap[0])
+    if not gift_table:
+        print("Таблица с информацией о подарке не найдена.")
+        return {}
+    
+    tbody = gift_table[0].find('.//tbody')
+    if tbody is None:
+        print("Таблица с информацией о подарке не найдена.")
+        return {}
+    
+    data = {}
+    for row in tbody.iter('tr'):
+        header = row.find('.//th')
+        value = row.find('.//td')
+        if header is None or value is None:
+            continue
+        key = _cell_text(header)
+        if key == "Owner":
+            img_tag = value.find('.//img')
+            src = img_tag.get('src') if img_tag is not None else None
+            data['Owner_avatar'] = src.strip() if src is not None else DEFAULT_OWNER_AVATAR
+            span_tag = value.find('.//span')
+            data['Owner'] = _cell_text(span_tag) if span_tag is not None else "User"
+        else:
+            val = _cell_text(value, " ")
+            mark_tag = value.find('.//mark')
+            if mark_tag is not None:
+                percent = _cell_text(mark_tag).replace('%', '').strip()
+                name = val.replace(''.join(tools['text'](mark_tag)), '').strip()
+                try:
+                    data[key] = {"trait_type": key, "value": name, "percent": float(percent)}
+                except ValueError:
+                    data[key] = {"trait_type": key, "value": name, "percent": 0.0}
+            else:
+                data[key] = {"trait_type": key, "value": val, "percent": 0.0}
+    return data
+
+def parse_gift_table_bs4(html_content):
+    """Извлекает данные из таблицы подарков через BeautifulSoup.
+
+    Эталонная реализация: используется для сверки с parse_gift_table в benchmark.py.
+    """
     soup = BeautifulSoup(html_content, 'lxml')
     gift_table_wrap = soup.find('div', class_='tgme_gift_table_wrap')
     if not gift_table_wrap:
@@ -78,7 +1452,7 @@ def parse_gift_table(html_content):
                 owner_html = value.decode_contents()
                 soup_owner = BeautifulSoup(owner_html, 'html.parser')
                 img_tag = soup_owner.find('img')
-                data['Owner_avatar'] = img_tag['src'].strip() if img_tag and img_tag.has_attr('src') else "https://i.getgems.io/pa4IG9_bFDXTUAXXqwq1M2OBNrplmfVaecyHGHoY3Po/rs:fill:512:512:1/g:ce/czM6Ly9nZXRnZW1zLXMzL3VzZXItbWVkaWEvZ2Vtcy80Ni53ZWJw"
+                data['Owner_avatar'] = img_tag['src'].strip() if img_tag and img_tag.has_attr('src') else DEFAULT_OWNER_AVATAR
                 span_tag = soup_owner.find('span')
                 data['Owner'] = span_tag.get_text(strip=True) if span_tag else "User"
             else:
@@ -95,26 +1469,83 @@ def parse_gift_table(html_content):
                     data[key] = {"trait_type": key, "value": val, "percent": 0.0}
     return data
 
+def get_fragment_url(collection_name, gift_id):
+    return f"{FRAGMENT_BASE_URL}/gift/{collection_name.lower()}-{gift_id}"
+
+def get_telegram_url(collection_name, gift_id):
+    return f"{TELEGRAM_BASE_URL}/nft/{collection_name}-{gift_id}"
+
+def cached_gift_result(gift_id, collection_name, metadata, telegram_url, html_content):
+    """Запись подарка из кэшированных метаданных fragment.com и страницы t.me."""
+    if html_content is NOT_MODIFIED:
+        return {"unchanged": True, "urls": [telegram_url]}
+    if html_content is None:
+        # Без t.me владелец неизвестен: не затираем сохранённую запись
+        return {"error": f"Не удалось получить данные с t.me для {gift_id}"}
+    telegram_data = resolve_source(telegram_url, html_content, parse_gift_table)
+    get_metadata_cache().check_attributes(collection_name, gift_id, metadata, telegram_data)
+    return build_gift_data(gift_id, collection_name, metadata, telegram_data)
+
 def process_gift_data(gift_id, collection_name):
     """Собирает и обрабатывает все данные о подарке."""
     # URL для данных из fragment.com
-    fragment_url = f"https://nft.fragment.com/gift/{collection_name.lower()}-{gift_id}"
+    fragment_url = get_fragment_url(collection_name, gift_id)
     
     # URL для данных из t.me
-    telegram_url = f"https://t.me/nft/{collection_name}-{gift_id}"
+    telegram_url = get_telegram_url(collection_name, gift_id)
+    
+    # Метаданные fragment.com уже известны — опрашиваем только t.me
+    cache = get_metadata_cache()
+    metadata = cache.lookup(collection_name, gift_id) if cache else None
+    if metadata is not None:
+        html_content = fetch_gift_page(telegram_url, conditional=True)
+        return cached_gift_result(gift_id, collection_name, metadata, telegram_url, html_content)
     
     # Получаем JSON данные из fragment.com
     try:
-        response = requests.get(fragment_url, timeout=10)
-        response.raise_for_status()
-        fragment_data = response.json()
+        fragment_body = fetch_source(fragment_url)
+        
+        # Теперь всегда пытаемся получить данные из Telegram
+        print(f"Пытаемся получить данные из Telegram для подарка {gift_id}...")
+        html_content = fetch_gift_page(telegram_url, conditional=True)
+        
+        # Оба источника не изменились — разбор и хеширование не нужны
+        if fragment_body is NOT_MODIFIED and html_content is NOT_MODIFIED:
+            if cache:
+                cache.mark(collection_name, gift_id)
+            return unchanged_gift_result(fragment_url, telegram_url)
+        
+        fragment_data = resolve_source(fragment_url, fragment_body, json.loads,
+                                       lambda: stored_fragment_data(collection_name, gift_id))
+        if fragment_data is NOT_MODIFIED:
+            fragment_data = resolve_source(fragment_url, fetch_source(fragment_url, conditional=False), json.loads)
     except requests.exceptions.RequestException as e:
+        if is_not_found_error(e):
+            return not_found_gift_result(gift_id)
         print(f"Ошибка при получении данных с {fragment_url}: {e}")
+        # Запись подарка не обновится: страница t.me не должна считаться уже учтённой
+        get_validator_cache().invalidate(telegram_url)
         return {"error": f"Не удалось получить данные с fragment.com для {gift_id}"}
     except json.JSONDecodeError:
+        get_validator_cache().invalidate(fragment_url)
+        get_validator_cache().invalidate(telegram_url)
+        get_metrics().inc('errors_total', category='json_decode', host=urlsplit(fragment_url).hostname)
         print(f"Ошибка декодирования JSON с {fragment_url}")
         return {"error": f"Неверный формат JSON с fragment.com для {gift_id}"}
+    if cache:
+        cache.mark(collection_name, gift_id, fragment_data)
     
+    telegram_data = resolve_source(telegram_url, html_content, parse_gift_table,
+                                   lambda: stored_telegram_data(collection_name, gift_id, fragment_data))
+    if telegram_data is NOT_MODIFIED:
+        telegram_data = resolve_source(telegram_url, fetch_gift_page(telegram_url), parse_gift_table)
+    return build_gift_data(gift_id, collection_name, fragment_data, telegram_data)
+
+def build_gift_data(gift_id, collection_name, fragment_data, telegram_data):
+    """Объединяет данные fragment.com и разобранной таблицы t.me в запись подарка.
+
+    telegram_data — результат parse_gift_table или None, если страница недоступна.
+    """
     # Инициализируем gift_data
     gift_data = {}
     gift_data['name'] = fragment_data.get('name', '')
@@ -135,6 +1566,7 @@ def process_gift_data(gift_id, collection_name):
                 'percent': 0.0  # Изначально без процентов
             })
     gift_data['attributes'] = processed_attributes  # Сохраняем для генерации страницы подарка
+    fragment_count = len(processed_attributes)
         
     # Извлекаем информацию о владельце из fragment.com
     original_details = fragment_data.get('original_details', {})
@@ -144,13 +1576,9 @@ def process_gift_data(gift_id, collection_name):
     gift_data['recipient_telegram_id'] = original_details.get('recipient_telegram_id', '')
     gift_data['date'] = original_details.get('date', '')
     
-    # Теперь всегда пытаемся получить данные из Telegram
-    print(f"Пытаемся получить данные из Telegram для подарка {gift_id}...")
-    html_content = fetch_gift_page(telegram_url)
-    if html_content:
-        telegram_data = parse_gift_table(html_content)
+    if telegram_data is not None:
         gift_data['Owner'] = telegram_data.get('Owner', gift_data.get('recipient_name', 'User'))
-        gift_data['Owner_avatar'] = telegram_data.get('Owner_avatar', "https://i.getgems.io/pa4IG9_bFDXTUAXXqwq1M2OBNrplmfVaecyHGHoY3Po/rs:fill:512:512:1/g:ce/czM6Ly9nZXRnZW1zLXMzL3VzZXItbWVkaWEvZ2Vtcy80Ni53ZWJw")
+        gift_data['Owner_avatar'] = telegram_data.get('Owner_avatar', DEFAULT_OWNER_AVATAR)
         
         # Интегрируем атрибуты из Telegram в gift_data['attributes']
         telegram_attributes = [v for k, v in telegram_data.items() if k not in ["Owner", "Owner_avatar"]]
@@ -166,367 +1594,1350 @@ def process_gift_data(gift_id, collection_name):
                     attr['percent'] = percent
                     break
             else:
-                # Если trait_type и value не найдены, добавляем новый атрибут
-                gift_data['attributes'].append(telegram_attr)
+                # Атрибут есть только на t.me: одна строка на trait_type, новое значение заменяет прежнее
+                for index in range(fragment_count, len(gift_data['attributes'])):
+                    if gift_data['attributes'][index]['trait_type'] == trait_type:
+                        gift_data['attributes'][index] = dict(telegram_attr)
+                        break
+                else:
+                    gift_data['attributes'].append(dict(telegram_attr))
     else:
         # Если не удалось получить данные из Telegram, используем данные из fragment.com для владельца
         gift_data['Owner'] = gift_data.get('recipient_name', 'User')
-        gift_data['Owner_avatar'] = gift_data.get('Owner_avatar', "https://i.getgems.io/pa4IG9_bFDXTUAXXqwq1M2OBNrplmfVaecyHGHoY3Po/rs:fill:512:512:1/g:ce/czM6Ly9nZXRnZW1zLXMzL3VzZXItbWVkaWEvZ2Vtcy80Ni53ZWJw")
+        gift_data['Owner_avatar'] = gift_data.get('Owner_avatar', DEFAULT_OWNER_AVATAR)
     
     # Добавляем ссылку на страницу подарка
     gift_data['gift_page'] = f"gifts/{collection_name}_{gift_id}.html"
     
     return gift_data
 
-# Генерация главной страницы коллекции
-def generate_main_page(gift_data, collection_name, output_file):
-    """Генерирует главную страницу со списком подарков."""
-    html_template_start = f"""
-    <!DOCTYPE html>
-    <html lang="ru">
-    <head>
-        <meta charset="UTF-8">
-        <title>{collection_name}</title>
-        <style>
-            /* Стили для тёмной темы */
-            body {{
-                font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-                background-color: #121212;
-                color: #e0e0e0;
-                margin: 0;
-                padding: 0;
-            }}
-            .header {{
-                background-color: #1f1f1f;
-                padding: 20px;
-                text-align: center;
-                box-shadow: 0 4px 8px rgba(0,0,0,0.3);
-                position: relative;
-            }}
-            .header h1 {{
-                margin: 0;
-                color: #ffffff;
-                font-size: 2em;
-                letter-spacing: 2px;
-            }}
-            .controls {{
-                display: flex;
-                justify-content: center;
-                gap: 20px;
-                padding: 20px;
-                flex-wrap: wrap;
-            }}
-            .controls input, .controls select {{
-                padding: 10px;
-                border-radius: 8px;
-                border: none;
-                font-size: 16px;
-            }}
-            .gift-grid {{
-                display: grid;
-                grid-template-columns: repeat(auto-fill, minmax(200px, 1fr)); /* Адаптивные колонки */
-                gap: 25px;
-                padding: 20px;
-            }}
-            .gift-card {{
-                background-color: #1f1f1f;
-                border-radius: 15px;
-                box-shadow: 0 8px 16px rgba(0,0,0,0.3);
-                overflow: hidden;
-                text-align: center;
-                transition: transform 0.3s, box-shadow 0.3s;
-                cursor: pointer;
-            }}
-            .gift-card:hover {{
-                transform: scale(1.05);
-                box-shadow: 0 12px 24px rgba(0,0,0,0.4);
-            }}
-            .gift-card img {{
-                width: 100%;
-                height: auto;
-            }}
-            .gift-card h3 {{
-                margin: 0;
-                padding: 10px;
-                color: #ffffff;
-            }}
-            a {{
-                text-decoration: none;
-                color: inherit;
-            }}
-            /* Адаптив для маленьких экранов */
-            @media (max-width: 600px) {{
-                .controls {{
-                    flex-direction: column;
-                    align-items: center;
-                }}
-                .gift-grid {{
-                    grid-template-columns: repeat(2, minmax(100px, 1fr)); /* Адаптивные колонки */
-                }}
-            }}
-        </style>
-    </head>
-    <body>
-    <div class="header">
-        <h1>{collection_name}</h1>
-    </div>
-    <div class="controls">
-        <input type="text" id="searchInput" placeholder="Поиск по номеру подарка (например, {collection_name}-1)">
-        <select id="sortSelect">
-            <option value="default">Сортировка по редкости</option>
-            <option value="asc">Редкость ↑</option>
-            <option value="desc">Редкость ↓</option>
-        </select>
-    </div>
-        <div class="gift-grid" id="giftGrid">
-    """
-    html_template_end = """
-        </div>
-        <script>
-            const giftGrid = document.getElementById('giftGrid');
-            const searchInput = document.getElementById('searchInput');
-            const sortSelect = document.getElementById('sortSelect');
-
-            // Функция для получения средней редкости подарка
-            function getRarity(giftCard) {
-                return parseFloat(giftCard.getAttribute('data-rarity')) || 0;
-            }
+# Компактное представление подарков в памяти: all_data хранит GiftRecord вместо вложенных словарей
+# Ссылки, которые почти у всех подарков строятся по номеру, хранятся как шаблоны
+GIFT_URL_TEMPLATES = {
+    'image': "https://nft.fragment.com/gift/{slug}-{gift_id}.webp",
+    'lottie': "https://nft.fragment.com/gift/{slug}-{gift_id}.lottie.json",
+    'gift_page': "gifts/{collection}_{gift_id}.html",
+}
+# Порядок полей совпадает с build_gift_data: JSON-представление не меняется
+GIFT_FIELDS = ('name', 'description', 'image', 'lottie', 'attributes', 'sender_name', 'sender_telegram_id',
+               'recipient_name', 'recipient_telegram_id', 'date', 'Owner', 'Owner_avatar', 'gift_page')
+_FIELD_SLOTS = {field: f"_{field}" for field in GIFT_FIELDS}
+# Отсутствующее поле; None в слоте шаблонного поля означает "ссылка по шаблону"
+_MISSING = object()
 
-            // Событие поиска
-            searchInput.addEventListener('input', function() {
-                const query = this.value.toLowerCase();
-                const giftCards = giftGrid.getElementsByClassName('gift-card');
-                Array.from(giftCards).forEach(function(card) {
-                    const title = card.getAttribute('data-id').toLowerCase();
-                    if (title.includes(query)) {
-                        card.style.display = '';
-                    } else {
-                        card.style.display = 'none';
-                    }
-                });
-            });
+class GiftAttribute(Mapping):
+    """Атрибут подарка. Одинаковые (trait_type, value, percent) — один общий объект на процесс."""
 
-            // Событие сортировки
-            sortSelect.addEventListener('change', function() {
-                const giftCards = Array.from(giftGrid.getElementsByClassName('gift-card'));
-                if (this.value === 'asc') {
-                    giftCards.sort((a, b) => getRarity(a) - getRarity(b));
-                } else if (this.value === 'desc') {
-                    giftCards.sort((a, b) => getRarity(b) - getRarity(a));
-                } else {
-                    // По умолчанию сортировка по порядку
-                    giftCards.sort((a, b) => a.getAttribute('data-original-order') - b.getAttribute('data-original-order'));
-                }
+    __slots__ = ('trait_type', 'value', 'percent', '__weakref__')
+    _interned = weakref.WeakValueDictionary()
 
-                // Удаляем текущие карточки
-                while (giftGrid.firstChild) {
-                    giftGrid.removeChild(giftGrid.firstChild);
-                }
+    def __new__(cls, trait_type, value, percent):
+        key = (trait_type, value, percent)
+        attribute = cls._interned.get(key)
+        if attribute is None:
+            attribute = super().__new__(cls)
+            attribute.trait_type = sys.intern(trait_type)
+            attribute.value = sys.intern(value)
+            attribute.percent = percent
+            cls._interned[key] = attribute
+        return attribute
 
-                // Добавляем отсортированные карточки
-                giftCards.forEach(function(card) {
-                    giftGrid.appendChild(card);
-                });
-            });
-        </script>
-    </body>
-    </html>
+    def __getitem__(self, name):
+        if name not in self.__slots__[:3]:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def get(self, name, default=None):
+        return getattr(self, name) if name in self.__slots__[:3] else default
+
+    def __iter__(self):
+        return iter(self.__slots__[:3])
+
+    def __len__(self):
+        return 3
+
+    def to_dict(self):
+        return {'trait_type': self.trait_type, 'value': self.value, 'percent': self.percent}
+
+class GiftRecord(Mapping):
+    """Запись подарка на __slots__ с интерфейсом словаря только для чтения.
+
+    Названия и значения атрибутов интернированы и общие для всех подарков, ссылки
+    image, lottie и gift_page хранятся как шаблон + номер, а аватар по умолчанию —
+    как отсутствие значения. to_dict() возвращает прежнюю форму словаря для JSON.
     """
-    # Фильтрация ключей: исключаем те, которые содержат '_hash' или равны 'hash'
-    filtered_gift_keys = [k for k in gift_data.keys() if not k.endswith('_hash') and k != 'hash']
-    
-    # Сортировка ключей
-    try:
-        sorted_gift_keys = sorted(filtered_gift_keys, key=lambda x: int(x.split('_')[-1]))
-    except ValueError as e:
-        print(f"Ошибка при сортировке ключей: {e}")
-        sorted_gift_keys = [k for k in filtered_gift_keys]  # Без сортировки
-    
-    gift_cards_html = ""
-    for index, key in enumerate(sorted_gift_keys):
-        data = gift_data[key]
-        if "error" in data:
-            print(f"Пропуск подарка {key} из-за ошибки: {data['error']}")
-            continue
-        image_url = data.get('image', '')
-        gift_page = data.get('gift_page', '#')
-        name = data.get('name', 'Подарок')
-        # Вычисляем средний процент редкости
-        total_percent = 0
-        count = 0
-        for attr in data.get('attributes', []):
-            percent = attr.get('percent', 0.0)
-            total_percent += percent
-            count += 1
-        average_rarity = total_percent / count if count > 0 else 0
-        # Добавляем data-атрибуты для сортировки и поиска
-        gift_card_html = f"""
-            <div class="gift-card" data-id="{key}" data-rarity="{average_rarity}" data-original-order="{index}">
-                <a href="{gift_page}">
-                    <img src="{image_url}" alt="{name}">
-                    <h3>{name}</h3>
-                </a>
-            </div>
-        """
-        gift_cards_html += gift_card_html
-    full_html = html_template_start + gift_cards_html + html_template_end
-    with open(output_file, "w", encoding="utf-8") as f:
-        f.write(full_html)
-    print(f"Главная страница создана или обновлена: {output_file}")
 
-# Генерация отдельных страниц подарков
-def generate_gift_pages(gift_data, collection_name, yandex_client, bucket_name):
-    """Генерирует отдельные страницы для каждого подарка и загружает их на Yandex."""
-    for gift_id, data in gift_data.items():
-        if "error" in data:
-            print(f"Пропуск подарка {gift_id} из-за ошибки: {data['error']}")
-            continue
-        gift_page = data.get('gift_page', '')
-        if not gift_page:
-            continue
-        output_file = gift_page
-        name = data.get('name', 'Подарок')
-        description = data.get('description', '')
-        owner_name = data.get('Owner', 'User')
-        owner_avatar = data.get('Owner_avatar', 'https://i.getgems.io/pa4IG9_bFDXTUAXXqwq1M2OBNrplmfVaecyHGHoY3Po/rs:fill:512:512:1/g:ce/czM6Ly9nZXRnZW1zLXMzL3VzZXItbWVkaWEvZ2Vtcy80Ni53ZWJw')
-        image_url = data.get('image', '')
-        lottie_url = data.get('lottie', '')
-        attributes = data.get('attributes', [])
-        # back_button = '<a href="../index.html" class="back-button">Назад</a>'
-        html_content = f"""
+    __slots__ = ('collection', 'gift_id') + tuple(_FIELD_SLOTS.values()) + ('extra',)
+
+    @classmethod
+    def from_dict(cls, collection_name, gift_id, data):
+        record = cls()
+        record.collection = sys.intern(collection_name)
+        record.gift_id = gift_id
+        values = {'slug': collection_name.lower(), 'collection': collection_name, 'gift_id': gift_id}
+        extra = None
+        stored = 0
+        for field, value in data.items():
+            if field == 'attributes':
+                value = tuple(GiftAttribute(attr.get('trait_type', ''), attr.get('value', ''), attr.get('percent', 0.0))
+                              for attr in value)
+            elif field in GIFT_URL_TEMPLATES and value == GIFT_URL_TEMPLATES[field].format(**values):
+                value = None
+            elif field == 'Owner_avatar' and value == DEFAULT_OWNER_AVATAR:
+                value = None
+            elif field not in GIFT_FIELDS:
+                extra = extra or {}
+                extra[field] = value
+                continue
+            elif field in ('description', 'date') and isinstance(value, str):
+                value = sys.intern(value)
+            setattr(record, _FIELD_SLOTS[field], value)
+            stored += 1
+        if stored < len(GIFT_FIELDS):
+            for slot in _FIELD_SLOTS.values():
+                if not hasattr(record, slot):
+                    setattr(record, slot, _MISSING)
+        record.extra = extra
+        return record
+
+    def _value(self, field, value):
+        if value is None:
+            if field == 'Owner_avatar':
+                return DEFAULT_OWNER_AVATAR
+            return GIFT_URL_TEMPLATES[field].format(slug=self.collection.lower(), collection=self.collection,
+                                                    gift_id=self.gift_id)
+        return value
+
+    def __getitem__(self, field):
+        slot = _FIELD_SLOTS.get(field)
+        if slot is not None:
+            value = getattr(self, slot)
+            if value is not _MISSING:
+                return self._value(field, value)
+        elif self.extra and field in self.extra:
+            return self.extra[field]
+        raise KeyError(field)
+
+    def get(self, field, default=None):
+        try:
+            return self[field]
+        except KeyError:
+            return default
+
+    def __contains__(self, field):
+        slot = _FIELD_SLOTS.get(field)
+        if slot is not None:
+            return getattr(self, slot) is not _MISSING
+        return bool(self.extra) and field in self.extra
+
+    def __iter__(self):
+        for field, slot in _FIELD_SLOTS.items():
+            if getattr(self, slot) is not _MISSING:
+                yield field
+        if self.extra:
+            yield from self.extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def to_dict(self):
+        data = {}
+        for field in self:
+            value = self[field]
+            data[field] = [attr.to_dict() for attr in value] if field == 'attributes' else value
+        return data
+
+def compact_gift(key, data):
+    """Словарь подарка из build_gift_data или хранилища → GiftRecord."""
+    return GiftRecord.from_dict(key.rsplit('_', 1)[0], get_gift_number(key), data)
+
+def gift_as_dict(data):
+    """Прежняя форма подарка для JSON: GiftRecord.to_dict() или исходный словарь."""
+    return data.to_dict() if isinstance(data, GiftRecord) else data
+
+# Асинхронный движок загрузки (engine: "async" в config.json)
+async def fetch_async(session, host_semaphores, url, conditional=True):
+    """Загружает тело ответа, ограничивая число одновременных запросов к хосту."""
+    cache = get_validator_cache()
+    governor = get_request_governor()
+    headers = cache.request_headers(url) if conditional else {}
+    metrics = get_metrics()
+    host = urlsplit(url).hostname
+    attempt = 0
+    async with host_semaphores[urlsplit(url).netloc]:
+        while True:
+            await asyncio.sleep(governor.reserve(host))
+            started = time.perf_counter()
+            try:
+                async with session.get(url, headers=headers) as response:
+                    metrics.record_fetch(host, time.perf_counter() - started, response.status)
+                    if response.status in RETRYABLE_STATUSES:
+                        delay = governor.on_failure(host, attempt, response.status,
+                                                    parse_retry_after(response.headers.get('Retry-After')))
+                        if delay is None:
+                            response.raise_for_status()
+                    else:
+                        if response.status != 304:
+                            response.raise_for_status()
+                        body = await response.read()
+                        governor.on_success(host)
+                        break
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                metrics.record_fetch(host, time.perf_counter() - started,
+                                     error='timeout' if isinstance(e, asyncio.TimeoutError) else 'connection')
+                delay = governor.on_failure(host, attempt)
+                if delay is None:
+                    raise
+            await asyncio.sleep(delay)
+            attempt += 1
+    unchanged = cache.on_response(url, response.status, response.headers, body)
+    if unchanged and conditional:
+        return NOT_MODIFIED
+    return body
+
+async def process_gift_data_async(session, host_semaphores, gift_id, collection_name):
+    """Асинхронный аналог process_gift_data: fragment.com и t.me запрашиваются параллельно."""
+    fragment_url = get_fragment_url(collection_name, gift_id)
+    telegram_url = get_telegram_url(collection_name, gift_id)
+    cache = get_metadata_cache()
+    metadata = cache.lookup(collection_name, gift_id) if cache else None
+    if metadata is not None:
+        try:
+            html_content = await fetch_async(session, host_semaphores, telegram_url)
+        except Exception as e:
+            print(f"Ошибка при получении страницы {telegram_url}: {e!r}")
+            html_content = None
+        return cached_gift_result(gift_id, collection_name, metadata, telegram_url, html_content)
+    fragment_body, html_content = await asyncio.gather(
+        fetch_async(session, host_semaphores, fragment_url),
+        fetch_async(session, host_semaphores, telegram_url),
+        return_exceptions=True,
+    )
+    if isinstance(html_content, Exception):
+        print(f"Ошибка при получении страницы {telegram_url}: {html_content!r}")
+        html_content = None
+    if fragment_body is NOT_MODIFIED and html_content is NOT_MODIFIED:
+        if cache:
+            cache.mark(collection_name, gift_id)
+        return unchanged_gift_result(fragment_url, telegram_url)
+    try:
+        if isinstance(fragment_body, Exception):
+            raise fragment_body
+        fragment_data = resolve_source(fragment_url, fragment_body, json.loads,
+                                       lambda: stored_fragment_data(collection_name, gift_id))
+        if fragment_data is NOT_MODIFIED:
+            fragment_body = await fetch_async(session, host_semaphores, fragment_url, conditional=False)
+            fragment_data = resolve_source(fragment_url, fragment_body, json.loads)
+    except json.JSONDecodeError:
+        get_validator_cache().invalidate(fragment_url)
+        get_validator_cache().invalidate(telegram_url)
+        get_metrics().inc('errors_total', category='json_decode', host=urlsplit(fragment_url).hostname)
+        print(f"Ошибка декодирования JSON с {fragment_url}")
+        return {"error": f"Неверный формат JSON с fragment.com для {gift_id}"}
+    except Exception as e:
+        if is_not_found_error(e):
+            return not_found_gift_result(gift_id)
+        print(f"Ошибка при получении данных с {fragment_url}: {e!r}")
+        # Запись подарка не обновится: страница t.me не должна считаться уже учтённой
+        get_validator_cache().invalidate(telegram_url)
+        return {"error": f"Не удалось получить данные с fragment.com для {gift_id}"}
+    if cache:
+        cache.mark(collection_name, gift_id, fragment_data)
+    telegram_data = resolve_source(telegram_url, html_content, parse_gift_table,
+                                   lambda: stored_telegram_data(collection_name, gift_id, fragment_data))
+    if telegram_data is NOT_MODIFIED:
+        try:
+            html_content = await fetch_async(session, host_semaphores, telegram_url, conditional=False)
+        except Exception as e:
+            print(f"Ошибка при получении страницы {telegram_url}: {e!r}")
+            html_content = None
+        telegram_data = resolve_source(telegram_url, html_content, parse_gift_table)
+    return build_gift_data(gift_id, collection_name, fragment_data, telegram_data)
+
+class HostSemaphores(dict):
+    """Лениво создаёт asyncio.Semaphore для каждого хоста."""
+
+    def __init__(self, limit):
+        super().__init__()
+        self.limit = limit
+
+    def __missing__(self, host):
+        semaphore = asyncio.Semaphore(self.limit)
+        self[host] = semaphore
+        return semaphore
+
+async def _run_async_sweep(jobs, config, on_result):
+    async_config = config.get('async', {})
+    http_config = config.get('http', {})
+    max_in_flight = async_config.get('max_in_flight', 200)
+    per_host_limit = async_config.get('per_host_limit', 100)
+    timeout = aiohttp.ClientTimeout(
+        sock_connect=http_config.get('connect_timeout', 5),
+        sock_read=http_config.get('read_timeout', 10),
+    )
+    connector = aiohttp.TCPConnector(limit=0, limit_per_host=per_host_limit, ttl_dns_cache=300)
+    host_semaphores = HostSemaphores(per_host_limit)
+    metrics = get_metrics()
+    jobs_iter = iter(jobs)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=HTTP_HEADERS) as session:
+        async def worker():
+            # Итератор общий для всех воркеров: в одном потоке это безопасно
+            for collection_key, key, gift_id, collection_name in jobs_iter:
+                if shutdown_event.is_set():
+                    return
+                try:
+                    with metrics.timer('gift'):
+                        gift_data = await process_gift_data_async(session, host_semaphores, gift_id, collection_name)
+                except Exception as e:
+                    metrics.inc('errors_total', category='exception')
+                    print(f"Исключение при обработке подарка {key}: {e!r}")
+                    gift_data = {"error": f"Исключение: {e!r}"}
+                try:
+                    on_result(collection_key, key, gift_data)
+                except Exception as e:
+                    print(f"Исключение при обработке подарка {key}: {e!r}")
+
+        await asyncio.gather(*(worker() for _ in range(max(1, min(max_in_flight, len(jobs))))))
+
+def run_async_sweep(jobs, config, on_result):
+    """Обходит подарки асинхронно: сотни подарков одновременно, с лимитом на хост."""
+    asyncio.run(_run_async_sweep(jobs, config, on_result))
+
+def run_threaded_sweep(jobs, thread_workers, on_result):
+    """Обходит подарки в пуле потоков: по одному process_gift_data на подарок."""
+    metrics = get_metrics()
+
+    def timed_process_gift_data(gift_id, collection_name):
+        with metrics.timer('gift'):
+            return process_gift_data(gift_id, collection_name)
+
+    with ThreadPoolExecutor(max_workers=thread_workers) as executor:
+        future_to_gift = {}
+        for collection_key, key, gift_id, collection_name in jobs:
+            future = executor.submit(timed_process_gift_data, gift_id, collection_name)
+            future_to_gift[future] = (collection_key, key)
+        
+        draining = False
+        for future in as_completed(future_to_gift):
+            if shutdown_event.is_set() and not draining:
+                # Ещё не начатые подарки отменяются, выполняющиеся дорабатываются
+                draining = True
+                for pending in future_to_gift:
+                    pending.cancel()
+            if future.cancelled():
+                continue
+            collection_key, key = future_to_gift[future]
+            try:
+                gift_data = future.result()
+            except Exception as e:
+                metrics.inc('errors_total', category='exception')
+                print(f"Исключение при обработке подарка {key}: {e}")
+                gift_data = {"error": f"Исключение: {e}"}
+            try:
+                on_result(collection_key, key, gift_data)
+            except Exception as e:
+                print(f"Исключение при обработке подарка {key}: {e}")
+
+def run_sweep(jobs, config, engine, on_result):
+    """Обходит jobs выбранным движком ("threads" или "async")."""
+    if engine == 'async':
+        run_async_sweep(jobs, config, on_result)
+    else:
+        run_threaded_sweep(jobs, config.get('thread_workers', 20), on_result)
+
+# Обработка результата загрузки подарка: сравнение отпечатков и обновление all_data
+def apply_gift_result(all_data, collection_key, key, gift_data, changed_keys, index_dirty, fingerprints):
+    """Возвращает 'changed', 'unchanged', 'not_found' или 'error'.
+
+    Изменившиеся группы полей подарка записываются в fingerprints.changed_fields.
+    """
+    if gift_data and gift_data.get("not_found"):
+        print(f"Подарок не найден: {key}")
+        return 'not_found'
+    if gift_data and gift_data.get("unchanged"):
+        if key in all_data[collection_key]:
+            print(f"Подарок не изменился: {key}")
+            return 'unchanged'
+        # Валидаторы есть, а данных нет: в следующем цикле загружаем источники целиком
+        for url in gift_data["urls"]:
+            get_validator_cache().invalidate(url)
+        print(f"Нет сохранённых данных для неизменного подарка {key}, будет перезагружен.")
+        return 'error'
+    elif gift_data and "error" not in gift_data:
+        old_data = all_data[collection_key].get(key)
+        with get_metrics().timer('hash'):
+            fields = fingerprints.diff(collection_key, key, gift_data, old_data)
+        if fields:
+            # Карточка на главной странице не зависит от владельца
+            if fields != {'owner'} and get_card_fields(old_data) != get_card_fields(gift_data):
+                index_dirty.add(collection_key)
+            all_data[collection_key][key] = compact_gift(key, gift_data)
+            changed_keys[collection_key].add(key)
+            fingerprints.record_changes(collection_key, key, fields)
+            if changelog:
+                changelog.record(collection_key, get_gift_number(key), fields, old_data, gift_data)
+            for field in fields:
+                get_metrics().inc('gift_field_changes_total', field=field)
+            print(f"Обновление подарка: {key} ({', '.join(sorted(fields))})")
+            return 'changed'
+        print(f"Подарок не изменился: {key}")
+        return 'unchanged'
+    print(f"Ошибка при получении данных для {key}: {gift_data.get('error', 'Неизвестная ошибка')}")
+    return 'error'
+
+# Адаптивный планировщик опроса подарков
+class PollScheduler:
+    """Очередь с приоритетом по времени следующего опроса каждого подарка.
+
+    Интервал подарка сбрасывается до min_interval при изменении и растёт
+    в growth раз, пока подарок не меняется, но не выше max_interval.
+    Число опрашиваемых подарков ограничено бюджетом запросов в секунду: за время
+    между вызовами due_jobs накапливается requests_per_second запросов в секунду,
+    а неизрасходованный остаток переносится не больше чем на burst запросов.
+    """
+
+    def __init__(self, min_interval=10, max_interval=3600, growth=1.5,
+                 requests_per_second=10, requests_per_gift=2, burst=None):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.growth = growth
+        self.requests_per_second = requests_per_second
+        self.requests_per_gift = requests_per_gift
+        self.heap = []
+        self.entries = {}
+        self.ranges = {}
+        self.dirty = set()
+        # Запас бюджета не зависит от min_interval: при min_interval = 0 опрос не должен вставать
+        self.burst = burst if burst is not None else max(requests_per_second, requests_per_gift)
+        self.tokens = self.burst
+        self.last_refill = time.time()
+
+    def load(self, rows):
+        """Восстанавливает сохранённые интервалы: (collection, gift_id, interval, next_due, last_change)."""
+        for collection_key, gift_id, interval, next_due, last_change in rows:
+            self.entries[(collection_key, gift_id)] = [interval, next_due, last_change]
+            heapq.heappush(self.heap, (next_due, collection_key, gift_id))
+
+    def ensure_range(self, collection_key, start_id, end_id):
+        """Добавляет в очередь новые id коллекции; id вне диапазона отбрасываются при выдаче."""
+        if self.ranges.get(collection_key) == (start_id, end_id):
+            return
+        self.ranges[collection_key] = (start_id, end_id)
+        now = time.time()
+        for gift_id in range(start_id, end_id + 1):
+            if (collection_key, gift_id) not in self.entries:
+                self.entries[(collection_key, gift_id)] = [self.min_interval, now, 0.0]
+                heapq.heappush(self.heap, (now, collection_key, gift_id))
+                self.dirty.add((collection_key, gift_id))
+
+    def _refill(self, now):
+        # Бюджет, накопленный за время последнего цикла, доступен целиком, каким бы долгим
+        # ни был цикл; с прежних циклов переносится не больше burst
+        accrued = (now - self.last_refill) * self.requests_per_second
+        self.tokens = min(max(self.burst, accrued), self.tokens + accrued)
+        self.last_refill = now
+
+    def due_jobs(self, now=None):
+        """Выдаёт подарки, время опроса которых наступило, в пределах бюджета запросов."""
+        now = time.time() if now is None else now
+        self._refill(now)
+        jobs = []
+        while self.heap and self.heap[0][0] <= now and self.tokens >= self.requests_per_gift:
+            next_due, collection_key, gift_id = heapq.heappop(self.heap)
+            entry = self.entries.get((collection_key, gift_id))
+            # Устаревшая запись кучи или id вне текущего диапазона
+            if entry is None or entry[1] != next_due:
+                continue
+            start_id, end_id = self.ranges.get(collection_key, (gift_id, gift_id))
+            if not start_id <= gift_id <= end_id:
+                del self.entries[(collection_key, gift_id)]
+                continue
+            self.tokens -= self.requests_per_gift
+            jobs.append((collection_key, f"{collection_key}_{gift_id}", gift_id, collection_key))
+        return jobs
+
+    def record(self, collection_key, key, status, now=None):
+        """Пересчитывает интервал подарка по результату опроса и ставит его обратно в очередь."""
+        now = time.time() if now is None else now
+        gift_id = int(key.rsplit('_', 1)[-1])
+        entry = self.entries.setdefault((collection_key, gift_id), [self.min_interval, now, 0.0])
+        if status == 'changed':
+            entry[0] = self.min_interval
+            entry[2] = now
+        elif status in ('unchanged', 'not_found'):
+            entry[0] = min(self.max_interval, entry[0] * self.growth)
+        # Ошибка: интервал не меняется, повтор через минимальный интервал
+        delay = entry[0] if status != 'error' else self.min_interval
+        entry[1] = now + delay * random.uniform(0.9, 1.1)
+        heapq.heappush(self.heap, (entry[1], collection_key, gift_id))
+        self.dirty.add((collection_key, gift_id))
+
+    def pop_dirty_rows(self):
+        rows = []
+        for collection_key, gift_id in self.dirty:
+            entry = self.entries.get((collection_key, gift_id))
+            if entry:
+                rows.append((collection_key, gift_id, entry[0], entry[1], entry[2]))
+        self.dirty.clear()
+        return rows
+
+    def backlog(self, now=None):
+        now = time.time() if now is None else now
+        return sum(1 for entry in self.entries.values() if entry[1] <= now)
+
+# Инициализация планировщика по config.json ("scheduler": {...})
+def init_scheduler(config):
+    scheduler_config = config.get('scheduler', {})
+    if not scheduler_config.get('enabled', True):
+        return None
+    return PollScheduler(
+        min_interval=scheduler_config.get('min_interval', config.get('interval_seconds', 60)),
+        max_interval=scheduler_config.get('max_interval', 3600),
+        growth=scheduler_config.get('growth', 1.5),
+        requests_per_second=scheduler_config.get('requests_per_second', 10),
+        # С кэшем метаданных обычный опрос подарка — один запрос к t.me
+        requests_per_gift=scheduler_config.get(
+            'requests_per_gift', 1 if config.get('metadata', {}).get('enabled', True) else 2),
+        burst=scheduler_config.get('burst'),
+    )
+
+# Поиск текущего диапазона id коллекции и кэш отсутствующих подарков
+def gift_exists(collection_name, gift_id):
+    """Проверяет существование подарка одним запросом к fragment.com (404 — подарка нет)."""
+    response = get_http_client().get(get_fragment_url(collection_name, gift_id))
+    if response.status_code == 404:
+        return False
+    response.raise_for_status()
+    return True
+
+class IdDiscovery:
+    """Верхние границы id коллекций и негативный кэш id, для которых fragment.com отвечает 404.
+
+    Граница ищется экспоненциальными шагами от последней известной, затем бинарным
+    поиском — O(log n) запросов — и перепроверяется раз в interval секунд. Отсутствующие
+    id перепроверяются с экспоненциально растущей паузой от negative_ttl до negative_max_ttl.
+    С store (SqliteStateStore воркеров) состояние общее для всех воркеров и хранится
+    в базе: границы перечитываются перед проверкой, негативный кэш подгружается
+    по диапазону опрашиваемых id, а save() записывает только изменившиеся id.
+    Без store состояние хранится в JSON-файле path.
+    """
+
+    def __init__(self, path=None, interval=600, negative_ttl=300, negative_max_ttl=86400,
+                 max_id=10_000_000, probe=gift_exists, store=None):
+        self.path = path
+        self.store = store
+        self.dirty = set()
+        self.interval = interval
+        self.negative_ttl = negative_ttl
+        self.negative_max_ttl = negative_max_ttl
+        self.max_id = max_id
+        self.probe = probe
+        self._lock = threading.Lock()
+        self.ranges = {}
+        self.not_found = {}
+        if store is not None:
+            self.ranges = store.load_discovery_ranges()
+        elif path and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+            self.ranges = saved.get('ranges', {})
+            self.not_found = {collection_key: {int(gift_id): entry for gift_id, entry in entries.items()}
+                              for collection_key, entries in saved.get('not_found', {}).items()}
+        self.probes = 0
+        self.skipped = 0
+
+    def find_upper_bound(self, collection_name, start_id, known_end=None):
+        """Последний существующий id коллекции или start_id - 1, если подарков нет."""
+        low = high = None
+        if known_end is not None and known_end >= start_id:
+            self.probes += 1
+            if self.probe(collection_name, known_end):
+                low = known_end
+            else:
+                high = known_end
+        if low is None:
+            self.probes += 1
+            if not self.probe(collection_name, start_id):
+                return start_id - 1
+            low = start_id
+        if high is None:
+            step = 1
+            high = low + step
+            while high <= self.max_id:
+                self.probes += 1
+                if not self.probe(collection_name, high):
+                    break
+                low = high
+                step *= 2
+                high = low + step
+            else:
+                return low
+        while high - low > 1:
+            middle = (low + high) // 2
+            self.probes += 1
+            if self.probe(collection_name, middle):
+                low = middle
+            else:
+                high = middle
+        return low
+
+    def end_id(self, collection):
+        """Граница обхода: найденная, но не меньше end_id из config.json."""
+        configured = collection.get('end_id')
+        discovered = self.ranges.get(collection.get('name'), {}).get('end_id')
+        if discovered is None:
+            return configured if configured is not None else collection.get('start_id') - 1
+        return discovered if configured is None else max(configured, discovered)
+
+    def refresh(self, collections, now=None):
+        """Перепроверяет границы коллекций, для которых подошёл срок."""
+        now = time.time() if now is None else now
+        if self.store is not None:
+            # Границу могли только что проверить другие воркеры
+            self.ranges = self.store.load_discovery_ranges()
+        for collection in collections:
+            collection_name = collection.get('name')
+            saved = self.ranges.get(collection_name, {})
+            if now - saved.get('checked_at', 0) < self.interval:
+                continue
+            known_end = saved.get('end_id', collection.get('end_id'))
+            probes = self.probes
+            try:
+                end_id = self.find_upper_bound(collection_name, collection.get('start_id'), known_end)
+            except requests.exceptions.RequestException as e:
+                print(f"Не удалось определить диапазон id коллекции {collection_name}: {e}")
+                continue
+            # Граница не уменьшается: пропуск в нумерации не должен сужать обход
+            end_id = max(end_id, saved.get('end_id', end_id))
+            self.ranges[collection_name] = {'end_id': end_id, 'checked_at': now}
+            if self.store is not None:
+                self.store.save_discovery_range(collection_name, end_id, now)
+            print(f"Диапазон id коллекции {collection_name}: {collection.get('start_id')}–{end_id} "
+                  f"(запросов: {self.probes - probes})")
+
+    def is_missing(self, collection_key, gift_id, now=None):
+        """True, если id недавно отвечал 404 и срок перепроверки ещё не наступил."""
+        entry = self.not_found.get(collection_key, {}).get(gift_id)
+        if entry is None or entry[1] <= (time.time() if now is None else now):
+            return False
+        self.skipped += 1
+        return True
+
+    def record(self, collection_key, gift_id, status, now=None):
+        """Учитывает результат опроса: 'not_found' продлевает паузу, успех снимает id из кэша."""
+        now = time.time() if now is None else now
+        with self._lock:
+            entries = self.not_found.setdefault(collection_key, {})
+            if status == 'not_found':
+                misses = entries.get(gift_id, [0, 0])[0] + 1
+                ttl = min(self.negative_max_ttl, self.negative_ttl * 2 ** (misses - 1))
+                entries[gift_id] = [misses, now + ttl * random.uniform(0.9, 1.1)]
+                self.dirty.add((collection_key, gift_id))
+            elif status != 'error' and entries.pop(gift_id, None) is not None:
+                self.dirty.add((collection_key, gift_id))
+
+    def load_missing(self, jobs):
+        """Подгружает из базы негативный кэш для диапазона id заданий; несохранённые id не затираются."""
+        spans = {}
+        for job in jobs:
+            low, high = spans.get(job[0], (job[2], job[2]))
+            spans[job[0]] = (min(low, job[2]), max(high, job[2]))
+        for collection_key, (start_id, end_id) in spans.items():
+            loaded = self.store.load_discovery_missing(collection_key, start_id, end_id)
+            with self._lock:
+                entries = self.not_found.setdefault(collection_key, {})
+                for gift_id in range(start_id, end_id + 1):
+                    if (collection_key, gift_id) in self.dirty:
+                        continue
+                    if gift_id in loaded:
+                        entries[gift_id] = loaded[gift_id]
+                    else:
+                        entries.pop(gift_id, None)
+
+    def filter_jobs(self, jobs, now=None):
+        """Делит задания на опрашиваемые и пропущенные по негативному кэшу."""
+        now = time.time() if now is None else now
+        if self.store is not None and jobs:
+            self.load_missing(jobs)
+        kept, skipped = [], []
+        for job in jobs:
+            (skipped if self.is_missing(job[0], job[2], now) else kept).append(job)
+        return kept, skipped
+
+    def save(self):
+        if self.store is not None:
+            with self._lock:
+                rows = [(collection_key, gift_id, self.not_found.get(collection_key, {}).get(gift_id))
+                        for collection_key, gift_id in self.dirty]
+                self.dirty.clear()
+            self.store.save_discovery_missing(rows)
+            return
+        if not self.path:
+            return
+        with self._lock:
+            saved = {
+                'ranges': self.ranges,
+                'not_found': {collection_key: {str(gift_id): entry for gift_id, entry in entries.items()}
+                              for collection_key, entries in self.not_found.items() if entries},
+            }
+        write_json_atomic(self.path, saved)
+
+    def report(self):
+        missing = sum(len(entries) for entries in self.not_found.values())
+        print(f"Поиск id: проверочных запросов {self.probes}, в негативном кэше {missing}, "
+              f"пропущено опросов {self.skipped}")
+        self.probes = 0
+        self.skipped = 0
+
+# Инициализация поиска id по config.json ("discovery": {...}); None — диапазоны только из config.json
+def init_discovery(config, store=None):
+    """store — общая база воркеров: состояние хранится в ней, а не в discovery.cache_file."""
+    discovery_config = config.get('discovery', {})
+    if not discovery_config.get('enabled', True):
+        return None
+    return IdDiscovery(
+        discovery_config.get('cache_file', 'discovery.json'),
+        store=store,
+        interval=discovery_config.get('interval_seconds', 600),
+        negative_ttl=discovery_config.get('negative_ttl', 300),
+        negative_max_ttl=discovery_config.get('negative_max_ttl', 86400),
+        max_id=discovery_config.get('max_id', 10_000_000),
+    )
+
+def effective_collections(collections, discovery):
+    """Коллекции из config.json с end_id, расширенным найденной границей."""
+    if discovery is None:
+        return collections
+    return [dict(collection, end_id=discovery.end_id(collection)) for collection in collections]
+
+# Контрольные точки обхода: прогресс цикла переживает падение и перезапуск
+def id_ranges(ids):
+    """Отсортированные id как отрезки [начало, конец]: [1, 2, 3, 7] → [[1, 3], [7, 7]]."""
+    ranges = []
+    for gift_id in sorted(ids):
+        if ranges and ranges[-1][1] == gift_id - 1:
+            ranges[-1][1] = gift_id
+        else:
+            ranges.append([gift_id, gift_id])
+    return ranges
+
+class SweepCheckpoint:
+    """Прогресс текущего цикла в JSON-файле: обработанные id и ещё не опубликованные изменения.
+
+    Контрольная точка пишется атомарно каждые every результатов или interval секунд
+    и удаляется, когда цикл опубликован. Если процесс остановился посреди цикла,
+    первый цикл после запуска пропускает уже обработанные id, а сохранённые, но не
+    опубликованные изменения публикует вместе со своими.
+    """
+
+    def __init__(self, path, every=500, interval=30):
+        self.path = path
+        self.every = every
+        self.interval = interval
+        self.done = {}
+        self.pending = {}
+        self.index_dirty = set()
+        self.results = 0
+        self.saved_at = time.monotonic()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            saved = json.load(f)
+        for collection_key, ranges in saved.get('done', {}).items():
+            self.done[collection_key] = {gift_id for start, end in ranges for gift_id in range(start, end + 1)}
+        for collection_key, ranges in saved.get('pending', {}).items():
+            self.pending[collection_key] = {f"{collection_key}_{gift_id}"
+                                            for start, end in ranges for gift_id in range(start, end + 1)}
+        self.index_dirty = set(saved.get('index_dirty', []))
+        print(f"Продолжение прерванного цикла: обработано {sum(len(ids) for ids in self.done.values())}, "
+              f"не опубликовано {sum(len(keys) for keys in self.pending.values())} подарков.")
+
+    def filter_jobs(self, jobs):
+        """Убирает подарки, обработанные до перезапуска."""
+        if not self.done:
+            return jobs
+        return [job for job in jobs if job[2] not in self.done.get(job[0], ())]
+
+    def mark(self, collection_key, gift_id):
+        """Отмечает обработанный подарок. Возвращает True, если пора писать контрольную точку."""
+        self.done.setdefault(collection_key, set()).add(gift_id)
+        self.results += 1
+        return self.results >= self.every or time.monotonic() - self.saved_at >= self.interval
+
+    def save(self, changed_keys, index_dirty):
+        write_json_atomic(self.path, {
+            'done': {collection_key: id_ranges(ids) for collection_key, ids in self.done.items()},
+            'pending': {collection_key: id_ranges(get_gift_number(key) for key in keys)
+                        for collection_key, keys in changed_keys.items() if keys},
+            'index_dirty': sorted(index_dirty),
+        })
+        self.results = 0
+        self.saved_at = time.monotonic()
+
+    def clear(self):
+        """Цикл опубликован: контрольная точка больше не нужна."""
+        self.done.clear()
+        self.pending.clear()
+        self.index_dirty.clear()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def init_checkpoint(config):
+    state_config = config.get('state', {})
+    checkpoint = SweepCheckpoint(
+        state_config.get('checkpoint_file', 'sweep_checkpoint.json'),
+        every=state_config.get('checkpoint_every', 500),
+        interval=state_config.get('checkpoint_interval_seconds', 30),
+    )
+    checkpoint.load()
+    return checkpoint
+
+# Остановка по SIGTERM (например, при перезапуске контейнера): текущие запросы
+# дорабатываются, новые не начинаются, состояние сохраняется перед выходом
+shutdown_event = threading.Event()
+
+def install_shutdown_handler():
+    # Обработчик сигнала можно установить только из главного потока процесса
+    if threading.current_thread() is not threading.main_thread():
+        return
+
+    def handle(signum, frame):
+        print("Получен сигнал остановки: завершаем текущие запросы и сохраняем состояние...")
+        shutdown_event.set()
+    signal.signal(signal.SIGTERM, handle)
+
+# Общие статические ресурсы страниц: загружаются в бакет один раз и подключаются ссылкой
+STATIC_CSS = """/* Стили для тёмной темы: главная страница коллекции и страницы подарков */
+body {
+    font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
+    background-color: #121212;
+    color: #e0e0e0;
+    margin: 0;
+    padding: 0;
+}
+body.gift-page {
+    padding: 20px;
+}
+a {
+    text-decoration: none;
+    color: inherit;
+}
+
+/* Главная страница коллекции */
+.header {
+    background-color: #1f1f1f;
+    padding: 20px;
+    text-align: center;
+    box-shadow: 0 4px 8px rgba(0,0,0,0.3);
+    position: relative;
+}
+.header h1 {
+    margin: 0;
+    color: #ffffff;
+    font-size: 2em;
+    letter-spacing: 2px;
+}
+.controls {
+    display: flex;
+    justify-content: center;
+    gap: 20px;
+    padding: 20px;
+    flex-wrap: wrap;
+}
+.controls input, .controls select {
+    padding: 10px;
+    border-radius: 8px;
+    border: none;
+    font-size: 16px;
+}
+.gift-grid {
+    display: grid;
+    grid-template-columns: repeat(auto-fill, minmax(200px, 1fr)); /* Адаптивные колонки */
+    gap: 25px;
+    padding: 20px;
+}
+.gift-card {
+    background-color: #1f1f1f;
+    border-radius: 15px;
+    box-shadow: 0 8px 16px rgba(0,0,0,0.3);
+    overflow: hidden;
+    text-align: center;
+    transition: transform 0.3s, box-shadow 0.3s;
+    cursor: pointer;
+}
+.gift-card:hover {
+    transform: scale(1.05);
+    box-shadow: 0 12px 24px rgba(0,0,0,0.4);
+}
+.gift-card img {
+    width: 100%;
+    height: auto;
+}
+.gift-card h3 {
+    margin: 0;
+    padding: 10px;
+    color: #ffffff;
+    white-space: nowrap;
+    overflow: hidden;
+    text-overflow: ellipsis;
+}
+.gift-grid.virtual {
+    display: block;
+    position: relative;
+    padding: 0;
+}
+.gift-grid.virtual .gift-card {
+    position: absolute;
+}
+.gift-grid.virtual .gift-card img {
+    aspect-ratio: 1 / 1;
+    object-fit: cover;
+}
+
+/* Страница подарка */
+.container {
+    max-width: 800px;
+    margin: auto;
+    background-color: #1f1f1f;
+    padding: 20px;
+    border-radius: 15px;
+    box-shadow: 0 4px 8px rgba(0,0,0,0.3);
+    text-align: center;
+    display: flex;
+    flex-direction: column;
+    align-items: center;
+}
+.back-button {
+    background-color: #ff562200;
+    color: #fff;
+    padding: 10px 20px;
+    border-radius: 8px;
+    cursor: pointer;
+    font-size: 16px;
+    margin-bottom: 20px;
+    transition: background-color 0.3s;
+    border: 2px solid #585858;
+    text-decoration: none;
+    align-self: flex-start;
+}
+.back-button:hover {
+    background-color: #000000;
+}
+.gift-title {
+    color: #ffffff;
+    font-size: 2em;
+    margin: 20px 0;
+}
+.animation-container {
+    width: 400px;
+    height: 400px;
+    margin: auto;
+    position: relative;
+    overflow: hidden;
+}
+.animation-container::before {
+    content: '';
+    position: absolute;
+    top: -20px;
+    left: -20px;
+    right: -20px;
+    bottom: -20px;
+    background: radial-gradient(circle, rgba(255,255,255,0.1), rgba(0,0,0,0));
+    filter: blur(20px);
+    z-index: -1;
+}
+.owner-box {
+    background-color: #ff562200;
+    color: #fff;
+    padding: 10px 15px;
+    border-radius: 8px;
+    margin-top: 20px;
+    border: 2px solid #585858;
+}
+.owner {
+    display: flex;
+    align-items: center;
+    justify-content: center;
+}
+.owner img {
+    width: 60px;
+    height: 60px;
+    border-radius: 50%;
+    object-fit: cover;
+    margin-right: 10px;
+}
+.owner-name {
+    font-size: 1.2em;
+    font-weight: bold;
+}
+.description {
+    margin-top: 20px;
+    font-size: 18px;
+    text-align: left;
+}
+.attributes {
+    display: flex;
+    justify-content: center;
+    flex-wrap: wrap;
+    margin-top: 20px;
+    margin-bottom: 20px;
+}
+.attribute-box {
+    background-color: #ff562200;
+    color: #fff;
+    padding: 10px 15px;
+    border-radius: 8px;
+    margin: 5px;
+    min-width: 100px;
+    text-align: center;
+    font-size: 16px;
+    border: 2px solid #585858;
+}
+.attribute-box span {
+    color: #FFD700; /* Золотой цвет для процентов */
+    font-weight: bold;
+}
+
+/* Адаптив для маленьких экранов */
+@media (max-width: 600px) {
+    .controls {
+        flex-direction: column;
+        align-items: center;
+    }
+    .gift-grid {
+        grid-template-columns: repeat(2, minmax(100px, 1fr)); /* Адаптивные колонки */
+    }
+    .gift-card h3 {
+        font-size: 1em;
+    }
+    .animation-container {
+        width: 200px;
+        height: 200px;
+    }
+    .description {
+        font-size: 16px;
+    }
+    .attribute-box {
+        font-size: 14px;
+        min-width: 80px;
+    }
+}
+"""
+
+STATIC_INDEX_JS = """// Виртуализированная сетка подарков: данные берутся из шардированного JSON-манифеста
+(function() {
+    const giftGrid = document.getElementById('giftGrid');
+    const searchInput = document.getElementById('searchInput');
+    const sortSelect = document.getElementById('sortSelect');
+    const facetSelect = document.getElementById('facetSelect');
+    const collection = giftGrid.getAttribute('data-collection');
+    const manifestBase = 'manifest/' + collection + '/';
+    const searchBase = 'search/' + collection + '/';
+
+    const GAP = 25;
+    const PADDING = 20;
+    const CAPTION_HEIGHT = 56;
+    const OVERSCAN_ROWS = 2;
+
+    // Строки манифеста: [id, name, image, rarity]; порядок загрузки — порядок по умолчанию
+    let gifts = [];
+    let visible = [];
+    let layout = {columns: 1, cardWidth: 200, rowHeight: 281};
+    let renderedRange = '';
+    // Ранги редкости по локальным частотам атрибутов: id -> ранг, загружаются при первом выборе
+    let ranks = null;
+    let ranksLoading = false;
+    // Поисковые индексы: атрибут -> значение -> id и владелец -> [имя, id...]; id закодированы разностями
+    let traitIndex = null;
+    let ownerIndex = null;
+    let ownersLoading = false;
+
+    function escapeHtml(value) {
+        return String(value).replace(/[&<>"']/g, function(ch) {
+            return {'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'}[ch];
+        });
+    }
+
+    function computeLayout() {
+        const width = giftGrid.clientWidth - PADDING * 2;
+        const minCard = window.innerWidth <= 600 ? 100 : 200;
+        let columns = Math.max(1, Math.floor((width + GAP) / (minCard + GAP)));
+        if (window.innerWidth <= 600) {
+            columns = 2;
+        }
+        const cardWidth = (width - GAP * (columns - 1)) / columns;
+        layout = {columns: columns, cardWidth: cardWidth, rowHeight: cardWidth + CAPTION_HEIGHT + GAP};
+        const rows = Math.ceil(visible.length / columns);
+        giftGrid.style.height = (rows * layout.rowHeight + PADDING * 2) + 'px';
+        renderedRange = '';
+    }
+
+    function render() {
+        const gridTop = giftGrid.getBoundingClientRect().top + window.scrollY;
+        const viewTop = window.scrollY - gridTop - PADDING;
+        const firstRow = Math.max(0, Math.floor(viewTop / layout.rowHeight) - OVERSCAN_ROWS);
+        const lastRow = Math.ceil((viewTop + window.innerHeight) / layout.rowHeight) + OVERSCAN_ROWS;
+        const start = firstRow * layout.columns;
+        const end = Math.min(visible.length, (lastRow + 1) * layout.columns);
+        const range = start + ':' + end;
+        if (range === renderedRange) {
+            return;
+        }
+        renderedRange = range;
+        const html = [];
+        for (let i = start; i < end; i++) {
+            const gift = visible[i];
+            const row = Math.floor(i / layout.columns);
+            const column = i % layout.columns;
+            const left = PADDING + column * (layout.cardWidth + GAP);
+            const top = PADDING + row * layout.rowHeight;
+            html.push(
+                '<div class="gift-card" style="left:' + left + 'px;top:' + top + 'px;width:' + layout.cardWidth + 'px"'
+                + ' data-id="' + collection + '_' + gift[0] + '" data-rarity="' + gift[3] + '">'
+                + '<a href="gifts/' + collection + '_' + gift[0] + '.html">'
+                + '<img loading="lazy" src="' + escapeHtml(gift[2]) + '" alt="' + escapeHtml(gift[1]) + '">'
+                + '<h3>' + escapeHtml(gift[1]) + '</h3></a></div>'
+            );
+        }
+        giftGrid.innerHTML = html.join('');
+    }
+
+    function decodeIds(deltas, start) {
+        const ids = [];
+        let id = 0;
+        for (let i = start; i < deltas.length; i++) {
+            id += deltas[i];
+            ids.push(id);
+        }
+        return ids;
+    }
+
+    // id подарков, у которых значение атрибута или владелец содержит строку запроса
+    function indexMatches(query) {
+        const ids = new Set();
+        if (traitIndex) {
+            Object.keys(traitIndex).forEach(function(trait) {
+                const values = traitIndex[trait];
+                Object.keys(values).forEach(function(value) {
+                    if (value.toLowerCase().includes(query)) {
+                        decodeIds(values[value], 0).forEach(function(id) { ids.add(id); });
+                    }
+                });
+            });
+        }
+        if (ownerIndex) {
+            const owner = query.replace(/^@/, '');
+            Object.keys(ownerIndex).forEach(function(name) {
+                if (name.includes(owner)) {
+                    decodeIds(ownerIndex[name], 1).forEach(function(id) { ids.add(id); });
+                }
+            });
+        }
+        return ids;
+    }
+
+    // Поиск по номеру (например, Collection-1), названию, атрибутам и владельцу,
+    // фильтр по значению атрибута, сортировка по средней редкости
+    function applyView() {
+        const query = searchInput.value.trim().toLowerCase();
+        const matched = query ? indexMatches(query) : null;
+        let facetIds = null;
+        if (facetSelect.value && traitIndex) {
+            const facet = JSON.parse(facetSelect.value);
+            facetIds = new Set(decodeIds((traitIndex[facet[0]] || {})[facet[1]] || [], 0));
+        }
+        visible = (query || facetIds) ? gifts.filter(function(gift) {
+            if (facetIds && !facetIds.has(gift[0])) {
+                return false;
+            }
+            return !query
+                || (collection + '-' + gift[0]).toLowerCase().includes(query)
+                || (collection + '_' + gift[0]).toLowerCase().includes(query)
+                || String(gift[1]).toLowerCase().includes(query)
+                || matched.has(gift[0]);
+        }) : gifts.slice();
+        if (sortSelect.value === 'asc') {
+            visible.sort(function(a, b) { return a[3] - b[3]; });
+        } else if (sortSelect.value === 'desc') {
+            visible.sort(function(a, b) { return b[3] - a[3]; });
+        } else if (sortSelect.value === 'rank') {
+            if (ranks) {
+                visible.sort(function(a, b) { return (ranks[a[0]] || Number.MAX_SAFE_INTEGER) - (ranks[b[0]] || Number.MAX_SAFE_INTEGER); });
+            } else {
+                loadRanks();
+            }
+        }
+        computeLayout();
+        render();
+    }
+
+    function loadRanks() {
+        if (ranksLoading) {
+            return;
+        }
+        ranksLoading = true;
+        fetch('rarity/' + collection + '/ranks.json', {cache: 'no-cache'})
+            .then(function(response) { return response.json(); })
+            .then(function(data) {
+                ranks = {};
+                data.ids.forEach(function(id, index) { ranks[id] = index + 1; });
+                applyView();
+            })
+            .catch(function() { ranksLoading = false; });
+    }
+
+    function loadTraits() {
+        fetch(searchBase + 'traits.json', {cache: 'no-cache'})
+            .then(function(response) { return response.json(); })
+            .then(function(data) {
+                traitIndex = data.traits;
+                Object.keys(traitIndex).forEach(function(trait) {
+                    const group = document.createElement('optgroup');
+                    group.label = trait;
+                    Object.keys(traitIndex[trait]).forEach(function(value) {
+                        const option = document.createElement('option');
+                        option.value = JSON.stringify([trait, value]);
+                        option.textContent = value + ' (' + traitIndex[trait][value].length + ')';
+                        group.appendChild(option);
+                    });
+                    facetSelect.appendChild(group);
+                });
+                applyView();
+            });
+    }
+
+    // Индекс владельцев может быть большим: загружается при первом обращении к поиску
+    function loadOwners() {
+        if (ownersLoading) {
+            return;
+        }
+        ownersLoading = true;
+        fetch(searchBase + 'owners.json', {cache: 'no-cache'})
+            .then(function(response) { return response.json(); })
+            .then(function(data) {
+                ownerIndex = data.owners;
+                if (searchInput.value.trim()) {
+                    applyView();
+                }
+            })
+            .catch(function() { ownersLoading = false; });
+    }
+
+    let scheduled = false;
+    function scheduleRender() {
+        if (!scheduled) {
+            scheduled = true;
+            window.requestAnimationFrame(function() {
+                scheduled = false;
+                render();
+            });
+        }
+    }
+
+    searchInput.addEventListener('input', applyView);
+    searchInput.addEventListener('focus', loadOwners);
+    sortSelect.addEventListener('change', applyView);
+    facetSelect.addEventListener('change', applyView);
+    window.addEventListener('scroll', scheduleRender, {passive: true});
+    window.addEventListener('resize', function() {
+        computeLayout();
+        render();
+    });
+
+    loadTraits();
+
+    // Шарды загружаются параллельно, сетка обновляется по мере поступления
+    fetch(manifestBase + 'meta.json', {cache: 'no-cache'})
+        .then(function(response) { return response.json(); })
+        .then(function(meta) {
+            const pages = new Array(meta.pages.length);
+            return Promise.all(meta.pages.map(function(page, index) {
+                return fetch(manifestBase + page[0] + '.' + page[1] + '.json')
+                    .then(function(response) { return response.json(); })
+                    .then(function(rows) {
+                        pages[index] = rows;
+                        gifts = [].concat.apply([], pages.filter(Boolean));
+                        applyView();
+                    });
+            }));
+        });
+})();
+"""
+
+# Версия ресурсов в ключах объектов: новые стили получают новый ключ, а объект под старым
+# ключом не меняется, поэтому его можно кэшировать навсегда
+STATIC_VERSION = md5((STATIC_CSS + STATIC_INDEX_JS).encode('utf-8')).hexdigest()[:8]
+STATIC_CSS_KEY = f"static/giftexplorer.{STATIC_VERSION}.css"
+STATIC_INDEX_JS_KEY = f"static/index.{STATIC_VERSION}.js"
+
+class PageTemplate:
+    """Шаблон страницы, один раз разобранный на литералы и поля.
+
+    Поля задаются как в str.format ({name}, {{ — экранированная скобка);
+    рендеринг дописывает части в список, который собирается одним join.
+    """
+
+    def __init__(self, text):
+        self.parts = []
+        for literal, field_name, _, _ in string.Formatter().parse(text):
+            self.parts.append((literal, field_name))
+
+    def render_into(self, out, values):
+        append = out.append
+        for literal, field_name in self.parts:
+            if literal:
+                append(literal)
+            if field_name is not None:
+                append(str(values[field_name]))
+
+    def render(self, **values):
+        out = []
+        self.render_into(out, values)
+        return ''.join(out)
+
+INDEX_PAGE = PageTemplate("""
+    <!DOCTYPE html>
+    <html lang="ru">
+    <head>
+        <meta charset="UTF-8">
+        <title>{collection_name}</title>
+        <link rel="stylesheet" href=""" + STATIC_CSS_KEY + """">
+    </head>
+    <body>
+    <div class="header">
+        <h1>{collection_name}</h1>
+    </div>
+    <div class="controls">
+        <input type="text" id="searchInput" placeholder="Поиск по номеру, названию, атрибуту или владельцу (например, {collection_name}-1)">
+        <select id="facetSelect">
+            <option value="">Все атрибуты</option>
+        </select>
+        <select id="sortSelect">
+            <option value="default">Сортировка по редкости</option>
+            <option value="asc">Редкость ↑</option>
+            <option value="desc">Редкость ↓</option>
+            <option value="rank">Ранг редкости</option>
+        </select>
+    </div>
+        <div class="gift-grid virtual" id="giftGrid" data-collection="{collection_name}"></div>
+        <script src=""" + STATIC_INDEX_JS_KEY + """"></script>
+    </body>
+    </html>
+""")
+
+GIFT_PAGE_HEAD = PageTemplate("""
         <!DOCTYPE html>
         <html lang="ru">
         <head>
             <meta charset="UTF-8">
             <title>{name}</title>
-            <style>
-                /* Ваши стили */
-                body {{
-                    font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-                    background-color: #121212;
-                    color: #e0e0e0;
-                    margin: 0;
-                    padding: 20px;
-                }}
-                .container {{
-                    max-width: 800px;
-                    margin: auto;
-                    background-color: #1f1f1f;
-                    padding: 20px;
-                    border-radius: 15px;
-                    box-shadow: 0 4px 8px rgba(0,0,0,0.3);
-                    text-align: center;
-                    display: flex;
-                    flex-direction: column;
-                    align-items: center;
-                }}
-                .back-button {{
-                    background-color: #ff562200;
-                    color: #fff;
-                    padding: 10px 20px;
-                    border-radius: 8px;
-                    cursor: pointer;
-                    font-size: 16px;
-                    margin-bottom: 20px;
-                    transition: background-color 0.3s;
-                    border: 2px solid #585858;
-                    text-decoration: none;
-                    align-self: flex-start;
-                }}
-                .back-button:hover {{
-                    background-color: #000000;
-                }}
-                .gift-title {{
-                    color: #ffffff;
-                    font-size: 2em;
-                    margin: 20px 0;
-                }}
-                .animation-container {{
-                    width: 400px;
-                    height: 400px;
-                    margin: auto;
-                    position: relative;
-                    overflow: hidden;
-                }}
-                .animation-container::before {{
-                    content: '';
-                    position: absolute;
-                    top: -20px;
-                    left: -20px;
-                    right: -20px;
-                    bottom: -20px;
-                    background: radial-gradient(circle, rgba(255,255,255,0.1), rgba(0,0,0,0));
-                    filter: blur(20px);
-                    z-index: -1;
-                }}
-                .owner-box {{
-                    background-color: #ff562200;
-                    color: #fff;
-                    padding: 10px 15px;
-                    border-radius: 8px;
-                    margin-top: 20px;
-                    border: 2px solid #585858;
-                }}
-                .owner {{
-                    display: flex;
-                    align-items: center;
-                    justify-content: center;
-                }}
-                .owner img {{
-                    width: 60px;
-                    height: 60px;
-                    border-radius: 50%;
-                    object-fit: cover;
-                    margin-right: 10px;
-                }}
-                .owner-name {{
-                    font-size: 1.2em;
-                    font-weight: bold;
-                }}
-                .description {{
-                    margin-top: 20px;
-                    font-size: 18px;
-                    text-align: left;
-                }}
-                .attributes {{
-                    display: flex;
-                    justify-content: center;
-                    flex-wrap: wrap;
-                    margin-top: 20px;
-                    margin-bottom: 20px;
-                }}
-                .attribute-box {{
-                    background-color: #ff562200;
-                    color: #fff;
-                    padding: 10px 15px;
-                    border-radius: 8px;
-                    margin: 5px;
-                    min-width: 100px;
-                    text-align: center;
-                    font-size: 16px;
-                    border: 2px solid #585858;
-                }}
-                .attribute-box span {{
-                    color: #FFD700; /* Золотой цвет для процентов */
-                    font-weight: bold;
-                }}
-                @media (max-width: 600px) {{
-                    .animation-container {{
-                        width: 200px;
-                        height: 200px;
-                    }}
-                    .description {{
-                        font-size: 16px;
-                    }}
-                    .attribute-box {{
-                        font-size: 14px;
-                        min-width: 80px;
-                    }}
-                }}
-            </style>
+            <link rel="stylesheet" href="../""" + STATIC_CSS_KEY + """">
             <script src="https://cdnjs.cloudflare.com/ajax/libs/lottie-web/5.7.13/lottie.min.js"></script>
         </head>
-        <body>
+        <body class="gift-page">
             <div class="container">
                 <a href="../{collection_name}.html" class="back-button">Назад</a>
                 <h1 class="gift-title">{name}</h1>
@@ -539,26 +2950,21 @@ def generate_gift_pages(gift_data, collection_name, yandex_client, bucket_name):
                     </div>
                 </div>
                 <div class="attributes">
-        """
-        # Добавляем атрибуты
-        for attr in attributes:
-            trait_type = attr.get('trait_type', '')
-            value = attr.get('value', '')
-            percent = attr.get('percent', None)
-            if percent is not None and percent != 0.0:
-                html_content += f"""
+""")
+
+GIFT_ATTRIBUTE_WITH_PERCENT = PageTemplate("""
                 <div class="attribute-box">
                     <strong>{trait_type}</strong><br>{value}<br><span>{percent}%</span>
                 </div>
-                """
-            else:
-                html_content += f"""
+""")
+
+GIFT_ATTRIBUTE = PageTemplate("""
                 <div class="attribute-box">
                     <strong>{trait_type}</strong><br>{value}
                 </div>
-                """
-    
-        html_content += f"""
+""")
+
+GIFT_PAGE_TAIL = PageTemplate("""
                 </div>
             </div>
             <script>
@@ -572,129 +2978,2131 @@ def generate_gift_pages(gift_data, collection_name, yandex_client, bucket_name):
             </script>
         </body>
         </html>
-        """
+""")
+
+# Загрузка общих стилей и скриптов (повторно не загружаются, пока не изменятся)
+def publish_static_assets(uploader):
+    uploader.submit(STATIC_CSS_KEY, STATIC_CSS)
+    uploader.submit(STATIC_INDEX_JS_KEY, STATIC_INDEX_JS)
+
+# Генерация главной страницы коллекции: оболочка, карточки рисует static/index.js по манифесту
+def generate_main_page(collection_name, output_file=None):
+    """Генерирует главную страницу коллекции и возвращает её HTML.
+
+    Если передан output_file, страница также записывается на диск.
+    """
+    html = INDEX_PAGE.render(collection_name=collection_name)
+    if output_file:
         with open(output_file, "w", encoding="utf-8") as f:
-            f.write(html_content)
-        print(f"Страница подарка создана или обновлена: {output_file}")
-        
-        # Загрузка файла на Yandex Object Storage
-        upload_to_yandex(yandex_client, bucket_name, output_file, gift_page)
-        
-        # Удаление локального файла после загрузки (опционально)
-        os.remove(output_file)
+            f.write(html)
+    print(f"Главная страница создана или обновлена: {collection_name}.html")
+    return html
+
+# Шардированный JSON-манифест коллекции для главной страницы
+# Хеши и размеры опубликованных страниц манифеста: {collection: {page: (hash, count)}}
+_manifest_pages = {}
+# Хеши предыдущих версий страниц, ещё не удалённых из бакета: {collection: {page: hash}}
+_manifest_previous = {}
+
+def get_gift_number(key):
+    return int(key.rsplit('_', 1)[-1])
+
+def render_manifest_page(gift_data, collection_name, page_number, page_size, rarity=None):
+    """Возвращает строки манифеста [id, name, image, rarity] для id из диапазона страницы."""
+    rows = []
+    first_id = page_number * page_size
+    for gift_id in range(first_id, first_id + page_size):
+        data = gift_data.get(f"{collection_name}_{gift_id}")
+        if not data or "error" in data:
+            continue
+        rows.append([gift_id, data.get('name', 'Подарок'), data.get('image', ''),
+                     round(get_average_rarity(data, rarity), 3)])
+    if asset_mirror:
+        asset_mirror.load(row[2] for row in rows)
+        for row in rows:
+            # Манифест читает главная страница из корня бакета
+            row[2] = asset_mirror.url(row[2], '')
+    return rows
+
+def generate_manifest(gift_data, collection_name, uploader, page_size=1000, only_keys=None, rarity=None):
+    """Публикует манифест коллекции: страницы по page_size id и meta.json со списком страниц.
+
+    Страница загружается под ключом <номер>.<хеш>.json и не перезаписывается, поэтому
+    кэшируется навсегда, а meta.json (no-cache) ссылается на текущие хеши. Предыдущая
+    версия страницы остаётся для клиентов со старым meta.json и удаляется при следующей смене.
+    Если передан only_keys, перестраиваются только страницы с этими подарками;
+    хеши остальных страниц берутся из предыдущего meta.json в памяти.
+    rarity (CollectionRarity) подставляет локальные частоты вместо отсутствующих процентов.
+    """
+    prefix = f"manifest/{collection_name}/"
+    all_pages = {get_gift_number(key) // page_size for key, data in iter_gift_items(gift_data)
+                 if "error" not in data}
+    cached = _manifest_pages.setdefault(collection_name, {})
+    previous = _manifest_previous.setdefault(collection_name, {})
+    # Хеши до перестройки: сменившаяся страница удаляет свою позапрошлую версию
+    published = dict(cached) if cached.get('page_size') == page_size else {}
+    if only_keys is None or cached.get('page_size') != page_size:
+        if cached.get('page_size') not in (None, page_size):
+            previous.clear()
+        cached.clear()
+        cached['page_size'] = page_size
+        dirty_pages = all_pages
+    else:
+        dirty_pages = {get_gift_number(key) // page_size for key in only_keys} | (all_pages - cached.keys())
+    for page_number in sorted(dirty_pages):
+        old = published.get(page_number)
+        rows = render_manifest_page(gift_data, collection_name, page_number, page_size, rarity)
+        if not rows:
+            cached.pop(page_number, None)
+            for stale in {old and old[0], previous.pop(page_number, None)} - {None}:
+                uploader.delete(f"{prefix}{page_number}.{stale}.json")
+            continue
+        body = json.dumps(rows, ensure_ascii=False, separators=(',', ':'))
+        page_hash = md5(body.encode('utf-8')).hexdigest()[:8]
+        cached[page_number] = (page_hash, len(rows))
+        if old and old[0] != page_hash:
+            stale = previous.get(page_number)
+            if stale and stale != page_hash:
+                uploader.delete(f"{prefix}{page_number}.{stale}.json")
+            previous[page_number] = old[0]
+        uploader.submit(f"{prefix}{page_number}.{page_hash}.json", body)
+    pages = [[n, cached[n][0], cached[n][1]] for n in sorted(all_pages) if n in cached]
+    meta = {
+        'collection': collection_name,
+        'page_size': page_size,
+        'total': sum(page[2] for page in pages),
+        'pages': pages,
+    }
+    uploader.submit(f"{prefix}meta.json", json.dumps(meta, separators=(',', ':')))
+    print(f"Манифест {collection_name}: страниц {len(pages)}, перестроено {len(dirty_pages)}")
+    return meta
+
+# Редкость по локальным данным: частоты атрибутов, оценки и ранги всех подарков коллекции
+class CollectionRarity:
+    """Таблицы trait → value → count одной коллекции.
+
+    Значения атрибутов кодируются целыми числами и хранятся по столбцам в array
+    (codes[trait][row], -1 — атрибута нет), счётчики — в array('q'). При изменении
+    атрибутов подарка корректируются только счётчики его строки; оценки всех подарков
+    пересчитываются векторно через NumPy поверх тех же буферов без копирования.
+    Оценка — сумма n / count по атрибутам (отсутствие атрибута считается отдельным
+    значением), ранг 1 — самый редкий подарок, при равенстве — меньший номер.
+    """
+
+    def __init__(self):
+        self.traits = {}
+        self.values = []
+        self.value_names = []
+        self.counts = []
+        self.codes = []
+        self.rows = {}
+        self.keys = []
+        self.numbers = array('q')
+        self.active = array('b')
+        self.size = 0
+
+    def _trait(self, trait_type):
+        column = self.traits.get(trait_type)
+        if column is None:
+            column = self.traits[trait_type] = len(self.values)
+            self.values.append({})
+            self.value_names.append([])
+            self.counts.append(array('q'))
+            self.codes.append(array('i', [-1]) * len(self.keys))
+        return column
+
+    def _code(self, column, value):
+        code = self.values[column].get(value)
+        if code is None:
+            code = self.values[column][value] = len(self.value_names[column])
+            self.value_names[column].append(value)
+            self.counts[column].append(0)
+        return code
+
+    def update(self, key, data):
+        """Учитывает атрибуты подарка. Возвращает True, если счётчики изменились."""
+        codes = {}
+        if data and "error" not in data:
+            for attr in data.get('attributes', []):
+                column = self._trait(attr.get('trait_type', ''))
+                codes[column] = self._code(column, attr.get('value', ''))
+        row = self.rows.get(key)
+        if row is None:
+            if not codes:
+                return False
+            row = self.rows[key] = len(self.keys)
+            self.keys.append(key)
+            self.numbers.append(get_gift_number(key))
+            self.active.append(0)
+            for column in self.codes:
+                column.append(-1)
+        old_codes = {column: self.codes[column][row] for column in range(len(self.codes))
+                     if self.codes[column][row] >= 0}
+        if old_codes == codes and bool(self.active[row]) == bool(codes):
+            return False
+        for column, code in old_codes.items():
+            self.counts[column][code] -= 1
+            self.codes[column][row] = -1
+        for column, code in codes.items():
+            self.counts[column][code] += 1
+            self.codes[column][row] = code
+        self.size += bool(codes) - self.active[row]
+        self.active[row] = 1 if codes else 0
+        return True
+
+    def frequency(self, trait_type, value):
+        """Доля подарков коллекции с этим значением атрибута, в процентах."""
+        column = self.traits.get(trait_type)
+        code = self.values[column].get(value) if column is not None else None
+        if code is None or not self.size:
+            return 0.0
+        return self.counts[column][code] * 100 / self.size
+
+    def scores(self):
+        """Оценки редкости по строкам (0 — подарка нет)."""
+        size = self.size
+        if np is not None:
+            total = np.zeros(len(self.keys))
+            for column in range(len(self.codes)):
+                counts = np.frombuffer(self.counts[column], dtype=np.int64) if self.counts[column] else np.zeros(0, np.int64)
+                counts = np.append(counts, size - counts.sum())
+                codes = np.frombuffer(self.codes[column], dtype=np.int32) if self.keys else np.zeros(0, np.int32)
+                frequencies = counts[np.where(codes < 0, len(counts) - 1, codes)]
+                total += size / np.maximum(frequencies, 1)
+            total[np.frombuffer(self.active, dtype=np.int8) == 0] = 0
+            return total
+        total = [0.0] * len(self.keys)
+        for column in range(len(self.codes)):
+            missing = size - sum(self.counts[column])
+            counts = self.counts[column]
+            for row, code in enumerate(self.codes[column]):
+                total[row] += size / max(counts[code] if code >= 0 else missing, 1)
+        return [score if self.active[row] else 0.0 for row, score in enumerate(total)]
+
+    def ranking(self):
+        """Строки подарков в порядке ранга и их оценки."""
+        scores = self.scores()
+        if np is not None:
+            rows = np.flatnonzero(np.frombuffer(self.active, dtype=np.int8)) if self.keys else np.zeros(0, np.int64)
+            numbers = np.frombuffer(self.numbers, dtype=np.int64)[rows] if self.keys else np.zeros(0, np.int64)
+            order = rows[np.lexsort((numbers, -scores[rows]))]
+            return order.tolist(), scores[order].tolist()
+        order = sorted((row for row in range(len(self.keys)) if self.active[row]),
+                       key=lambda row: (-scores[row], self.numbers[row]))
+        return order, [scores[row] for row in order]
+
+class RarityEngine:
+    """CollectionRarity для каждой коллекции с инкрементальным обновлением из all_data."""
+
+    def __init__(self, top_n=100):
+        self.top_n = top_n
+        self.collections = {}
+        self.published = {}
+
+    def get(self, collection_key):
+        return self.collections.get(collection_key)
+
+    def update(self, collection_key, gift_data, only_keys=None):
+        """Обновляет таблицы по подаркам only_keys (None — вся коллекция). True — частоты изменились."""
+        rarity = self.collections.get(collection_key)
+        if rarity is None:
+            rarity = self.collections[collection_key] = CollectionRarity()
+            only_keys = None
+        changed = False
+        if only_keys is None:
+            for key, data in iter_gift_items(gift_data):
+                changed |= rarity.update(key, data)
+        else:
+            for key in only_keys:
+                changed |= rarity.update(key, gift_data.get(key))
+        return changed or collection_key not in self.published
+
+    def publish(self, collection_key, gift_data, uploader):
+        """Публикует ранги всех подарков и топ-N самых редких рядом с главной страницей."""
+        rarity = self.collections[collection_key]
+        with get_metrics().timer('rarity'):
+            order, scores = rarity.ranking()
+        prefix = f"rarity/{collection_key}/"
+        uploader.submit(f"{prefix}ranks.json", json.dumps({
+            'collection': collection_key,
+            'total': len(order),
+            # ids[i] — номер подарка с рангом i + 1
+            'ids': [rarity.numbers[row] for row in order],
+            'scores': [round(score, 3) for score in scores],
+        }, separators=(',', ':')))
+        top = []
+        if asset_mirror:
+            asset_mirror.load(gift_data.get(rarity.keys[row], {}).get('image', '') for row in order[:self.top_n])
+        for rank, (row, score) in enumerate(zip(order[:self.top_n], scores), start=1):
+            key = rarity.keys[row]
+            data = gift_data.get(key, {})
+            top.append({
+                'rank': rank,
+                'id': rarity.numbers[row],
+                'name': data.get('name', ''),
+                'image': asset_url(data.get('image', '')),
+                'gift_page': data.get('gift_page', ''),
+                'score': round(score, 3),
+                'attributes': [
+                    {'trait_type': attr.get('trait_type', ''), 'value': attr.get('value', ''),
+                     'frequency': round(rarity.frequency(attr.get('trait_type', ''), attr.get('value', '')), 3)}
+                    for attr in data.get('attributes', [])
+                ],
+            })
+        uploader.submit(f"{prefix}top.json", json.dumps({
+            'collection': collection_key,
+            'total': len(order),
+            'top': top,
+        }, ensure_ascii=False, separators=(',', ':')))
+        self.published[collection_key] = True
+        print(f"Редкость {collection_key}: ранжировано {len(order)} подарков, топ-{len(top)} опубликован")
+
+def init_rarity_engine(config):
+    return RarityEngine(top_n=config.get('rarity', {}).get('top_n', 100))
+
+# Инвертированные индексы для поиска на главной странице: значение атрибута → id и владелец → id
+def normalize_owner(owner):
+    return ' '.join(str(owner).lstrip('@').split()).casefold()
+
+def delta_encode(ids):
+    """Отсортированные id как первый id и разности соседних: [5, 7, 12] → [5, 2, 5]."""
+    encoded = []
+    previous = 0
+    for gift_id in sorted(ids):
+        encoded.append(gift_id - previous)
+        previous = gift_id
+    return encoded
+
+class CollectionSearchIndex:
+    """Постинги одной коллекции с инкрементальным обновлением по изменившимся подаркам."""
+
+    def __init__(self):
+        self.traits = {}
+        self.owners = {}
+        self.owner_names = {}
+        # gift_id -> ((trait_type, value), ...), нормализованный владелец: для удаления старых постингов
+        self.entries = {}
+
+    def update(self, gift_id, data):
+        """Переиндексирует подарок. Возвращает множество изменившихся индексов ('traits', 'owners')."""
+        if data and "error" not in data:
+            attributes = tuple(sorted({(attr.get('trait_type', ''), attr.get('value', ''))
+                                       for attr in data.get('attributes', [])}))
+            owner_name = data.get('Owner') or ''
+            entry = (attributes, normalize_owner(owner_name))
+        else:
+            entry = None
+            owner_name = ''
+        old = self.entries.get(gift_id)
+        if old == entry:
+            return set()
+        old_attributes, old_owner = old or ((), '')
+        attributes, owner = entry or ((), '')
+        changed = set()
+        if old_attributes != attributes:
+            for trait_type, value in old_attributes:
+                postings = self.traits[trait_type][value]
+                postings.discard(gift_id)
+                if not postings:
+                    del self.traits[trait_type][value]
+            for trait_type, value in attributes:
+                self.traits.setdefault(trait_type, {}).setdefault(value, set()).add(gift_id)
+            changed.add('traits')
+        if old_owner != owner:
+            if old_owner:
+                self.owners[old_owner].discard(gift_id)
+                if not self.owners[old_owner]:
+                    del self.owners[old_owner]
+                    del self.owner_names[old_owner]
+            if owner:
+                self.owners.setdefault(owner, set()).add(gift_id)
+                self.owner_names.setdefault(owner, owner_name)
+            changed.add('owners')
+        if entry is None:
+            self.entries.pop(gift_id, None)
+        else:
+            self.entries[gift_id] = entry
+        return changed
+
+    def render_traits(self, collection_key):
+        return json.dumps({
+            'collection': collection_key,
+            'traits': {trait_type: {value: delta_encode(ids) for value, ids in sorted(values.items())}
+                       for trait_type, values in sorted(self.traits.items())},
+        }, ensure_ascii=False, separators=(',', ':'))
+
+    def render_owners(self, collection_key):
+        # Ключ — нормализованное имя для поиска, первый элемент — имя для отображения
+        return json.dumps({
+            'collection': collection_key,
+            'owners': {owner: [self.owner_names[owner]] + delta_encode(ids)
+                       for owner, ids in sorted(self.owners.items())},
+        }, ensure_ascii=False, separators=(',', ':'))
+
+class SearchIndexer:
+    """Поисковые индексы коллекций: search/<коллекция>/traits.json и owners.json."""
+
+    def __init__(self):
+        self.collections = {}
+
+    def update(self, collection_key, gift_data, only_keys=None):
+        """Обновляет индекс по only_keys (None — вся коллекция). Возвращает изменившиеся индексы."""
+        index = self.collections.get(collection_key)
+        changed = set()
+        if index is None:
+            index = self.collections[collection_key] = CollectionSearchIndex()
+            only_keys = None
+            # Первая публикация после запуска: оба индекса, даже если коллекция пуста
+            changed = {'traits', 'owners'}
+        if only_keys is None:
+            stale = set(index.entries)
+            for key, data in iter_gift_items(gift_data):
+                gift_id = get_gift_number(key)
+                stale.discard(gift_id)
+                changed |= index.update(gift_id, data)
+            for gift_id in stale:
+                changed |= index.update(gift_id, None)
+        else:
+            for key in only_keys:
+                changed |= index.update(get_gift_number(key), gift_data.get(key))
+        return changed
+
+    def publish(self, collection_key, changed, uploader):
+        index = self.collections[collection_key]
+        prefix = f"search/{collection_key}/"
+        with get_metrics().timer('render', artifact='search'):
+            if 'traits' in changed:
+                uploader.submit(f"{prefix}traits.json", index.render_traits(collection_key))
+            if 'owners' in changed:
+                uploader.submit(f"{prefix}owners.json", index.render_owners(collection_key))
+        print(f"Поисковый индекс {collection_key}: значений атрибутов "
+              f"{sum(len(values) for values in index.traits.values())}, владельцев {len(index.owners)}")
+
+def init_search_indexer(config):
+    if not config.get('search', {}).get('enabled', True):
+        return None
+    return SearchIndexer()
+
+# Зеркало изображений и Lottie-анимаций: каждый файл скачивается один раз и хранится
+# в бакете под ключом по содержимому, страницы и JSON ссылаются на копию в бакете
+ASSET_FIELDS = ('image', 'lottie', 'Owner_avatar')
+ASSET_EXTENSIONS = {
+    'image/webp': '.webp',
+    'image/png': '.png',
+    'image/jpeg': '.jpg',
+    'image/gif': '.gif',
+    'application/json': '.json',
+}
+
+class AssetMirror:
+    """Копии внешних файлов подарков под ключами assets/<sha256>.<расширение>.
+
+    Соответствие «исходный URL → ключ» хранится в хранилище состояния и
+    подгружается по мере надобности; одинаковое содержимое разных URL
+    загружается в бакет один раз. Пока файл не скопирован (или не скачался),
+    страницы ссылаются на исходный URL.
+    Ранее опубликованные подарки переиздаются пачками по backfill_batch за цикл,
+    курсор по id хранится в backfill_file; подарки с нескачавшимися файлами
+    переиздаются повторно через retry_seconds, но не больше max_attempts раз.
+    """
+
+    def __init__(self, uploader, store, workers=8, base_url='', backfill_file='assets_backfill.json',
+                 backfill_batch=500, retry_seconds=600, max_attempts=3):
+        self.uploader = uploader
+        self.store = store
+        self.workers = workers
+        self.base_url = base_url
+        self.backfill_file = backfill_file
+        self.backfill_batch = backfill_batch
+        self.retry_seconds = retry_seconds
+        self.max_attempts = max_attempts
+        self.keys = {}
+        self.failures = {}
+        self.retry = {}
+        self.uploaded = set()
+        self.backfill = {'cursors': {}, 'done': []}
+        self.downloaded = self.deduplicated = self.failed = self.bytes = 0
+        if backfill_file and os.path.exists(backfill_file):
+            with open(backfill_file, "r", encoding="utf-8") as f:
+                self.backfill = json.load(f)
+
+    @staticmethod
+    def gift_urls(data):
+        return [data.get(field) for field in ASSET_FIELDS
+                if str(data.get(field) or '').startswith(('http://', 'https://'))]
+
+    def load(self, urls):
+        """Подгружает из хранилища ключи уже скопированных URL."""
+        missing = [url for url in set(urls) if url not in self.keys]
+        if missing:
+            self.keys.update(self.store.load_assets(missing))
+
+    def url(self, source, prefix=None):
+        """Ссылка на копию в бакете или исходный URL, если копии ещё нет.
+
+        prefix — путь от страницы до корня бакета ('' для страниц в корне, '../' для
+        gifts/*.html), не используется, если задан assets.base_url. prefix=None — ссылка
+        для JSON и выгрузок, которые читают не только наши страницы: относительный ключ
+        там не разрешится, поэтому без assets.base_url остаётся исходный URL.
+        """
+        object_key = self.keys.get(source)
+        if object_key is None:
+            return source
+        if self.base_url:
+            return self.base_url + object_key
+        return source if prefix is None else prefix + object_key
+
+    def mirror(self, collection_key, gift_data, keys=None):
+        """Скачивает и загружает в бакет ещё не скопированные файлы подарков keys (None — всех)."""
+        gifts = [(key, data) for key, data in iter_gift_items(gift_data, keys) if "error" not in data]
+        self.load(url for _, data in gifts for url in self.gift_urls(data))
+        now = time.time()
+        pending = [url for url in {url for _, data in gifts for url in self.gift_urls(data)}
+                   if url not in self.keys and self._can_retry(url, now)]
+        if pending:
+            rows = []
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for url, fetched in zip(pending, executor.map(self._download, pending)):
+                    if fetched is None:
+                        count, _ = self.failures.get(url, (0, 0))
+                        self.failures[url] = (count + 1, now)
+                        continue
+                    object_key, body = fetched
+                    if object_key in self.uploaded:
+                        self.deduplicated += 1
+                    else:
+                        self.uploaded.add(object_key)
+                        self.uploader.submit(object_key, body)
+                    self.keys[url] = object_key
+                    self.failures.pop(url, None)
+                    rows.append((url, object_key))
+            if rows:
+                self.store.save_assets(rows)
+        # Подарки с нескопированными файлами будут переизданы, когда подойдёт срок повтора
+        retry = self.retry.setdefault(collection_key, {})
+        for key, data in gifts:
+            failed = [url for url in self.gift_urls(data) if url not in self.keys and url in self.failures]
+            if failed and any(self.failures[url][0] < self.max_attempts for url in failed):
+                retry[key] = now + self.retry_seconds
+            else:
+                retry.pop(key, None)
+
+    def _can_retry(self, url, now):
+        count, last_attempt = self.failures.get(url, (0, 0))
+        return count < self.max_attempts and now - last_attempt >= self.retry_seconds
+
+    def _download(self, url):
+        """(ключ объекта, содержимое) или None, если файл не удалось скачать."""
+        try:
+            with get_metrics().timer('asset_download', host=urlsplit(url).hostname):
+                response = get_http_client().get(url)
+                response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            print(f"Не удалось скачать {url}: {e}")
+            get_metrics().inc('errors_total', category='asset', host=urlsplit(url).hostname)
+            self.failed += 1
+            return None
+        body = response.content
+        content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+        extension = ASSET_EXTENSIONS.get(content_type)
+        if extension is None:
+            extension = os.path.splitext(urlsplit(url).path)[1].lower()
+            if extension not in CONTENT_TYPES:
+                extension = ''
+        self.downloaded += 1
+        self.bytes += len(body)
+        return f"assets/{sha256(body).hexdigest()[:32]}{extension}", body
+
+    def take_backfill(self, collection_key, gift_data):
+        """Ключи подарков для переиздания: срок повтора наступил или очередная пачка старых подарков."""
+        now = time.time()
+        retry = self.retry.get(collection_key, {})
+        keys = {key for key, due in retry.items() if due <= now}
+        if collection_key in self.backfill['done']:
+            return keys
+        cursor = self.backfill['cursors'].get(collection_key, 0)
+        numbers = sorted(gift_id for gift_id in (get_gift_number(key) for key in gift_data) if gift_id > cursor)
+        batch = numbers[:self.backfill_batch]
+        keys.update(f"{collection_key}_{gift_id}" for gift_id in batch)
+        if batch:
+            self.backfill['cursors'][collection_key] = batch[-1]
+        if len(numbers) <= self.backfill_batch:
+            # Новые подарки получают копии файлов при первой публикации
+            self.backfill['done'].append(collection_key)
+        return keys
+
+    def save(self):
+        if self.backfill_file:
+            write_json_atomic(self.backfill_file, self.backfill)
+
+    def report(self):
+        print(f"Зеркало файлов: скачано {self.downloaded} ({self.bytes / 1024:.1f} КБ), "
+              f"совпало по содержимому {self.deduplicated}, ошибок {self.failed}")
+        self.downloaded = self.deduplicated = self.failed = self.bytes = 0
+
+asset_mirror = None
+
+# Инициализация зеркала файлов ("assets": {"enabled": false} — ссылки на исходные URL)
+def init_asset_mirror(config, uploader, state_store):
+    global asset_mirror
+    assets_config = config.get('assets', {})
+    if not assets_config.get('enabled', True):
+        asset_mirror = None
+        return None
+    asset_mirror = AssetMirror(
+        uploader,
+        state_store,
+        workers=assets_config.get('workers', 8),
+        base_url=assets_config.get('base_url', ''),
+        backfill_file=assets_config.get('backfill_file', 'assets_backfill.json'),
+        backfill_batch=assets_config.get('backfill_batch', 500),
+        retry_seconds=assets_config.get('retry_seconds', 600),
+        max_attempts=assets_config.get('max_attempts', 3),
+    )
+    return asset_mirror
+
+def get_asset_mirror():
+    return asset_mirror
+
+def asset_url(source, prefix=None):
+    """Ссылка на копию файла в бакете, если зеркало включено и файл уже скопирован."""
+    return asset_mirror.url(source, prefix) if asset_mirror and source else source
+
+def mirrored_gift_dict(data):
+    """gift_as_dict с внешними файлами, заменёнными ссылками на их копии в бакете."""
+    data = gift_as_dict(data)
+    if asset_mirror is None:
+        return data
+    data = dict(data)
+    for field in ASSET_FIELDS:
+        if data.get(field):
+            data[field] = asset_mirror.url(data[field])
+    return data
+
+def render_gift_page(data, collection_name):
+    """Возвращает HTML страницы подарка."""
+    parts = []
+    GIFT_PAGE_HEAD.render_into(parts, {
+        'name': data.get('name', 'Подарок'),
+        'collection_name': collection_name,
+        'description': data.get('description', ''),
+        'owner_avatar': asset_url(data.get('Owner_avatar', DEFAULT_OWNER_AVATAR), '../'),
+        'owner_name': data.get('Owner', 'User'),
+    })
+    # Добавляем атрибуты
+    for attr in data.get('attributes', []):
+        values = {
+            'trait_type': attr.get('trait_type', ''),
+            'value': attr.get('value', ''),
+            'percent': attr.get('percent', None),
+        }
+        if values['percent'] is not None and values['percent'] != 0.0:
+            GIFT_ATTRIBUTE_WITH_PERCENT.render_into(parts, values)
+        else:
+            GIFT_ATTRIBUTE.render_into(parts, values)
+    GIFT_PAGE_TAIL.render_into(parts, {'lottie_url': asset_url(data.get('lottie', ''), '../')})
+    return ''.join(parts)
+
+# Генерация отдельных страниц подарков
+def generate_gift_pages(gift_data, collection_name, uploader, only_keys=None):
+    """Генерирует отдельные страницы для каждого подарка и загружает их на Yandex.
+
+    Если передан only_keys, обрабатываются только подарки с этими ключами.
+    """
+    for gift_id, data in iter_gift_items(gift_data, only_keys):
+        if "error" in data:
+            print(f"Пропуск подарка {gift_id} из-за ошибки: {data['error']}")
+            continue
+        gift_page = data.get('gift_page', '')
+        if not gift_page:
+            continue
+        # Загрузка страницы на Yandex Object Storage
+        uploader.submit(gift_page, render_gift_page(data, collection_name))
 
 # Генерация JSON-файлов для будущего использования
-def generate_json_files(gift_data, collection_name, yandex_client, bucket_name):
-    """Сохраняет данные подарков в JSON-файлы и загружает их на Yandex."""
-    json_output_dir = 'json'
-    os.makedirs(json_output_dir, exist_ok=True)
-    for gift_id, data in gift_data.items():
+def generate_json_files(gift_data, collection_name, uploader, only_keys=None):
+    """Сериализует данные подарков в JSON и загружает их на Yandex.
+
+    Если передан only_keys, обрабатываются только подарки с этими ключами.
+    """
+    for gift_id, data in iter_gift_items(gift_data, only_keys):
         if "error" in data:
             continue
-        json_file = os.path.join(json_output_dir, f"{collection_name}_{gift_id}.json")
-        with open(json_file, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=4)
-        # Загрузка JSON-файла на Yandex
+        # Загрузка JSON на Yandex
         object_key = f"json/{collection_name}_{gift_id}.json"
-        upload_to_yandex(yandex_client, bucket_name, json_file, object_key)
-        # Удаление локального JSON-файла после загрузки (опционально)
-        os.remove(json_file)
+        uploader.submit(object_key, json.dumps(mirrored_gift_dict(data), ensure_ascii=False, indent=4))
+
+# Выгрузка коллекции одним объектом: NDJSON и колоночный файл (Parquet или Arrow)
+EXPORT_FIELDS = ('name', 'description', 'image', 'lottie', 'Owner', 'Owner_avatar', 'sender_name',
+                 'sender_telegram_id', 'recipient_name', 'recipient_telegram_id', 'date', 'gift_page')
+
+def write_ndjson_export(gifts, out):
+    """Пишет подарки в out построчно и возвращает MD5 содержимого."""
+    digest = md5()
+    for gift_id, data in gifts:
+        line = json.dumps({'id': gift_id, **mirrored_gift_dict(data)}, ensure_ascii=False, separators=(',', ':')).encode('utf-8') + b'\n'
+        digest.update(line)
+        out.write(line)
+    return digest.hexdigest()
+
+def build_columnar_export(gifts, file_format):
+    """Таблица pyarrow: поля подарка и по два столбца на атрибут (значение и процент)."""
+    columns = {'id': [gift_id for gift_id, _ in gifts]}
+    for field in EXPORT_FIELDS:
+        columns[field] = [None if data.get(field) is None else str(data.get(field)) for _, data in gifts]
+        if field in ASSET_FIELDS:
+            # Ссылки на копии файлов в бакете, как в JSON подарков
+            columns[field] = [value and asset_url(value) for value in columns[field]]
+    traits = {}
+    for row, (_, data) in enumerate(gifts):
+        for attr in data.get('attributes', []):
+            trait_type = attr.get('trait_type', '')
+            if trait_type not in traits:
+                traits[trait_type] = ([None] * len(gifts), [None] * len(gifts))
+            values, percents = traits[trait_type]
+            values[row] = attr.get('value', '')
+            percents[row] = float(attr.get('percent') or 0.0)
+    for trait_type in sorted(traits):
+        columns[trait_type], columns[f"{trait_type}_percent"] = traits[trait_type]
+    table = pa.table({name: pa.array(values, type=pa.int64() if name == 'id' else None)
+                      for name, values in columns.items()})
+    out = pa.BufferOutputStream()
+    if file_format == 'parquet':
+        pq.write_table(table, out, compression='zstd')
+    else:
+        with pa.ipc.new_file(out, table.schema, options=pa.ipc.IpcWriteOptions(compression='zstd')) as writer:
+            writer.write_table(table)
+    return out.getvalue().to_pybytes()
+
+class CollectionExporter:
+    """Публикует коллекцию целиком: export/<коллекция>/<коллекция>.<версия>.<формат> и latest.json.
+
+    Версия — префикс MD5 NDJSON-выгрузки, поэтому файлы неизменяемы и кэшируются
+    надолго, а latest.json (no-cache) указывает на текущую версию и перечисляет
+    хранимые. Коллекция выгружается не чаще раза в min_interval_seconds; в бакете
+    остаются keep_versions последних версий, более старые удаляются. Время выгрузки
+    и хранимые версии сохраняются в state_file.
+    """
+
+    def __init__(self, formats, min_interval_seconds=900, keep_versions=3, state_file='export_state.json'):
+        self.formats = formats
+        self.min_interval_seconds = min_interval_seconds
+        self.keep_versions = max(keep_versions, 1)
+        self.state_file = state_file
+        self.state = {}
+        if state_file and os.path.exists(state_file):
+            with open(state_file, "r", encoding="utf-8") as f:
+                self.state = json.load(f)
+
+    def due(self, collection_name):
+        exported_at = self.state.get(collection_name, {}).get('exported_at', 0)
+        return time.time() - exported_at >= self.min_interval_seconds
+
+    def export(self, gift_data, collection_name, uploader):
+        """Выгружает коллекцию, если подошло время; возвращает файлы версии или None."""
+        if not self.due(collection_name):
+            return None
+        state = self.state.setdefault(collection_name, {'versions': []})
+        state['exported_at'] = time.time()
+        gifts = sorted((get_gift_number(key), data) for key, data in iter_gift_items(gift_data) if "error" not in data)
+        if asset_mirror:
+            asset_mirror.load(url for _, data in gifts for url in AssetMirror.gift_urls(data))
+        prefix = f"export/{collection_name}/"
+        # NDJSON пишется во временный файл (сразу сжатым, если загрузчик сжимает gzip)
+        with tempfile.TemporaryFile() as ndjson:
+            ndjson_kwargs = {}
+            if uploader.compression == 'gzip':
+                with gzip.GzipFile(fileobj=ndjson, mode='wb', compresslevel=uploader.compression_level, mtime=0) as out:
+                    version = write_ndjson_export(gifts, out)[:12]
+                ndjson_kwargs['ContentEncoding'] = 'gzip'
+            else:
+                version = write_ndjson_export(gifts, ndjson)[:12]
+            versions = state['versions']
+            if versions and versions[0]['version'] == version:
+                self.save()
+                print(f"Выгрузка {collection_name}: версия {version} не изменилась")
+                return versions[0]['files']
+            files = {}
+            for file_format in self.formats:
+                put_kwargs = {}
+                if file_format == 'ndjson':
+                    ndjson.seek(0)
+                    body = ndjson.read()
+                    put_kwargs = ndjson_kwargs
+                elif file_format in ('parquet', 'arrow'):
+                    if pa is None:
+                        print(f"Для выгрузки {file_format} нужен пакет pyarrow, формат пропущен.")
+                        continue
+                    body = build_columnar_export(gifts, file_format)
+                else:
+                    print(f"Неизвестный формат выгрузки: {file_format}")
+                    continue
+                object_key = f"{prefix}{collection_name}.{version}.{file_format}"
+                uploader.submit(object_key, body, **put_kwargs)
+                files[file_format] = {'key': object_key, 'bytes': len(body), 'md5': md5(body).hexdigest()}
+        # Возврат к одной из хранимых версий не создаёт дубликат в списке
+        versions = [{'version': version, 'count': len(gifts), 'files': files}] + [
+            kept for kept in versions if kept['version'] != version]
+        state['versions'], pruned = versions[:self.keep_versions], versions[self.keep_versions:]
+        for old in pruned:
+            for file_info in old['files'].values():
+                uploader.delete(file_info['key'])
+        uploader.submit(f"{prefix}latest.json", json.dumps({
+            'collection': collection_name,
+            'version': version,
+            'count': len(gifts),
+            'files': files,
+            'versions': state['versions'],
+        }, separators=(',', ':')))
+        self.save()
+        print(f"Выгрузка {collection_name}: {len(gifts)} подарков, версия {version}, форматы {', '.join(files)}"
+              + (f", удалено старых версий {len(pruned)}" if pruned else ""))
+        return files
+
+    def save(self):
+        if self.state_file:
+            write_json_atomic(self.state_file, self.state)
+
+def init_export(config):
+    """Настройки выгрузки: (CollectionExporter или None, если выключена; загружать ли JSON каждого подарка)."""
+    export_config = config.get('export', {})
+    exporter = None
+    if export_config.get('enabled', False):
+        exporter = CollectionExporter(
+            export_config.get('formats', ['ndjson', 'parquet']),
+            min_interval_seconds=export_config.get('min_interval_seconds', 900),
+            keep_versions=export_config.get('keep_versions', 3),
+            state_file=export_config.get('state_file', 'export_state.json'),
+        )
+    return exporter, export_config.get('per_gift_json', True)
+
+# Лента изменений: события о каждом изменившемся подарке в NDJSON-сегментах
+def make_change_event(collection_key, gift_id, fields, old_data, new_data):
+    """Событие ленты без seq: номер присваивает ChangeLog.append."""
+    return {
+        'ts': round(time.time(), 3),
+        'collection': collection_key,
+        'gift_id': gift_id,
+        'fields': sorted(fields),
+        'old_owner': old_data.get('Owner') if old_data and "error" not in old_data else None,
+        'new_owner': new_data.get('Owner'),
+    }
+
+class ChangeLog:
+    """Журнал событий изменения подарков, разбитый на сегменты NDJSON.
+
+    Событие: {"seq", "ts", "collection", "gift_id", "fields", "old_owner", "new_owner"},
+    seq растёт на единицу без пропусков. Локально сегменты лежат в directory файлами
+    <первый seq>.ndjson и только дописываются; последний сегмент открыт и закрывается,
+    когда в нём segment_events событий или он старше segment_seconds.
+    В бакете закрытые сегменты неизменяемы (changelog/<первый>-<последний>.ndjson),
+    открытый публикуется как changelog/current.ndjson, а changelog/cursor.json
+    перечисляет их с диапазонами seq: потребитель помнит свой последний seq
+    и скачивает только сегменты после него. Хранится max_segments последних сегментов:
+    более старые удаляются и локально, и из бакета.
+    """
+
+    def __init__(self, directory='changelog', segment_events=10000, segment_seconds=3600, max_segments=168):
+        self.directory = directory
+        self.segment_events = segment_events
+        self.segment_seconds = segment_seconds
+        self.max_segments = max_segments
+        self._lock = threading.Lock()
+        self.buffer = []
+        self.published = set()
+        self.pruned = []
+        os.makedirs(directory, exist_ok=True)
+        self.segments = sorted(int(name.split('.')[0]) for name in os.listdir(directory)
+                               if name.endswith('.ndjson') and name.split('.')[0].isdigit())
+        self.next_seq = 1
+        self.open_count = 0
+        self.open_started = None
+        if self.segments:
+            with open(self.segment_path(self.segments[-1]), "r", encoding="utf-8") as f:
+                lines = [line for line in f if line.strip()]
+            self.open_count = len(lines)
+            self.next_seq = self.segments[-1] + len(lines)
+            if lines:
+                self.open_started = json.loads(lines[0])['ts']
+        # Первый цикл после запуска публикует cursor.json в любом случае
+        self.dirty = True
+
+    def segment_path(self, first_seq):
+        return os.path.join(self.directory, f"{first_seq:012d}.ndjson")
+
+    def record(self, collection_key, gift_id, fields, old_data, new_data):
+        """Добавляет событие об изменении подарка; на диск оно попадает при flush()."""
+        self.append(make_change_event(collection_key, gift_id, fields, old_data, new_data))
+
+    def append(self, event):
+        """Добавляет готовое событие (из make_change_event или журнала воркеров)."""
+        with self._lock:
+            self.buffer.append({'seq': self.next_seq, **event})
+            self.next_seq += 1
+
+    @property
+    def journal_cursor_path(self):
+        return os.path.join(self.directory, "journal_cursor.json")
+
+    def load_journal_cursor(self):
+        """seq журнала gift_changes, до которого события публикатора уже в ленте (None — не сохранён)."""
+        if not os.path.exists(self.journal_cursor_path):
+            return None
+        with open(self.journal_cursor_path, "r", encoding="utf-8") as f:
+            return json.load(f)['seq']
+
+    def save_journal_cursor(self, seq):
+        """Сохраняется после flush(): после сбоя события могут повториться, но не пропасть."""
+        write_json_atomic(self.journal_cursor_path, {'seq': seq})
+
+    def flush(self):
+        """Дописывает накопленные события в открытый сегмент, при необходимости начиная новый."""
+        with self._lock:
+            events, self.buffer = self.buffer, []
+        if not events:
+            return
+        writes = []
+        for event in events:
+            if not self.segments or self.open_count >= self.segment_events or (
+                    self.open_started is not None and event['ts'] - self.open_started >= self.segment_seconds):
+                self.segments.append(event['seq'])
+                self.open_count = 0
+                self.open_started = event['ts']
+            if not writes or writes[-1][0] != self.segments[-1]:
+                writes.append((self.segments[-1], []))
+            writes[-1][1].append(json.dumps(event, ensure_ascii=False, separators=(',', ':')) + '\n')
+            self.open_count += 1
+        for first_seq, lines in writes:
+            with open(self.segment_path(first_seq), "a", encoding="utf-8") as f:
+                f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
+        while len(self.segments) > self.max_segments:
+            first_seq = self.segments.pop(0)
+            os.remove(self.segment_path(first_seq))
+            # Из бакета сегмент удаляется при publish(), вместе с обновлением cursor.json
+            self.pruned.append(f"changelog/{first_seq:012d}-{self.segments[0] - 1:012d}.ndjson")
+        self.dirty = True
+
+    def publish(self, uploader):
+        """Загружает новые закрытые сегменты, открытый сегмент и cursor.json."""
+        if not self.dirty:
+            return
+        prefix = "changelog/"
+        sealed = []
+        for first_seq, next_first in zip(self.segments, self.segments[1:]):
+            object_key = f"{prefix}{first_seq:012d}-{next_first - 1:012d}.ndjson"
+            if object_key not in self.published:
+                with open(self.segment_path(first_seq), "rb") as f:
+                    uploader.submit(object_key, f.read())
+                self.published.add(object_key)
+            sealed.append({'key': object_key, 'first_seq': first_seq, 'last_seq': next_first - 1})
+        current = None
+        if self.segments:
+            with open(self.segment_path(self.segments[-1]), "rb") as f:
+                uploader.submit(f"{prefix}current.ndjson", f.read())
+            current = {'key': f"{prefix}current.ndjson", 'first_seq': self.segments[-1],
+                       'last_seq': self.next_seq - 1}
+        uploader.submit(f"{prefix}cursor.json", json.dumps({
+            'latest_seq': self.next_seq - 1,
+            'segments': sealed,
+            'current': current,
+        }, separators=(',', ':')))
+        for object_key in self.pruned:
+            uploader.delete(object_key)
+            self.published.discard(object_key)
+        self.pruned = []
+        self.dirty = False
+        print(f"Лента изменений: последний seq {self.next_seq - 1}, закрытых сегментов {len(sealed)}")
+
+changelog = None
+
+# Инициализация ленты изменений ("changelog": {"enabled": false} — события не пишутся)
+def init_changelog(config, journal=None):
+    """journal — хранилище воркера: события пишутся в журнал gift_changes, а ленту ведёт публикатор."""
+    global changelog
+    changelog_config = config.get('changelog', {})
+    if not changelog_config.get('enabled', True):
+        changelog = None
+        return None
+    if journal is not None:
+        changelog = journal
+        return journal
+    changelog = ChangeLog(
+        changelog_config.get('directory', 'changelog'),
+        segment_events=changelog_config.get('segment_events', 10000),
+        segment_seconds=changelog_config.get('segment_seconds', 3600),
+        max_segments=changelog_config.get('max_segments', 168),
+    )
+    return changelog
+
+def get_changelog():
+    return changelog
+
+# Хранилища состояния all_data
+class JsonStateStore:
+    """Прежний формат: весь all_data в одном JSON-файле.
+
+    Сохранение с changed_keys (контрольная точка) дописывает только изменившиеся
+    подарки в журнал <файл>_delta.ndjson; файл переписывается целиком, когда в журнале
+    набирается не меньше записей, чем подарков в файле. load() применяет журнал поверх файла.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fingerprints = FingerprintIndex()
+        self.assets = None
+        # Записей в журнале; None — журнал не прочитан, следующее сохранение полное
+        self.delta_count = None
+
+    @property
+    def delta_path(self):
+        return os.path.splitext(self.path)[0] + "_delta.ndjson"
+
+    @staticmethod
+    def read(path):
+        """Содержимое файла в прежнем формате с применённым журналом и число записей журнала."""
+        stored = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                stored = json.load(f)
+        count = 0
+        delta_path = os.path.splitext(path)[0] + "_delta.ndjson"
+        if os.path.exists(delta_path):
+            with open(delta_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        row = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Строка, оборванная при сбое, — последняя в журнале
+                        break
+                    collection = stored.setdefault(row['collection'], {})
+                    collection[row['key']] = row['data']
+                    collection[f"{row['key']}_hash"] = row['hash']
+                    count += 1
+        return stored, count
+
+    def load(self):
+        if os.path.exists(self.path) or os.path.exists(self.delta_path):
+            stored, self.delta_count = self.read(self.path)
+            # Отпечатки хранятся в файле ключами "{key}_hash", но в all_data не попадают
+            all_data = {}
+            for collection_key, gifts in stored.items():
+                gifts, hashes = split_legacy_hashes(gifts)
+                all_data[collection_key] = {key: compact_gift(key, data) for key, data in gifts.items()}
+                for key, encoded in hashes.items():
+                    self.fingerprints.load(collection_key, get_gift_number(key), encoded)
+            print(f"Загружено данные из {self.path}.")
+            return all_data
+        print(f"Файл данных {self.path} не найден. Начинаем с пустого набора данных.")
+        self.delta_count = 0
+        return {}
+
+    def save(self, all_data, changed_keys=None):
+        """Сохраняет all_data; changed_keys — подарки, изменившиеся с прошлого сохранения."""
+        total = sum(len(gifts) for gifts in all_data.values())
+        if changed_keys is not None and self.delta_count is not None:
+            rows = [(collection_key, key) for collection_key, keys in changed_keys.items() for key in keys
+                    if key in all_data.get(collection_key, {})]
+            if self.delta_count + len(rows) < total:
+                self.append_delta(all_data, rows)
+                return
+        stored = {}
+        for collection_key, gifts in all_data.items():
+            stored[collection_key] = collection = {}
+            for key, data in gifts.items():
+                collection[key] = gift_as_dict(data)
+                collection[f"{key}_hash"] = self.fingerprints.encode(collection_key, get_gift_number(key), data)
+        write_json_atomic(self.path, stored, ensure_ascii=False, indent=4)
+        # Сбой до удаления журнала повторно применит его записи при загрузке: они могут быть
+        # старее файла, но подарок с устаревшими данными обновится при следующем опросе
+        if os.path.exists(self.delta_path):
+            os.remove(self.delta_path)
+        self.delta_count = 0
+        print(f"Данные сохранены в {self.path}.")
+
+    def append_delta(self, all_data, rows):
+        if not rows:
+            return
+        with open(self.delta_path, "a", encoding="utf-8") as f:
+            for collection_key, key in rows:
+                data = all_data[collection_key][key]
+                f.write(json.dumps({
+                    'collection': collection_key,
+                    'key': key,
+                    'data': gift_as_dict(data),
+                    'hash': self.fingerprints.encode(collection_key, get_gift_number(key), data),
+                }, ensure_ascii=False, separators=(',', ':')) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.delta_count += len(rows)
+        print(f"Изменения дописаны в {self.delta_path}: подарков {len(rows)}.")
 
-def main():
+    @property
+    def schedule_path(self):
+        return os.path.splitext(self.path)[0] + "_schedule.json"
+
+    def load_schedule(self):
+        if not os.path.exists(self.schedule_path):
+            return []
+        with open(self.schedule_path, "r", encoding="utf-8") as f:
+            return [tuple(row) for row in json.load(f)]
+
+    def save_schedule(self, rows):
+        schedule = {(row[0], row[1]): row for row in self.load_schedule()}
+        schedule.update({(row[0], row[1]): row for row in rows})
+        write_json_atomic(self.schedule_path, list(schedule.values()))
+
+    @property
+    def assets_path(self):
+        return os.path.splitext(self.path)[0] + "_assets.json"
+
+    def load_assets(self, urls):
+        """Ключи копий в бакете для urls, которые уже скопированы: {url: ключ}."""
+        if self.assets is None:
+            self.assets = {}
+            if os.path.exists(self.assets_path):
+                with open(self.assets_path, "r", encoding="utf-8") as f:
+                    self.assets = json.load(f)
+        return {url: self.assets[url] for url in urls if url in self.assets}
+
+    def save_assets(self, rows):
+        self.load_assets(())
+        self.assets.update(rows)
+        write_json_atomic(self.assets_path, self.assets)
+
+    def close(self):
+        pass
+
+class SqliteStateStore:
+    """SQLite-таблица подарков с ключом (collection, gift_id).
+
+    За цикл выполняется одна транзакция, и записываются только изменившиеся подарки.
+    С log_changes=True ключи записанных подарков добавляются в журнал gift_changes,
+    из которого публикатор в режиме шардирования узнаёт об изменениях воркеров;
+    события, переданные в record(), сохраняются в журнале вместе с ключом.
+    """
+
+    def __init__(self, path, legacy_json_path=None, log_changes=False):
+        self.path = path
+        self.log_changes = log_changes
+        self.fingerprints = FingerprintIndex()
+        # Базу могут одновременно открывать несколько воркеров: ждём блокировку, а не падаем
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS gifts (
+                collection TEXT NOT NULL,
+                gift_id INTEGER NOT NULL,
+                hash TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (collection, gift_id)
+            )
+        """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS poll_schedule (
+                collection TEXT NOT NULL,
+                gift_id INTEGER NOT NULL,
+                interval REAL NOT NULL,
+                next_due REAL NOT NULL,
+                last_change REAL NOT NULL,
+                PRIMARY KEY (collection, gift_id)
+            )
+        """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS gift_changes (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                collection TEXT NOT NULL,
+                gift_id INTEGER NOT NULL
+            )
+        """)
+        # Событие изменения для ленты (make_change_event); в базах прежних версий столбца нет
+        if 'event' not in {row[1] for row in self.conn.execute("PRAGMA table_info(gift_changes)")}:
+            self.conn.execute("ALTER TABLE gift_changes ADD COLUMN event TEXT")
+        self.pending_events = {}
+        # Состояние поиска id, общее для воркеров: границы коллекций и негативный кэш
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS discovery_ranges (
+                collection TEXT PRIMARY KEY,
+                end_id INTEGER NOT NULL,
+                checked_at REAL NOT NULL
+            )
+        """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS discovery_missing (
+                collection TEXT NOT NULL,
+                gift_id INTEGER NOT NULL,
+                misses INTEGER NOT NULL,
+                recheck_at REAL NOT NULL,
+                PRIMARY KEY (collection, gift_id)
+            )
+        """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS assets (
+                url TEXT PRIMARY KEY,
+                object_key TEXT NOT NULL,
+                mirrored_at REAL NOT NULL
+            )
+        """)
+        self.conn.commit()
+        if legacy_json_path:
+            self.migrate_from_json(legacy_json_path)
+
+    def migrate_from_json(self, json_path):
+        """Однократный перенос данных из all_collections_data.json в пустую базу."""
+        if not os.path.exists(json_path):
+            return
+        if self.conn.execute("SELECT 1 FROM gifts LIMIT 1").fetchone():
+            return
+        legacy_data, _ = JsonStateStore.read(json_path)
+        rows = []
+        for collection_key, gifts in legacy_data.items():
+            gifts, _ = split_legacy_hashes(gifts)
+            for key, data in gifts.items():
+                rows.append(self._row(collection_key, key, encode_fingerprint(gift_fingerprint(data)), data))
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO gifts (collection, gift_id, hash, payload, updated_at) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+        print(f"Перенесено {len(rows)} подарков из {json_path} в {self.path}.")
+
+    @staticmethod
+    def _row(collection_key, key, gift_hash, data):
+        gift_id = int(key.rsplit('_', 1)[-1])
+        return (collection_key, gift_id, gift_hash, json.dumps(gift_as_dict(data), ensure_ascii=False), time.time())
+
+    def load(self):
+        all_data = {}
+        count = 0
+        for collection_key, gift_id, gift_hash, payload in self.conn.execute(
+                "SELECT collection, gift_id, hash, payload FROM gifts ORDER BY collection, gift_id"):
+            gifts = all_data.setdefault(collection_key, {})
+            gifts[f"{collection_key}_{gift_id}"] = GiftRecord.from_dict(collection_key, gift_id, json.loads(payload))
+            self.fingerprints.load(collection_key, gift_id, gift_hash)
+            count += 1
+        print(f"Загружено {count} подарков из {self.path}.")
+        return all_data
+
+    def load_range(self, collection_key, start_id, end_id):
+        """Подарки коллекции с id из [start_id, end_id] в формате all_data[collection_key]."""
+        gifts = {}
+        for gift_id, gift_hash, payload in self.conn.execute(
+                "SELECT gift_id, hash, payload FROM gifts WHERE collection = ? AND gift_id BETWEEN ? AND ?",
+                (collection_key, start_id, end_id)):
+            gifts[f"{collection_key}_{gift_id}"] = GiftRecord.from_dict(collection_key, gift_id, json.loads(payload))
+            self.fingerprints.load(collection_key, gift_id, gift_hash)
+        return gifts
+
+    def save(self, all_data, changed_keys=None):
+        if changed_keys is None:
+            changed_keys = {collection_key: [k for k, _ in iter_gift_items(gifts)]
+                            for collection_key, gifts in all_data.items()}
+        rows = []
+        for collection_key, keys in changed_keys.items():
+            gifts = all_data.get(collection_key, {})
+            for key in keys:
+                if key in gifts:
+                    gift_hash = self.fingerprints.encode(collection_key, get_gift_number(key), gifts[key])
+                    rows.append(self._row(collection_key, key, gift_hash, gifts[key]))
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO gifts (collection, gift_id, hash, payload, updated_at) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            if self.log_changes:
+                events = [self.pending_events.pop((row[0], row[1]), None) for row in rows]
+                self.conn.executemany(
+                    "INSERT INTO gift_changes (collection, gift_id, event) VALUES (?, ?, ?)",
+                    [(row[0], row[1], event and json.dumps(event, ensure_ascii=False))
+                     for row, event in zip(rows, events)],
+                )
+        print(f"Данные сохранены в {self.path}: записано подарков {len(rows)}.")
+
+    def record(self, collection_key, gift_id, fields, old_data, new_data):
+        """Событие для ленты: записывается в журнал при save() вместе с подарком."""
+        event = make_change_event(collection_key, gift_id, fields, old_data, new_data)
+        previous = self.pending_events.get((collection_key, gift_id))
+        if previous:
+            # Два изменения до одного save(): одно событие от первой версии к последней
+            event['fields'] = sorted(set(previous['fields']) | set(event['fields']))
+            event['old_owner'] = previous['old_owner']
+        self.pending_events[(collection_key, gift_id)] = event
+
+    def read_changes(self, after_seq=0):
+        """Изменения из журнала после after_seq: [(seq, collection, gift_id, hash, payload, event)]."""
+        return self.conn.execute(
+            "SELECT c.seq, c.collection, c.gift_id, g.hash, g.payload, c.event FROM gift_changes c "
+            "JOIN gifts g ON g.collection = c.collection AND g.gift_id = c.gift_id "
+            "WHERE c.seq > ? ORDER BY c.seq",
+            (after_seq,),
+        ).fetchall()
+
+    def last_change_seq(self):
+        return self.conn.execute("SELECT COALESCE(MAX(seq), 0) FROM gift_changes").fetchone()[0]
+
+    def trim_changes(self, upto_seq):
+        """Удаляет обработанные записи журнала."""
+        with self.conn:
+            self.conn.execute("DELETE FROM gift_changes WHERE seq <= ?", (upto_seq,))
+
+    def load_schedule(self):
+        return self.conn.execute(
+            "SELECT collection, gift_id, interval, next_due, last_change FROM poll_schedule").fetchall()
+
+    def save_schedule(self, rows):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO poll_schedule (collection, gift_id, interval, next_due, last_change) "
+                "VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+
+    def load_assets(self, urls):
+        """Ключи копий в бакете для urls, которые уже скопированы: {url: ключ}."""
+        urls = list(urls)
+        assets = {}
+        # Не больше 500 параметров на запрос: ограничение SQLite на число переменных
+        for start in range(0, len(urls), 500):
+            chunk = urls[start:start + 500]
+            assets.update(self.conn.execute(
+                f"SELECT url, object_key FROM assets WHERE url IN ({','.join('?' * len(chunk))})", chunk))
+        return assets
+
+    def save_assets(self, rows):
+        now = time.time()
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO assets (url, object_key, mirrored_at) VALUES (?, ?, ?)",
+                                  [(url, object_key, now) for url, object_key in rows])
+
+    def load_discovery_ranges(self):
+        return {collection_key: {'end_id': end_id, 'checked_at': checked_at} for collection_key, end_id, checked_at
+                in self.conn.execute("SELECT collection, end_id, checked_at FROM discovery_ranges")}
+
+    def save_discovery_range(self, collection_key, end_id, checked_at):
+        # Граница не уменьшается, даже если другой воркер успел записать большую
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO discovery_ranges (collection, end_id, checked_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (collection) DO UPDATE SET end_id = MAX(end_id, excluded.end_id), "
+                "checked_at = MAX(checked_at, excluded.checked_at)",
+                (collection_key, end_id, checked_at),
+            )
+
+    def load_discovery_missing(self, collection_key, start_id, end_id):
+        """Негативный кэш id коллекции от start_id до end_id: {gift_id: [промахов, время перепроверки]}."""
+        return {gift_id: [misses, recheck_at] for gift_id, misses, recheck_at in self.conn.execute(
+            "SELECT gift_id, misses, recheck_at FROM discovery_missing "
+            "WHERE collection = ? AND gift_id BETWEEN ? AND ?", (collection_key, start_id, end_id))}
+
+    def save_discovery_missing(self, rows):
+        """rows — (collection, gift_id, [промахов, время перепроверки] или None, если id нашёлся)."""
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO discovery_missing (collection, gift_id, misses, recheck_at) VALUES (?, ?, ?, ?)",
+                [(collection_key, gift_id, entry[0], entry[1]) for collection_key, gift_id, entry in rows if entry])
+            self.conn.executemany(
+                "DELETE FROM discovery_missing WHERE collection = ? AND gift_id = ?",
+                [(collection_key, gift_id) for collection_key, gift_id, entry in rows if not entry])
+
+    def export_json(self, output_file):
+        """Выгружает состояние в прежнем формате all_collections_data.json."""
+        all_data = self.load()
+        exported = JsonStateStore(output_file)
+        exported.fingerprints = self.fingerprints
+        exported.save(all_data)
+        print(f"Состояние выгружено в {output_file}.")
+
+    def close(self):
+        self.conn.close()
+
+LEGACY_DATA_FILE = "all_collections_data.json"
+
+# Создание хранилища состояния по config.json ("state": {"backend": "sqlite" | "json"})
+def init_state_store(config, log_changes=False):
+    state_config = config.get('state', {})
+    backend = state_config.get('backend', 'sqlite')
+    if backend == 'json':
+        return JsonStateStore(state_config.get('path', LEGACY_DATA_FILE))
+    if backend == 'sqlite':
+        return SqliteStateStore(state_config.get('path', 'state.db'), legacy_json_path=LEGACY_DATA_FILE,
+                                log_changes=log_changes)
+    raise ValueError(f"Неизвестный backend хранилища состояния: {backend}")
+
+def has_yandex_config(yandex_config):
+    if not all([yandex_config.get('id'), yandex_config.get('key'), yandex_config.get('bucket_name')]):
+        print("Отсутствуют необходимые параметры для Yandex Cloud в config.json.")
+        return False
+    return True
+
+def get_engine(config):
+    """Движок обхода: "threads" — ThreadPoolExecutor, "async" — asyncio + aiohttp."""
+    engine = config.get('engine', 'threads')
+    if engine == 'async' and aiohttp is None:
+        print("Для engine=async нужен пакет aiohttp, используется пул потоков.")
+        engine = 'threads'
+    return engine
+
+def load_config(path='config.json'):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+# Выгрузка состояния из SQLite в прежний JSON-формат: python main.py export-state [файл]
+def export_state(output_file=LEGACY_DATA_FILE):
+    config = load_config()
+    state_config = config.get('state', {})
+    store = SqliteStateStore(state_config.get('path', 'state.db'))
+    try:
+        store.export_json(output_file)
+    finally:
+        store.close()
+
+# Шардирование диапазонов id между процессами и хостами через аренды в общей базе
+class ShardCoordinator:
+    """Аренды шардов — диапазонов id коллекции — в таблице shard_leases базы состояния.
+
+    Шард опрашивается не чаще раза в interval секунд. Воркер берёт шард с наступившим
+    сроком или с истёкшей арендой (продолжая с сохранённого курсора), а если таких нет —
+    отрезает себе вторую половину необработанного хвоста самого отстающего занятого шарда.
+    Отрезанные части при освобождении сливаются обратно до границ исходного шарда.
+    """
+
+    def __init__(self, path, worker_id, shard_size=200, lease_seconds=60, interval=60,
+                 batch_size=50, min_steal=20):
+        self.worker_id = worker_id
+        self.shard_size = shard_size
+        self.lease_seconds = lease_seconds
+        self.interval = interval
+        self.batch_size = batch_size
+        self.min_steal = min_steal
+        self.base_ids = {}
+        # Транзакции открываются явно через BEGIN IMMEDIATE: чтение и захват аренды атомарны
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS shard_leases (
+                collection TEXT NOT NULL,
+                start_id INTEGER NOT NULL,
+                end_id INTEGER NOT NULL,
+                owner TEXT,
+                lease_until REAL NOT NULL DEFAULT 0,
+                cursor INTEGER NOT NULL,
+                next_due REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (collection, start_id)
+            )
+        """)
+
+    @contextmanager
+    def _transaction(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
+    def sync_ranges(self, collections):
+        """Создаёт шарды для ещё не покрытых id коллекций из config.json."""
+        with self._transaction():
+            for collection in collections:
+                collection_key = collection.get('name')
+                start_id, end_id = collection.get('start_id'), collection.get('end_id')
+                self.base_ids[collection_key] = start_id
+                covered = self.conn.execute(
+                    "SELECT MAX(end_id) FROM shard_leases WHERE collection = ?", (collection_key,)).fetchone()[0]
+                next_id = start_id if covered is None else covered + 1
+                while next_id <= end_id:
+                    # Новые шарды выравниваются по границам start_id + k * shard_size
+                    shard_end = min(end_id, next_id + self.shard_size - 1 - (next_id - start_id) % self.shard_size)
+                    self.conn.execute(
+                        "INSERT OR IGNORE INTO shard_leases (collection, start_id, end_id, cursor) VALUES (?, ?, ?, ?)",
+                        (collection_key, next_id, shard_end, next_id))
+                    next_id = shard_end + 1
+
+    def _lease(self, row):
+        collection_key, start_id, end_id, cursor = row
+        return {'collection': collection_key, 'start_id': start_id, 'end_id': end_id, 'cursor': cursor}
+
+    def acquire(self, now=None):
+        """Захватывает шард для обработки. Возвращает аренду или None, если работы нет."""
+        now = time.time() if now is None else now
+        with self._transaction():
+            row = self.conn.execute(
+                "SELECT collection, start_id, end_id, cursor FROM shard_leases "
+                "WHERE (owner IS NULL AND next_due <= ?) OR (owner IS NOT NULL AND lease_until < ?) "
+                "ORDER BY next_due LIMIT 1",
+                (now, now)).fetchone()
+            if row:
+                self.conn.execute(
+                    "UPDATE shard_leases SET owner = ?, lease_until = ? WHERE collection = ? AND start_id = ?",
+                    (self.worker_id, now + self.lease_seconds, row[0], row[1]))
+                return self._lease(row)
+            return self._steal(now)
+
+    def _steal(self, now):
+        # Пачка [cursor, cursor + batch_size) уже в работе у владельца — её не трогаем
+        row = self.conn.execute(
+            "SELECT collection, start_id, end_id, cursor, next_due, end_id - cursor + 1 - ? AS remaining "
+            "FROM shard_leases WHERE owner IS NOT NULL AND owner != ? AND lease_until >= ? "
+            "ORDER BY remaining DESC LIMIT 1",
+            (self.batch_size, self.worker_id, now)).fetchone()
+        if not row or row[5] < 2 * self.min_steal:
+            return None
+        collection_key, start_id, end_id, cursor, next_due, remaining = row
+        split_id = cursor + self.batch_size + remaining // 2
+        self.conn.execute("UPDATE shard_leases SET end_id = ? WHERE collection = ? AND start_id = ?",
+                          (split_id - 1, collection_key, start_id))
+        self.conn.execute(
+            "INSERT INTO shard_leases (collection, start_id, end_id, owner, lease_until, cursor, next_due) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (collection_key, split_id, end_id, self.worker_id, now + self.lease_seconds, split_id, next_due))
+        print(f"Воркер {self.worker_id} забрал у отстающего шарда {collection_key} id {split_id}–{end_id}")
+        return self._lease((collection_key, split_id, end_id, split_id))
+
+    def heartbeat(self, lease, cursor):
+        """Продлевает аренду и сохраняет курсор. Возвращает текущую верхнюю границу
+        шарда (её мог уменьшить другой воркер) или None, если аренда потеряна."""
+        with self._transaction():
+            updated = self.conn.execute(
+                "UPDATE shard_leases SET cursor = ?, lease_until = ? "
+                "WHERE collection = ? AND start_id = ? AND owner = ?",
+                (cursor, time.time() + self.lease_seconds, lease['collection'], lease['start_id'],
+                 self.worker_id)).rowcount
+            if not updated:
+                return None
+            return self.conn.execute(
+                "SELECT end_id FROM shard_leases WHERE collection = ? AND start_id = ?",
+                (lease['collection'], lease['start_id'])).fetchone()[0]
+
+    def release(self, lease, cursor):
+        """Отдаёт недообработанный шард: аренда сразу считается истёкшей, курсор сохраняется."""
+        with self._transaction():
+            self.conn.execute(
+                "UPDATE shard_leases SET cursor = ?, lease_until = 0 "
+                "WHERE collection = ? AND start_id = ? AND owner = ?",
+                (cursor, lease['collection'], lease['start_id'], self.worker_id))
+
+    def _is_split(self, collection_key, start_id):
+        return (start_id - self.base_ids.get(collection_key, start_id)) % self.shard_size != 0
+
+    def complete(self, lease):
+        """Освобождает шард до следующего срока и сливает его с соседними отрезанными частями."""
+        collection_key = lease['collection']
+        with self._transaction():
+            row = self.conn.execute(
+                "SELECT start_id, end_id FROM shard_leases WHERE collection = ? AND start_id = ? AND owner = ?",
+                (collection_key, lease['start_id'], self.worker_id)).fetchone()
+            if not row:
+                return False
+            start_id, end_id = row
+            next_due = time.time() + self.interval
+            self.conn.execute(
+                "UPDATE shard_leases SET owner = NULL, lease_until = 0, cursor = start_id, next_due = ? "
+                "WHERE collection = ? AND start_id = ?",
+                (next_due, collection_key, start_id))
+            if self._is_split(collection_key, start_id):
+                previous = self.conn.execute(
+                    "SELECT start_id, next_due FROM shard_leases "
+                    "WHERE collection = ? AND end_id = ? AND owner IS NULL",
+                    (collection_key, start_id - 1)).fetchone()
+                if previous:
+                    self._merge(collection_key, previous[0], start_id, end_id, max(previous[1], next_due))
+                    start_id, next_due = previous[0], max(previous[1], next_due)
+            following = self.conn.execute(
+                "SELECT start_id, end_id, next_due FROM shard_leases "
+                "WHERE collection = ? AND start_id = ? AND owner IS NULL",
+                (collection_key, end_id + 1)).fetchone()
+            if following and self._is_split(collection_key, following[0]):
+                self._merge(collection_key, start_id, following[0], following[1], max(following[2], next_due))
+        return True
+
+    def _merge(self, collection_key, start_id, absorbed_start_id, end_id, next_due):
+        self.conn.execute("DELETE FROM shard_leases WHERE collection = ? AND start_id = ?",
+                          (collection_key, absorbed_start_id))
+        self.conn.execute("UPDATE shard_leases SET end_id = ?, next_due = ? WHERE collection = ? AND start_id = ?",
+                          (end_id, next_due, collection_key, start_id))
+
+    def seconds_until_due(self):
+        """Сколько ждать до ближайшего шарда с наступившим сроком или истекающей аренды."""
+        row = self.conn.execute(
+            "SELECT MIN(CASE WHEN owner IS NULL THEN next_due ELSE lease_until END) FROM shard_leases").fetchone()
+        return max(0.0, (row[0] or time.time()) - time.time())
+
+    def report(self):
+        total, leased, due = self.conn.execute(
+            "SELECT COUNT(*), SUM(owner IS NOT NULL), SUM(owner IS NULL AND next_due <= ?) FROM shard_leases",
+            (time.time(),)).fetchone()
+        print(f"Шарды: всего {total}, в работе {leased or 0}, ожидают опроса {due or 0}")
+
+    def close(self):
+        self.conn.close()
+
+def init_shard_coordinator(config, worker_id):
+    sharding_config = config.get('sharding', {})
+    return ShardCoordinator(
+        config.get('state', {}).get('path', 'state.db'),
+        worker_id,
+        shard_size=sharding_config.get('shard_size', 200),
+        lease_seconds=sharding_config.get('lease_seconds', 60),
+        interval=config.get('interval_seconds', 60),
+        batch_size=sharding_config.get('batch_size', 50),
+        min_steal=sharding_config.get('min_steal', 20),
+    )
+
+def worker_path(path, worker_id):
+    """Отдельный файл кэша для каждого воркера: state.json -> state.<worker_id>.json."""
+    root, extension = os.path.splitext(path)
+    return f"{root}.{worker_id}{extension}"
+
+def worker_config(config, worker_id, metrics_port=None):
+    """Копия config с файлами кэшей, не пересекающимися между воркерами одного каталога."""
+    config = dict(config)
+    config['validator_cache_file'] = worker_path(config.get('validator_cache_file', 'validator_cache.json'), worker_id)
+    upload_config = dict(config.get('upload', {}))
+    upload_config['etag_cache_file'] = worker_path(upload_config.get('etag_cache_file', 'upload_etags.json'), worker_id)
+    config['upload'] = upload_config
+    metrics_config = dict(config.get('metrics', {}))
+    metrics_config['summary_file'] = worker_path(metrics_config.get('summary_file', 'metrics_summary.json'), worker_id)
+    metrics_config['port'] = metrics_port
+    config['metrics'] = metrics_config
+    metadata_config = dict(config.get('metadata', {}))
+    metadata_config['cache_file'] = worker_path(metadata_config.get('cache_file', 'metadata_fetched.json'), worker_id)
+    config['metadata'] = metadata_config
+    return config
+
+def process_shard(lease, coordinator, state_store, uploader, config, engine, discovery=None):
+    """Опрашивает шард пачками, сохраняет изменения и публикует страницы подарков.
+
+    Возвращает False, если аренду перехватил другой воркер или процесс останавливается.
+    """
+    metrics = get_metrics()
+    # Выгрузку коллекции целиком собирает публикатор
+    _, per_gift_json = init_export(config)
+    collection_key = lease['collection']
+    collection_name = collection_key
+    cursor = lease['cursor']
+    end_id = lease['end_id']
+    while cursor <= end_id:
+        if shutdown_event.is_set():
+            # Остаток шарда продолжит другой воркер с сохранённого курсора
+            coordinator.release(lease, cursor)
+            return False
+        end_id = coordinator.heartbeat(lease, cursor)
+        if end_id is None:
+            print(f"Аренда шарда {collection_key} {lease['start_id']} перехвачена другим воркером.")
+            return False
+        if cursor > end_id:
+            break
+        batch_end = min(end_id, cursor + coordinator.batch_size - 1)
+        all_data = {collection_key: state_store.load_range(collection_key, cursor, batch_end)}
+        get_validator_cache().bind(all_data)
+        if get_metadata_cache():
+            get_metadata_cache().bind(all_data)
+        state_store.fingerprints.begin_cycle()
+        changed_keys = {collection_key: set()}
+        index_dirty = set()
+        jobs = [(collection_key, f"{collection_name}_{gift_id}", gift_id, collection_name)
+                for gift_id in range(cursor, batch_end + 1)]
+        if discovery:
+            jobs, _ = discovery.filter_jobs(jobs)
+
+        def on_result(collection_key, key, gift_data):
+            status = 'error'
+            try:
+                status = apply_gift_result(all_data, collection_key, key, gift_data, changed_keys, index_dirty,
+                                           state_store.fingerprints)
+            finally:
+                metrics.inc('gifts_total', result=status)
+                if discovery:
+                    discovery.record(collection_key, int(key.rsplit('_', 1)[-1]), status)
+
+        with metrics.timer('sweep'):
+            run_sweep(jobs, config, engine, on_result)
+        with metrics.timer('save'):
+            state_store.save(all_data, changed_keys)
+        # Главную страницу и манифест собирает публикатор по журналу gift_changes
+        if changed_keys[collection_key]:
+            if get_asset_mirror():
+                with metrics.timer('assets'):
+                    get_asset_mirror().mirror(collection_key, all_data[collection_key], changed_keys[collection_key])
+            with metrics.timer('render', artifact='gift_page'):
+                generate_gift_pages(all_data[collection_key], collection_name, uploader, changed_keys[collection_key])
+            if per_gift_json:
+                with metrics.timer('render', artifact='gift_json'):
+                    generate_json_files(all_data[collection_key], collection_name, uploader, changed_keys[collection_key])
+        if shutdown_event.is_set():
+            # Пачка могла остаться недообработанной: её повторит следующий владелец шарда
+            coordinator.release(lease, cursor)
+            return False
+        cursor = batch_end + 1
+    return coordinator.complete(lease)
+
+def run_worker(config, worker_id):
+    """Воркер: берёт шарды из общей базы, опрашивает их и публикует страницы подарков."""
+    if not has_yandex_config(config.get('yandex', {})):
+        return
+    if config.get('state', {}).get('backend', 'sqlite') != 'sqlite':
+        print("Шардирование требует state.backend = sqlite.")
+        return
+    engine = get_engine(config)
+    uploader = init_uploader(config['yandex'], config)
+    metrics = init_metrics(config)
+    init_http_client(config)
+    init_request_governor(config)
+    validators = init_validator_cache(config)
+    metadata = init_metadata_cache(config)
+    state_store = init_state_store(config, log_changes=True)
+    # Старые подарки переиздаёт публикатор, воркер копирует файлы только изменившихся
+    assets = init_asset_mirror(config, uploader, state_store)
+    # События изменений воркер пишет в журнал gift_changes, в ленту их переносит публикатор
+    init_changelog(config, journal=state_store)
+    coordinator = init_shard_coordinator(config, worker_id)
+    # Границы и негативный кэш общие для воркеров и лежат в той же базе
+    discovery = init_discovery(config, store=state_store)
+    collections = config.get('collections', [])
+    install_shutdown_handler()
+    print(f"Воркер {worker_id} запущен.")
+    while not shutdown_event.is_set():
+        if discovery:
+            discovery.refresh(collections)
+        coordinator.sync_ranges(effective_collections(collections, discovery))
+        lease = coordinator.acquire()
+        if lease is None:
+            shutdown_event.wait(min(max(coordinator.seconds_until_due(), 0.5), 10))
+            continue
+        print(f"\nВоркер {worker_id}: шард {lease['collection']} id {lease['cursor']}–{lease['end_id']}")
+        metrics.begin_cycle()
+        process_shard(lease, coordinator, state_store, uploader, config, engine, discovery)
+        if assets:
+            assets.report()
+        validators.save()
+        if metadata:
+            metadata.save()
+        if discovery:
+            discovery.save()
+        with metrics.timer('upload_flush'):
+            uploader.flush()
+        metrics.end_cycle(config.get('interval_seconds', 60), metrics_summary_file)
+    uploader.close()
+    state_store.close()
+    coordinator.close()
+    print(f"Воркер {worker_id} остановлен.")
+
+def run_publisher(config):
+    """Публикатор: сливает изменения воркеров в главные страницы и манифесты коллекций."""
+    if not has_yandex_config(config.get('yandex', {})):
+        return
+    uploader = init_uploader(config['yandex'], config)
+    metrics = init_metrics(config)
+    state_store = init_state_store(config, log_changes=True)
+    install_shutdown_handler()
+    manifest_page_size = config.get('index', {}).get('page_size', 1000)
+    exporter, per_gift_json = init_export(config)
+    publish_interval = config.get('sharding', {}).get('publish_interval', 10)
+    # Ленту ведёт публикатор: события воркеров приходят из журнала gift_changes
+    events = init_changelog(config)
+    # Журнал обрезает только публикатор, поэтому с лентой он читается с позиции, до которой
+    # события уже в ленте (при первом запуске — с начала); без ленты — с текущей позиции:
+    # полная загрузка уже содержит всё, что было до неё
+    seq = (events.load_journal_cursor() or 0) if events else None
+    if seq is None or seq > state_store.last_change_seq():
+        seq = state_store.last_change_seq()
+    all_data = state_store.load()
+    rarity = init_rarity_engine(config)
+    search = init_search_indexer(config)
+    assets = init_asset_mirror(config, uploader, state_store)
+    collection_names = [collection.get('name') for collection in config.get('collections', [])]
+    index_dirty = set(collection_names)
+    export_pending = set(collection_names)
+    changed_keys = {collection_key: None for collection_key in collection_names}
+    while True:
+        metrics.begin_cycle()
+        journal_keys = {}
+        for seq, collection_key, gift_id, _, payload, event in state_store.read_changes(seq):
+            key = f"{collection_key}_{gift_id}"
+            gifts = all_data.setdefault(collection_key, {})
+            data = GiftRecord.from_dict(collection_key, gift_id, json.loads(payload))
+            journal_keys.setdefault(collection_key, set()).add(key)
+            fields = state_store.fingerprints.diff(collection_key, key, data, gifts.get(key))
+            if events and event:
+                events.append(json.loads(event))
+            elif events and fields:
+                # Запись журнала без события (воркер прежней версии): сравниваем с копией в памяти
+                events.record(collection_key, gift_id, fields, gifts.get(key), data)
+            if get_card_fields(gifts.get(key)) != get_card_fields(data):
+                index_dirty.add(collection_key)
+                keys = changed_keys.setdefault(collection_key, set())
+                if keys is not None:
+                    keys.add(key)
+            gifts[key] = data
+        uploader.retry_failed()
+        publish_static_assets(uploader)
+        # Страницы ранее опубликованных подарков со ссылками на исходные файлы
+        for collection_key in collection_names if assets else ():
+            gift_data = all_data.get(collection_key, {})
+            republish_keys = assets.take_backfill(collection_key, gift_data)
+            if not republish_keys:
+                continue
+            with metrics.timer('assets'):
+                assets.mirror(collection_key, gift_data, republish_keys)
+            with metrics.timer('render', artifact='gift_page'):
+                generate_gift_pages(gift_data, collection_key, uploader, republish_keys)
+            if per_gift_json:
+                with metrics.timer('render', artifact='gift_json'):
+                    generate_json_files(gift_data, collection_key, uploader, republish_keys)
+            index_dirty.add(collection_key)
+            keys = changed_keys.setdefault(collection_key, set())
+            if keys is not None:
+                keys.update(republish_keys)
+        for collection_key in sorted(set(journal_keys) | set(collection_names) - rarity.published.keys()):
+            gift_data = all_data.get(collection_key, {})
+            if rarity.update(collection_key, gift_data, journal_keys.get(collection_key, set())):
+                rarity.publish(collection_key, gift_data, uploader)
+            if search:
+                search_changed = search.update(collection_key, gift_data, journal_keys.get(collection_key, set()))
+                if search_changed:
+                    search.publish(collection_key, search_changed, uploader)
+        # Выгрузка ограничена по частоте: изменившаяся коллекция ждёт, пока подойдёт её время
+        export_pending.update(journal_keys)
+        for collection_key in sorted(export_pending):
+            if exporter and exporter.due(collection_key):
+                with metrics.timer('render', artifact='export'):
+                    exporter.export(all_data.get(collection_key, {}), collection_key, uploader)
+                export_pending.discard(collection_key)
+        for collection_key in sorted(index_dirty):
+            with metrics.timer('render', artifact='index'):
+                uploader.submit(f"{collection_key}.html", generate_main_page(collection_key))
+                generate_manifest(all_data.get(collection_key, {}), collection_key, uploader,
+                                  manifest_page_size, changed_keys.get(collection_key),
+                                  rarity.get(collection_key))
+        index_dirty.clear()
+        changed_keys.clear()
+        if assets:
+            assets.report()
+        if events:
+            events.flush()
+            events.save_journal_cursor(seq)
+            events.publish(uploader)
+        with metrics.timer('upload_flush'):
+            uploader.flush()
+        if assets:
+            assets.save()
+        state_store.trim_changes(seq)
+        metrics.end_cycle(publish_interval, metrics_summary_file)
+        if shutdown_event.wait(publish_interval):
+            break
+    uploader.close()
+    state_store.close()
+
+def run_local_cluster(config_path, workers):
+    """Запускает на этой машине workers процессов-воркеров и публикатор в текущем процессе."""
+    config = load_config(config_path)
+    hostname = socket.gethostname()
+    base_port = config.get('metrics', {}).get('port')
+    context = multiprocessing.get_context('spawn')
+    processes = []
+    for index in range(workers):
+        worker_id = f"{hostname}-{index}"
+        metrics_port = base_port + 1 + index if base_port else None
+        process = context.Process(target=run_worker, args=(worker_config(config, worker_id, metrics_port), worker_id),
+                                  daemon=True)
+        process.start()
+        processes.append(process)
+    run_publisher(config)
+    # Публикатор остановлен сигналом: передаём его воркерам и ждём сохранения их состояния
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join()
+
+def main(config_path='config.json', max_cycles=None):
+    """Цикл опроса и публикации. max_cycles ограничивает число циклов (для бенчмарков)."""
     # Загрузка конфигурации
-    with open('config.json', 'r', encoding='utf-8') as f:
-        config = json.load(f)
+    config = load_config(config_path)
     
     collections = config.get('collections', [])
     yandex_config = config.get('yandex', {})
-    yandex_id = yandex_config.get('id')
-    yandex_key = yandex_config.get('key')
-    bucket_name = yandex_config.get('bucket_name')
     interval_seconds = config.get('interval_seconds', 60)
-    thread_workers = config.get('thread_workers', 20)
+    # "dirty" — публикуются только изменившиеся подарки, "full" — вся коллекция каждый цикл
+    publish_mode = config.get('publish_mode', 'dirty')
+    # Выгрузка коллекций в NDJSON/Parquet и загрузка JSON отдельных подарков
+    exporter, per_gift_json = init_export(config)
+    # Выгрузка ограничена по частоте: изменившаяся коллекция ждёт, пока подойдёт её время,
+    # даже если в следующих циклах она больше не меняется
+    export_pending = {collection.get('name') for collection in collections}
+    engine = get_engine(config)
+    # Число подарков в одной странице JSON-манифеста главной страницы
+    manifest_page_size = config.get('index', {}).get('page_size', 1000)
     
     # Проверка наличия необходимых параметров
-    if not all([yandex_id, yandex_key, bucket_name]):
-        print("Отсутствуют необходимые параметры для Yandex Cloud в config.json.")
+    if not has_yandex_config(yandex_config):
         return
     
-    # Инициализируем Yandex клиент
-    yandex_client = init_yandex_client(yandex_config)
+    # Инициализируем Yandex клиент и загрузчик
+    uploader = init_uploader(yandex_config, config)
+    
+    # Метрики: /metrics для Prometheus и JSON-сводка в конце каждого цикла
+    metrics = init_metrics(config)
+    
+    # Инициализируем общий HTTP-клиент, регулятор запросов и кэш валидаторов
+    client = init_http_client(config)
+    governor = init_request_governor(config)
+    validators = init_validator_cache(config)
+    # Метаданные fragment.com загружаются редко, обычный опрос — только t.me
+    metadata = init_metadata_cache(config)
+    # Поиск верхней границы id коллекций и негативный кэш (discovery.enabled = false — только config.json)
+    discovery = init_discovery(config)
     
     # Загрузка или инициализация данных
-    data_file = "all_collections_data.json"
-    if os.path.exists(data_file):
-        with open(data_file, "r", encoding="utf-8") as f:
-            all_data = json.load(f)
-        print(f"Загружено данные из {data_file}.")
-    else:
-        all_data = {}
-        print(f"Файл данных {data_file} не найден. Начинаем с пустого набора данных.")
+    state_store = init_state_store(config)
+    all_data = state_store.load()
+    validators.bind(all_data)
+    if metadata:
+        metadata.bind(all_data)
+    # Отпечатки подарков по группам полей хранятся отдельно от all_data
+    fingerprints = state_store.fingerprints
+    # Контрольные точки цикла: продолжение прерванного обхода после перезапуска
+    checkpoint = init_checkpoint(config)
+    install_shutdown_handler()
+    
+    # Адаптивный планировщик опроса (scheduler.enabled = false — полный обход каждый цикл)
+    scheduler = init_scheduler(config)
+    if scheduler:
+        scheduler.load(state_store.load_schedule())
+    
+    # Локальные таблицы частот атрибутов: ранги и топ редкости коллекций
+    rarity = init_rarity_engine(config)
+    # Поисковые индексы по атрибутам и владельцам (search.enabled = false — не публикуются)
+    search = init_search_indexer(config)
+    # Копии изображений и анимаций в бакете (assets.enabled = false — ссылки на исходные URL)
+    assets = init_asset_mirror(config, uploader, state_store)
+    # Лента событий изменения подарков для внешних потребителей
+    events = init_changelog(config)
     
+    cycle = 0
     while True:
         print("\nНачинается цикл проверки и парсинга коллекций...")
-        with ThreadPoolExecutor(max_workers=thread_workers) as executor:
-            future_to_gift = {}
-            for collection in collections:
-                collection_name = collection.get('name')
-                start_id = collection.get('start_id')
-                end_id = collection.get('end_id')
-                
-                # Создание ключа для коллекции
-                collection_key = collection_name
-                
-                # Инициализация данных коллекции если необходимо
-                if collection_key not in all_data:
-                    all_data[collection_key] = {}
-                
-                for gift_id in range(start_id, end_id + 1):
-                    key = f"{collection_name}_{gift_id}"
-                    future = executor.submit(process_gift_data, gift_id, collection_name)
-                    future_to_gift[future] = (collection_key, key)
+        metrics.begin_cycle()
+        fingerprints.begin_cycle()
+        # Ключи изменившихся подарков и коллекции, у которых изменились карточки
+        changed_keys = {}
+        index_dirty = set()
+        jobs = []
+        if discovery:
+            discovery.refresh(collections)
+        for collection in effective_collections(collections, discovery):
+            collection_name = collection.get('name')
+            start_id = collection.get('start_id')
+            end_id = collection.get('end_id')
             
-            for future in as_completed(future_to_gift):
-                collection_key, key = future_to_gift[future]
-                try:
-                    gift_data = future.result()
-                    if gift_data and "error" not in gift_data:
-                        new_hash = get_content_hash(gift_data)
-                        old_hash = all_data[collection_key].get(f"{key}_hash", "")
-                        if has_changed(old_hash, new_hash):
-                            all_data[collection_key][key] = gift_data
-                            all_data[collection_key][f"{key}_hash"] = new_hash
-                            print(f"Обновление подарка: {key}")
-                        else:
-                            print(f"Подарок не изменился: {key}")
-                    else:
-                        print(f"Ошибка при получении данных для {key}: {gift_data.get('error', 'Неизвестная ошибка')}")
-                except Exception as e:
-                    print(f"Исключение при обработке подарка {key}: {e}")
+            # Создание ключа для коллекции
+            collection_key = collection_name
+            
+            # Инициализация данных коллекции если необходимо
+            if collection_key not in all_data:
+                all_data[collection_key] = {}
+            changed_keys.setdefault(collection_key, set())
+            
+            if scheduler:
+                scheduler.ensure_range(collection_key, start_id, end_id)
+                continue
+            for gift_id in range(start_id, end_id + 1):
+                key = f"{collection_name}_{gift_id}"
+                jobs.append((collection_key, key, gift_id, collection_name))
+        
+        if scheduler:
+            backlog = scheduler.backlog()
+            jobs = scheduler.due_jobs()
+            print(f"Подарков с наступившим сроком опроса: {backlog}, опрашивается в этом цикле: {len(jobs)}")
+        
+        if discovery:
+            jobs, skipped_jobs = discovery.filter_jobs(jobs)
+            if scheduler:
+                for collection_key, key, _, _ in skipped_jobs:
+                    scheduler.record(collection_key, key, 'not_found')
+        
+        # Изменения, сохранённые до перезапуска, но ещё не опубликованные
+        remaining_jobs = checkpoint.filter_jobs(jobs)
+        if scheduler and len(remaining_jobs) < len(jobs):
+            # Подарки, опрошенные до перезапуска, уже взяты из очереди: возвращаем их туда
+            # с результатом из контрольной точки (изменившиеся перечислены в pending)
+            remaining = set(remaining_jobs)
+            for job in jobs:
+                if job not in remaining:
+                    collection_key, key = job[0], job[1]
+                    status = 'changed' if key in checkpoint.pending.get(collection_key, ()) else 'unchanged'
+                    scheduler.record(collection_key, key, status)
+        jobs = remaining_jobs
+        for collection_key, keys in checkpoint.pending.items():
+            changed_keys.setdefault(collection_key, set()).update(keys)
+            for key in keys:
+                fingerprints.record_changes(collection_key, key, FINGERPRINT_FIELDS)
+        index_dirty.update(checkpoint.index_dirty)
+        # Изменившиеся с последней контрольной точки подарки
+        unsaved_keys = {collection_key: set() for collection_key in changed_keys}
+        
+        def save_progress():
+            # Контрольная точка пишется до данных: подарок из неё, не успевший попасть в
+            # хранилище, будет опрошен в следующем цикле, а сохранённый — не потеряет публикацию.
+            # События — ещё раньше: после сбоя событие может повториться, но не пропасть
+            if events:
+                events.flush()
+            checkpoint.save(changed_keys, index_dirty)
+            state_store.save(all_data, unsaved_keys)
+            if scheduler:
+                state_store.save_schedule(scheduler.pop_dirty_rows())
+            if discovery:
+                discovery.save()
+            if metadata:
+                metadata.save()
+            for keys in unsaved_keys.values():
+                keys.clear()
+        
+        def on_result(collection_key, key, gift_data):
+            status = 'error'
+            try:
+                status = apply_gift_result(all_data, collection_key, key, gift_data, changed_keys, index_dirty,
+                                           fingerprints)
+            finally:
+                metrics.inc('gifts_total', result=status)
+                gift_id = int(key.rsplit('_', 1)[-1])
+                if discovery:
+                    discovery.record(collection_key, gift_id, status)
+                # Подарок всегда возвращается в очередь планировщика
+                if scheduler:
+                    scheduler.record(collection_key, key, status)
+                if status == 'changed':
+                    unsaved_keys.setdefault(collection_key, set()).add(key)
+                if checkpoint.mark(collection_key, gift_id):
+                    with metrics.timer('checkpoint'):
+                        save_progress()
+        
+        with metrics.timer('sweep'):
+            run_sweep(jobs, config, engine, on_result)
+        
+        client.report()
+        governor.report()
+        validators.report()
+        if metadata:
+            metadata.report()
+        if discovery:
+            discovery.report()
         
         # Сохранение обновлённых данных
-        with open(data_file, "w", encoding="utf-8") as f:
-            json.dump(all_data, f, ensure_ascii=False, indent=4)
-        print(f"Данные сохранены в {data_file}.")
+        with metrics.timer('save'):
+            save_progress()
+            validators.save()
+        
+        if shutdown_event.is_set():
+            # Публикация достанется следующему запуску из контрольной точки
+            break
         
         # Генерация страниц и загрузка на Yandex
+        uploader.retry_failed()
+        publish_static_assets(uploader)
         for collection in collections:
             collection_name = collection.get('name')
             collection_key = collection_name
             gift_data = all_data.get(collection_key, {})
-            # Генерация главной страницы
-            main_page_file = f"{collection_name}.html"
-            generate_main_page(gift_data, collection_name, main_page_file)
-            # Загрузка главной страницы на Yandex
-            upload_to_yandex(yandex_client, bucket_name, main_page_file, f"{collection_name}.html")
-            os.remove(main_page_file)  # Удаление локального файла после загрузки
+            if publish_mode == 'full':
+                only_keys = None
+            else:
+                only_keys = changed_keys.get(collection_key, set())
+                # Ранее опубликованные подарки, страницы которых ещё ссылаются на исходные файлы
+                republish_keys = assets.take_backfill(collection_key, gift_data) - only_keys if assets else set()
+                if republish_keys:
+                    only_keys = only_keys | republish_keys
+                    index_dirty.add(collection_key)
+                if not only_keys:
+                    if exporter and collection_key in export_pending and exporter.due(collection_key):
+                        with metrics.timer('render', artifact='export'):
+                            exporter.export(gift_data, collection_name, uploader)
+                        export_pending.discard(collection_key)
+                    print(f"Коллекция {collection_name} не изменилась, публикация пропущена.")
+                    continue
+            if assets:
+                with metrics.timer('assets'):
+                    assets.mirror(collection_key, gift_data, only_keys)
+            # Ранги и топ редкости (только если изменились значения атрибутов)
+            rarity_keys = None if only_keys is None else fingerprints.keys_with(collection_key, 'meta', only_keys)
+            if rarity.update(collection_key, gift_data, rarity_keys):
+                rarity.publish(collection_key, gift_data, uploader)
+            
+            # Поисковые индексы (только если изменились атрибуты или владельцы)
+            if search:
+                search_keys = None if only_keys is None else (
+                    fingerprints.keys_with(collection_key, 'meta', only_keys)
+                    | fingerprints.keys_with(collection_key, 'owner', only_keys))
+                search_changed = search.update(collection_key, gift_data, search_keys)
+                if search_changed:
+                    search.publish(collection_key, search_changed, uploader)
+            
+            # Генерация главной страницы (только если изменились данные карточек)
+            if only_keys is None or collection_key in index_dirty:
+                with metrics.timer('render', artifact='index'):
+                    main_page_html = generate_main_page(collection_name)
+                    # Загрузка главной страницы на Yandex
+                    uploader.submit(f"{collection_name}.html", main_page_html)
+                    generate_manifest(gift_data, collection_name, uploader, manifest_page_size, only_keys,
+                                      rarity.get(collection_key))
             
             # Генерация страниц подарков
-            generate_gift_pages(gift_data, collection_name, yandex_client, bucket_name)
+            with metrics.timer('render', artifact='gift_page'):
+                generate_gift_pages(gift_data, collection_name, uploader, only_keys)
             
             # Генерация JSON-файлов
-            generate_json_files(gift_data, collection_name, yandex_client, bucket_name)
+            if per_gift_json:
+                with metrics.timer('render', artifact='gift_json'):
+                    generate_json_files(gift_data, collection_name, uploader, only_keys)
+            
+            # Выгрузка коллекции целиком
+            export_pending.add(collection_key)
+            if exporter and exporter.due(collection_key):
+                with metrics.timer('render', artifact='export'):
+                    exporter.export(gift_data, collection_name, uploader)
+                export_pending.discard(collection_key)
+        if assets:
+            assets.report()
+        if events:
+            events.publish(uploader)
+        with metrics.timer('upload_flush'):
+            uploader.flush()
+        if assets:
+            assets.save()
+        checkpoint.clear()
+        metrics.end_cycle(interval_seconds, metrics_summary_file)
         
+        cycle += 1
+        if max_cycles is not None and cycle >= max_cycles:
+            break
         print(f"Ожидание {interval_seconds} секунд до следующей проверки...")
-        time.sleep(interval_seconds)
+        if shutdown_event.wait(interval_seconds):
+            break
+    
+    uploader.close()
+    state_store.close()
+    if shutdown_event.is_set():
+        print("Состояние сохранено, процесс остановлен.")
 
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] == "export-state":
+        export_state(*sys.argv[2:3])
+    elif len(sys.argv) > 1 and sys.argv[1] == "worker":
+        # python main.py worker [id] — id должен быть уникальным и постоянным для воркера
+        worker_id = sys.argv[2] if len(sys.argv) > 2 else f"{socket.gethostname()}-{os.getpid()}"
+        config = load_config()
+        run_worker(worker_config(config, worker_id, config.get('metrics', {}).get('port')), worker_id)
+    elif len(sys.argv) > 1 and sys.argv[1] == "refresh-metadata":
+        refresh_metadata(*sys.argv[2:3])
+    elif len(sys.argv) > 1 and sys.argv[1] == "publisher":
+        run_publisher(load_config())
+    elif len(sys.argv) > 1 and sys.argv[1] == "workers":
+        # python main.py workers N — N воркеров и публикатор на одной машине
+        run_local_cluster('config.json', int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count())
+    else:
+        main()